@@ -0,0 +1,135 @@
+"""
+Gunicorn Configuration
+
+Sizes the workers of the service from the CPUs its container may use and
+the size of its database connection pool. Every setting can be changed
+with an environment variable:
+
+    GUNICORN_WORKERS              worker processes, one per CPU (at least 2) for gthread
+                                  and 2 x CPUs + 1 for sync workers
+    GUNICORN_THREADS              threads of a gthread worker, one per connection of the pool
+                                  (less one for the group commit writer when it is enabled)
+                                  so a request never waits for a connection, plus
+    GUNICORN_STREAM_THREADS       threads set aside for /orders/events streams and wait_for
+                                  polls, which park without a connection, 4 by default. A
+                                  worker with more of them open at once runs short of threads
+                                  for other requests, so a service serving many subscribers
+                                  should raise this or serve them from a deployment of its own
+    GUNICORN_WORKER_CLASS         gthread or sync
+    GUNICORN_PRELOAD              import the service once before forking the workers
+    GUNICORN_MAX_REQUESTS         requests a worker serves before it is replaced, 0 never
+    GUNICORN_MAX_REQUESTS_JITTER  random extra requests so workers are not replaced together
+    GUNICORN_TIMEOUT              seconds a silent worker has before it is killed
+    GUNICORN_GRACEFUL_TIMEOUT     seconds a worker has to finish its requests on restart
+    GUNICORN_KEEPALIVE            seconds a connection is kept open between requests
+    GUNICORN_LOG_LEVEL            level of the error log
+    DB_MAX_CONNECTIONS            connections the service may open, workers are capped so
+                                  that workers x (DB_POOL_SIZE + DB_POOL_OVERFLOW, plus the
+                                  LISTEN connection with ORDER_EVENTS_NOTIFY) fits, and the
+                                  service does not start when not even one worker fits
+"""
+# pylint: disable=invalid-name
+import os
+import math
+
+# Where the cgroup of the container limits its CPU time
+CGROUP_ROOT = "/sys/fs/cgroup"
+
+
+def cpu_limit(root: str = CGROUP_ROOT) -> int:
+    """Returns the number of CPUs this container may use, rounded up"""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    quota = cgroup_quota(root)
+    if quota:
+        cpus = min(cpus, math.ceil(quota))
+    return max(1, cpus)
+
+
+def cgroup_quota(root: str = CGROUP_ROOT):
+    """Returns the CPU quota of the cgroup in CPUs, or None when there is none"""
+    try:
+        # cgroup v2: "<quota> <period>" or "max <period>"
+        with open(os.path.join(root, "cpu.max"), encoding="utf-8") as limit:
+            quota, period = limit.read().split()[:2]
+        if quota == "max":
+            return None
+    except OSError:
+        try:
+            # cgroup v1: the quota is -1 without a limit
+            with open(os.path.join(root, "cpu", "cpu.cfs_quota_us"), encoding="utf-8") as limit:
+                quota = limit.read().strip()
+            with open(os.path.join(root, "cpu", "cpu.cfs_period_us"), encoding="utf-8") as limit:
+                period = limit.read().strip()
+        except OSError:
+            return None
+    if int(quota) <= 0 or int(period) <= 0:
+        return None
+    return int(quota) / int(period)
+
+
+def size_workers(environ=os.environ, cpus: int = None):
+    """
+    Returns the worker class, workers and threads for the CPUs and database pool
+
+    Python runs one thread at a time in a process, so gthread workers get
+    one process per CPU for throughput and threads for requests that wait
+    on the database, and on top of those for requests that stream events.
+    Sync workers serve one request at a time and get the usual 2 x CPUs + 1
+    """
+    cpus = cpus or cpu_limit()
+    kind = environ.get("GUNICORN_WORKER_CLASS", "gthread")
+    pool = int(environ.get("DB_POOL_SIZE", "2")) + int(environ.get("DB_POOL_OVERFLOW", "10"))
+    if kind == "gthread":
+        worker_count = max(2, cpus)
+        # The group commit writer takes a connection of the pool for itself
+        writer = 1 if flag(environ, "GROUP_COMMIT_ENABLED") else 0
+        thread_count = max(1, pool - writer) + int(environ.get("GUNICORN_STREAM_THREADS", "4"))
+    else:
+        worker_count = 2 * cpus + 1
+        thread_count = 1
+    worker_count = int(environ.get("GUNICORN_WORKERS", worker_count))
+    thread_count = int(environ.get("GUNICORN_THREADS", thread_count))
+
+    # Every worker has a pool of its own, and a connection LISTENing for events beside it
+    connections = pool + (1 if flag(environ, "ORDER_EVENTS_NOTIFY") else 0)
+    max_connections = int(environ.get("DB_MAX_CONNECTIONS", "0"))
+    if max_connections:
+        if max_connections < connections:
+            raise ValueError(f"DB_MAX_CONNECTIONS={max_connections} is below the {connections} "
+                             "connections of a single worker, "
+                             "lower DB_POOL_SIZE or DB_POOL_OVERFLOW")
+        worker_count = min(worker_count, max_connections // connections)
+    return kind, worker_count, thread_count
+
+
+def flag(environ, name: str) -> bool:
+    """True when the environment variable is set to true"""
+    return environ.get(name, "false").lower() == "true"
+
+
+def when_ready(server):
+    """Closes the connections a preloaded service opened so workers never share one"""
+    if server.cfg.preload_app:
+        # pylint: disable=import-outside-toplevel
+        from service.models import db
+        db.engine.dispose()
+
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
+worker_class, workers, threads = size_workers()
+preload_app = os.getenv("GUNICORN_PRELOAD", "true").lower() == "true"
+
+# Replacing workers now and then bounds the memory any leak can grow to
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", "1000"))
+max_requests_jitter = int(os.getenv("GUNICORN_MAX_REQUESTS_JITTER", str(max_requests // 10)))
+
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "30"))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", "5"))
+
+accesslog = "-"
+errorlog = "-"
+loglevel = os.getenv("GUNICORN_LOG_LEVEL", "info")
@@ -9,14 +9,20 @@ import sys
 import logging
 from flask import Flask
 from flask_restx import Api
+from werkzeug.middleware.proxy_fix import ProxyFix
 from service import config
 from .utils import log_handlers
 
 # Create Flask application
 app = Flask(__name__)
+app.config.from_object(config)
 
 app.url_map.strict_slashes = False
 
+# Take the client address from the X-Forwarded-For entries of trusted proxies only
+if app.config["PROXY_FIX_HOPS"]:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config["PROXY_FIX_HOPS"])
+
 app.config['LOGGING_LEVEL'] = logging.INFO
 
 
@@ -34,21 +40,46 @@ api = Api(app,
 
 # Dependencies require we import the routes AFTER the Flask app is created
 # pylint: disable=wrong-import-position, wrong-import-order
-from service import routes, models        # noqa: F401, E402
-from service.utils import error_handlers, cli_commands  # noqa: F401, E402
+from service import routes, event_routes, batch_routes, models  # noqa: F401, E402
+from service.utils import (  # noqa: F401, E402
+    error_handlers, cli_commands, pubsub, group_commit, admission, singleflight, compression,
+    shared_cache
+)
 
 # Set up logging for production
 log_handlers.init_logging(app, "gunicorn.error")
 
+# Publish committed Order changes to the event streams
+pubsub.init_pubsub(app)
+
+# Coalesce concurrent creates into shared transactions when enabled
+group_commit.init_group_commit(app)
+
+# Bound the requests in progress when enabled
+admission.init_admission(app)
+
+# Share fetches between identical reads in progress
+singleflight.init_singleflight(app)
+
+# Share cached Orders between the workers of the host when enabled
+shared_cache.init_shared_cache(app)
+
+# Compress the responses the client accepts compressed
+compression.init_compression(app)
+
 app.logger.info(70 * "*")
 app.logger.info(" O R D E R   S E R V I C E   R U N N I N G  ".center(70, "*"))
 app.logger.info(70 * "*")
 
-try:
-    models.init_db(app)  # make our SQLAlchemy tables
-except Exception as error:  # pylint: disable=broad-except
-    app.logger.critical("%s: Cannot continue", error)
-    # gunicorn requires exit code 4 to stop spawning workers when they die
-    sys.exit(4)
+if app.config["DB_INIT_MODE"] == "lazy":
+    # Tables are made by `flask init-db`, workers connect on their first request
+    models.init_db(app, create_tables=False)
+else:
+    try:
+        models.init_db(app)  # make our SQLAlchemy tables
+    except Exception as error:  # pylint: disable=broad-except
+        app.logger.critical("%s: Cannot continue", error)
+        # gunicorn requires exit code 4 to stop spawning workers when they die
+        sys.exit(4)
 
 app.logger.info("Service initialized!")
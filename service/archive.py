@@ -0,0 +1,136 @@
+"""
+Models for archived Orders
+
+Delivered and cancelled Orders past the retention window are moved to
+these tables with their Items
+"""
+import logging
+from datetime import datetime
+from service.models import db, Order, Item, OrderStatus, append_changes, local_time
+
+logger = logging.getLogger("flask.app")
+
+
+class ArchivedItem(db.Model):
+    """
+    Class that represents an Item of an archived Order
+    """
+
+    __tablename__ = "item_archive"
+
+    # Table Schema, the same columns as item keeping the ids they had there
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    order_id = db.Column(db.Integer, db.ForeignKey("order_archive.id", ondelete="CASCADE"),
+                         nullable=False)
+    product_id = db.Column(db.Integer, nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    price = db.Column(db.Float, nullable=False)
+
+    __table_args__ = (
+        db.Index("ix_item_archive_order_id_id", "order_id", "id"),
+    )
+
+    def __repr__(self):
+        return f"<ArchivedItem {self.product_id} id=[{self.id}] order[{self.order_id}]>"
+
+    def serialize(self):
+        """Serializes an archived item into a dictionary shaped like a live one"""
+        return Item.serialize(self)
+
+
+class ArchivedOrder(db.Model):
+    """
+    Class that represents an archived Order
+
+    Orders that reached a terminal status longer than a retention window
+    ago are moved here with their Items by archive(), so the order and
+    item tables scanned by lists and lookups hold the Orders still being
+    worked on. Archived Orders are read by id only and never change
+    """
+
+    __tablename__ = "order_archive"
+
+    # The statuses an Order is archived in
+    statuses = (OrderStatus.DELIVERED, OrderStatus.CANCELLED)
+
+    # Table Schema, the same columns as order keeping the ids they had there
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    customer_id = db.Column(db.Integer, nullable=False)
+    tracking_id = db.Column(db.Integer)
+    created_time = db.Column(db.DateTime())
+    status = db.Column(db.Enum(OrderStatus), nullable=False)
+    archived_time = db.Column(db.DateTime(), nullable=False, server_default=db.func.now())
+    order_items = db.relationship("ArchivedItem", passive_deletes=True, lazy="selectin",
+                                  order_by="ArchivedItem.id")
+
+    def __repr__(self):
+        return f"<ArchivedOrder {self.id}: Customer_id=[{self.customer_id}], " \
+               f"Status=[{self.status}]>"
+
+    def serialize(self, items_limit: int = None):
+        """Serializes an archived order into a dictionary shaped like a live one"""
+        columns = ("id", "customer_id", "tracking_id", "created_time")
+        order = {name: getattr(self, name) for name in columns}
+        order["status"] = self.status.name
+        order["order_items"] = [item.serialize() for item in self.order_items[:items_limit]]
+        order["items_count"] = len(self.order_items)
+        return order
+
+    @classmethod
+    def find(cls, by_id):
+        """Finds an archived Order by it's ID"""
+        logger.info("Processing archive lookup for id %s ...", by_id)
+        return cls.query.get(by_id)
+
+    @classmethod
+    def archive(cls, session, cutoff: datetime, batch_size: int = 1000) -> tuple:
+        """
+        Moves a batch of terminal Orders created before cutoff, with their Items, to the archive
+
+        The oldest Orders by id go first. On Postgres Orders locked by a
+        writer are skipped for a later batch rather than waited for. An
+        "archive" change is appended for each Order so caches and
+        snapshots learn that it moved, while the customer summary, which
+        counts archived Orders too, is left as it is. The caller commits
+
+        :return: the number of Orders and of Items moved
+        """
+        query = db.select([Order.id, Order.customer_id, Order.status]).where(
+            Order.status.in_(cls.statuses) & (Order.created_time < local_time(cutoff))
+        ).order_by(Order.id).limit(batch_size)
+        connection = session.connection()
+        if connection.dialect.name == "postgresql":
+            query = query.with_for_update(of=Order.__table__, skip_locked=True)
+        orders = session.execute(query).fetchall()
+        if not orders:
+            return 0, 0
+        order_ids = [row.id for row in orders]
+        logger.info("Archiving %s orders from %s ...", len(order_ids), order_ids[0])
+        products = {}
+        for order_id, product_id in session.execute(
+            db.select([Item.order_id, Item.product_id])
+            .where(Item.order_id.in_(order_ids)).distinct()
+        ):
+            products.setdefault(order_id, set()).add(product_id)
+
+        order_columns = ["id", "customer_id", "tracking_id", "created_time", "status"]
+        item_columns = ["id", "order_id", "product_id", "quantity", "price"]
+        session.execute(cls.__table__.insert().from_select(order_columns, db.select(
+            [Order.__table__.c[name] for name in order_columns]
+        ).where(Order.id.in_(order_ids))))
+        items = session.execute(ArchivedItem.__table__.insert().from_select(item_columns, db.select(
+            [Item.__table__.c[name] for name in item_columns]
+        ).where(Item.order_id.in_(order_ids)))).rowcount
+        session.execute(Item.__table__.delete().where(Item.order_id.in_(order_ids)))
+        session.execute(Order.__table__.delete().where(Order.id.in_(order_ids)))
+
+        append_changes(session, [
+            {"order_id": row.id, "item_id": None, "customer_id": row.customer_id,
+             "action": "archive", "status": row.status, "previous_status": None}
+            for row in orders
+        ], [
+            {"customer_id": [row.customer_id], "status": [row.status.name],
+             "product_id": sorted(products.get(row.id, ()))}
+            for row in orders
+        ])
+        return len(order_ids), items
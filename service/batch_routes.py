@@ -0,0 +1,136 @@
+"""
+Batch Routes
+Paths:
+------
+run_batch     POST     /batch
+"""
+import re
+
+from flask import request
+from flask_restx import Resource, fields
+from service.models import atomic, db
+from .utils import status  # HTTP Status Codes
+from .utils.admission import NESTED_KEY
+from .routes import abort
+
+# Import Flask application
+from . import app, api
+
+batch_call_model = api.model('BatchCall', {
+    'method': fields.String(required=True, enum=['GET', 'POST', 'PUT', 'DELETE'],
+                            description='The HTTP method of the call'),
+    'path': fields.String(required=True,
+                          description='The path of the call, e.g. /api/orders/{0.id}/items'),
+    'body': fields.Raw(required=False, description='The JSON body of the call'),
+})
+
+batch_model = api.model('Batch', {
+    'atomic': fields.Boolean(required=False, default=False,
+                             description='Run all of the calls in one transaction'),
+    'requests': fields.List(fields.Nested(batch_call_model), required=True,
+                            description='The calls to run, in order'),
+})
+
+batch_response_model = api.model('BatchResponse', {
+    'committed': fields.Boolean(description='Whether the changes of the calls were kept'),
+    'responses': fields.List(fields.Raw, description='The status, headers and body of each call'),
+})
+
+# The most calls a single batch may carry
+MAX_BATCH_REQUESTS = 50
+
+# References such as {0.id} to a field of an earlier call's response body
+BATCH_REFERENCE = re.compile(r"\{(\d+)\.(\w+)\}")
+
+
+######################################################################
+#  PATH: /batch
+######################################################################
+@api.route('/batch', strict_slashes=False)
+class BatchResource(Resource):
+    """ Runs many API calls in one request """
+    @api.doc('run_batch')
+    @api.response(400, 'The posted batch was not valid')
+    @api.expect(batch_model, validate=True)
+    @api.marshal_with(batch_response_model)
+    def post(self):
+        """
+        Run a batch of calls
+
+        This endpoint runs each call against the API in order and returns
+        their responses. A path may refer to a field of an earlier response
+        body as {index.field}. When atomic is set the calls share one
+        transaction and the first failing call rolls all of them back
+        """
+        calls = api.payload["requests"]
+        app.logger.info("Request to run a batch of %s calls", len(calls))
+        check_batch(calls)
+
+        responses = []
+        if not api.payload.get("atomic"):
+            for call in calls:
+                responses.append(run_batch_call(call, responses))
+                if responses[-1]["status"] >= status.HTTP_500_INTERNAL_SERVER_ERROR:
+                    db.session.rollback()
+            return {"committed": True, "responses": responses}, status.HTTP_200_OK
+
+        try:
+            with atomic():
+                for call in calls:
+                    responses.append(run_batch_call(call, responses))
+                    if responses[-1]["status"] >= status.HTTP_400_BAD_REQUEST:
+                        raise BatchAborted()
+        except BatchAborted:
+            app.logger.info("Batch rolled back after call %s failed", len(responses) - 1)
+            return {"committed": False, "responses": responses}, status.HTTP_200_OK
+        return {"committed": True, "responses": responses}, status.HTTP_200_OK
+
+
+######################################################################
+#  U T I L I T Y   F U N C T I O N S
+######################################################################
+
+
+class BatchAborted(Exception):
+    """ Raised to roll back an atomic batch when one of its calls fails """
+
+
+def check_batch(calls: list):
+    """Aborts if a batch is too long or calls outside of the API"""
+    if len(calls) > MAX_BATCH_REQUESTS:
+        abort(
+            status.HTTP_400_BAD_REQUEST,
+            f"Cannot run more than {MAX_BATCH_REQUESTS} calls in one batch."
+        )
+    for call in calls:
+        path = call["path"]
+        if not path.startswith(api.prefix) or path.startswith(f"{api.prefix}/batch"):
+            abort(status.HTTP_400_BAD_REQUEST, f"Cannot run call to '{path}' in a batch.")
+
+
+def run_batch_call(call: dict, responses: list):
+    """Dispatches one call of a batch and returns its status, headers and body"""
+
+    def resolve(match):
+        position, field = int(match.group(1)), match.group(2)
+        if position >= len(responses) or not isinstance(responses[position]["body"], dict):
+            abort(status.HTTP_400_BAD_REQUEST, f"Cannot resolve reference '{match.group(0)}'.")
+        return str(responses[position]["body"].get(field))
+
+    path = BATCH_REFERENCE.sub(resolve, call["path"])
+    with app.test_request_context(path, method=call["method"], json=call.get("body"),
+                                  base_url=request.host_url, environ_overrides={NESTED_KEY: True}):
+        try:
+            response = app.full_dispatch_request()
+        except Exception as error:  # pylint: disable=broad-except
+            app.logger.error("Batch call to %s failed: %s", path, error)
+            response = app.make_response((
+                {"status_code": status.HTTP_500_INTERNAL_SERVER_ERROR, "message": str(error)},
+                status.HTTP_500_INTERNAL_SERVER_ERROR
+            ))
+    headers = {name: value for name, value in response.headers if name == "Location"}
+    return {
+        "status": response.status_code,
+        "headers": headers,
+        "body": response.get_json(silent=True)
+    }
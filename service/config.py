@@ -19,7 +19,81 @@ if 'VCAP_SERVICES' in os.environ:
 # Configure SQLAlchemy
 SQLALCHEMY_DATABASE_URI = DATABASE_URI
 SQLALCHEMY_TRACK_MODIFICATIONS = False
-SQLALCHEMY_POOL_SIZE = 2
+# Connections each worker keeps open, and may open beyond that when busy
+SQLALCHEMY_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "2"))
+SQLALCHEMY_MAX_OVERFLOW = int(os.getenv("DB_POOL_OVERFLOW", "10"))
+
+# How workers prepare the database: "create" makes any missing tables when the
+# service is imported, "lazy" leaves that to `flask init-db` and connects on the
+# first request, retrying DB_CONNECT_RETRIES times with exponential backoff.
+# Indexes and defaults missing from existing tables are added by `flask init-db` only
+DB_INIT_MODE = os.getenv("DB_INIT_MODE", "create").lower()
+DB_CONNECT_RETRIES = int(os.getenv("DB_CONNECT_RETRIES", "3"))
+DB_CONNECT_BACKOFF = float(os.getenv("DB_CONNECT_BACKOFF", "0.5"))
+
+# Send executemany() as multi-row INSERT statements instead of one per row
+if DATABASE_URI.startswith("postgresql"):
+    SQLALCHEMY_ENGINE_OPTIONS = {"executemany_mode": "values"}
+
+# Share Order change events between workers through Postgres LISTEN/NOTIFY
+ORDER_EVENTS_NOTIFY = os.getenv("ORDER_EVENTS_NOTIFY", "false").lower() == "true"
+
+# Coalesce concurrent Order and Item creation into one transaction per window,
+# answering with a 503 a request whose write was not done in GROUP_COMMIT_TIMEOUT_SECONDS
+GROUP_COMMIT_ENABLED = os.getenv("GROUP_COMMIT_ENABLED", "false").lower() == "true"
+GROUP_COMMIT_WINDOW_MS = float(os.getenv("GROUP_COMMIT_WINDOW_MS", "2"))
+GROUP_COMMIT_MAX_BATCH = int(os.getenv("GROUP_COMMIT_MAX_BATCH", "50"))
+GROUP_COMMIT_TIMEOUT_SECONDS = float(os.getenv("GROUP_COMMIT_TIMEOUT_SECONDS", "10"))
+
+# Admission control: at most ADMISSION_MAX_READS reads and ADMISSION_MAX_WRITES
+# writes in progress per worker, others wait up to ADMISSION_QUEUE_TIMEOUT_MS
+# for a slot and get a 503 after that. With RATE_LIMIT_PER_SECOND each client
+# gets that many requests a second in bursts of RATE_LIMIT_BURST and a 429 beyond
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "false").lower() == "true"
+ADMISSION_MAX_READS = int(os.getenv("ADMISSION_MAX_READS", "8"))
+ADMISSION_MAX_WRITES = int(os.getenv("ADMISSION_MAX_WRITES", "4"))
+ADMISSION_MAX_WAITING = int(os.getenv("ADMISSION_MAX_WAITING", "16"))
+ADMISSION_QUEUE_TIMEOUT_MS = float(os.getenv("ADMISSION_QUEUE_TIMEOUT_MS", "250"))
+ADMISSION_RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", "1"))
+RATE_LIMIT_PER_SECOND = float(os.getenv("RATE_LIMIT_PER_SECOND", "0"))
+RATE_LIMIT_BURST = int(os.getenv("RATE_LIMIT_BURST", "20"))
+
+# Proxies in front of the service whose X-Forwarded-For entries are trusted,
+# clients are rate limited by their own address when it is 0
+PROXY_FIX_HOPS = int(os.getenv("PROXY_FIX_HOPS", "0"))
+
+# Share one fetch between identical Order reads in progress in a worker
+SINGLEFLIGHT_ENABLED = os.getenv("SINGLEFLIGHT_ENABLED", "true").lower() == "true"
+
+# Compress responses of at least COMPRESSION_MIN_SIZE bytes at COMPRESSION_LEVEL
+# (1 fastest to 9 smallest) with brotli, zstd or gzip, as the client accepts
+COMPRESSION_ENABLED = os.getenv("COMPRESSION_ENABLED", "true").lower() == "true"
+COMPRESSION_LEVEL = int(os.getenv("COMPRESSION_LEVEL", "6"))
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+
+# Cache serialized Orders and lists in a file shared by the workers of a host,
+# of CACHE_SIZE_MB, in which entries live CACHE_TTL_SECONDS at most
+CACHE_ENABLED = os.getenv("CACHE_ENABLED", "false").lower() == "true"
+CACHE_PATH = os.getenv(
+    "CACHE_PATH", "/dev/shm/orders-cache" if os.path.isdir("/dev/shm") else "/tmp/orders-cache"
+)
+CACHE_SIZE_MB = float(os.getenv("CACHE_SIZE_MB", "8"))
+CACHE_TTL_SECONDS = float(os.getenv("CACHE_TTL_SECONDS", "60"))
+
+# Seconds a report may be answered from the analytics snapshot before it is refreshed
+ANALYTICS_MAX_AGE_SECONDS = float(os.getenv("ANALYTICS_MAX_AGE_SECONDS", "30"))
+
+# DELIVERED and CANCELLED Orders created more than ARCHIVE_RETENTION_DAYS ago
+# are moved to the archive tables by `flask archive-orders`
+ARCHIVE_RETENTION_DAYS = int(os.getenv("ARCHIVE_RETENTION_DAYS", "90"))
+
+# Logging: "text" or "json" lines, written by a background thread when
+# LOG_QUEUE_ENABLED, with LOG_SAMPLE_RATES like "INFO=0.1" keeping one in
+# ten info records
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()
+LOG_QUEUE_ENABLED = os.getenv("LOG_QUEUE_ENABLED", "false").lower() == "true"
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_SAMPLE_RATES = os.getenv("LOG_SAMPLE_RATES", "")
 
 # Secret for session management
 SECRET_KEY = os.getenv("SECRET_KEY", "sup3r-s3cr3t")
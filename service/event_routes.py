@@ -0,0 +1,110 @@
+"""
+Order Event Routes
+Paths:
+------
+stream_events   GET      /orders/events
+
+Also waits for the status asked of GET /orders/<int:order_id> by wait_for
+"""
+import json
+import time
+
+from flask import request, Response
+from flask_restx import Resource, reqparse, inputs
+from service.models import Order, OrderStatus, in_atomic, db
+from .utils import status  # HTTP Status Codes
+from .utils.pubsub import broker
+from .utils.admission import admission_controller, NESTED_KEY
+from .routes import abort
+
+# Import Flask application
+from . import app, api
+
+# Seconds between keep-alive comments on an idle event stream
+EVENT_HEARTBEAT_SECONDS = 15
+
+event_args = reqparse.RequestParser()
+event_args.add_argument('order_id', type=int, required=False, location='args',
+                        help='Stream the status changes of this Order')
+event_args.add_argument('customer_id', type=int, required=False, location='args',
+                        help='Stream the status changes of the Orders of this customer')
+event_args.add_argument('timeout', type=inputs.int_range(1, 3600), required=False, default=300,
+                        location='args', help='Seconds after which the stream ends')
+
+
+######################################################################
+#  PATH: /orders/events
+######################################################################
+@api.route('/orders/events', strict_slashes=False)
+class OrderEventStream(Resource):
+    """ Streams Order status changes as server-sent events """
+    @api.doc('stream_events', produces=['text/event-stream'])
+    @api.expect(event_args, validate=True)
+    @api.response(400, 'Neither an order_id nor a customer_id was given')
+    def get(self):
+        """
+        Stream Order status changes
+
+        This endpoint pushes a status event each time an Order of the given
+        order_id or customer_id is created or changes status, until timeout
+        seconds have passed. EventSource clients reconnect on their own
+        """
+        args = event_args.parse_args()
+        if args["order_id"] is None and args["customer_id"] is None:
+            abort(status.HTTP_400_BAD_REQUEST, "An order_id or a customer_id is required.")
+        app.logger.info("Request to stream events of Order %s / customer %s",
+                        args["order_id"], args["customer_id"])
+        subscription = broker.subscribe(args["order_id"], args["customer_id"])
+        return Response(
+            stream_status_events(subscription, args["timeout"]),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        )
+
+
+######################################################################
+#  U T I L I T Y   F U N C T I O N S
+######################################################################
+
+
+def wait_for_status(order_id: int, wanted: OrderStatus, timeout: int):
+    """
+    Blocks until the Order reaches the wanted status, is deleted or archived or timeout passes
+
+    A call of a batch answers at once: its session holds the batch's
+    uncommitted writes, which parking would throw away, and nothing
+    else can commit a change the batch would see before it ends
+    """
+    if in_atomic() or request.environ.get(NESTED_KEY):
+        return
+    deadline = time.monotonic() + timeout
+    # Subscribe before reading the status so no change can slip in between
+    with broker.subscribe(order_id=order_id) as subscription:
+        order = Order.find(order_id)
+        if not order or order.status == wanted:
+            return
+        # Give back the connection and the admission slot while the request is parked
+        db.session.remove()
+        app.logger.info("Waiting up to %ss for Order %s to be %s", timeout, order_id, wanted.name)
+        with admission_controller.parked(request):
+            while time.monotonic() < deadline:
+                event = subscription.get(deadline - time.monotonic())
+                if event and (event["status"] == wanted.name
+                              or event["action"] in ("delete", "archive")):
+                    return
+
+
+def stream_status_events(subscription, timeout: int):
+    """Yields the status changes of a subscription as server-sent events"""
+    deadline = time.monotonic() + timeout
+    try:
+        yield f"retry: {EVENT_HEARTBEAT_SECONDS * 1000}\n\n"
+        while time.monotonic() < deadline:
+            event = subscription.get(min(EVENT_HEARTBEAT_SECONDS, deadline - time.monotonic()))
+            if event is None:
+                yield ": keep-alive\n\n"
+            elif event["item_id"] is None and (event["action"] == "create"
+                                               or event["previous_status"]):
+                yield f"event: status\ndata: {json.dumps(event)}\n\n"
+    finally:
+        subscription.close()
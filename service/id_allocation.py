@@ -0,0 +1,54 @@
+"""
+Id Allocation
+
+Primary keys of Orders and Items are handed out by the workers from
+blocks reserved ahead of time
+"""
+import logging
+import threading
+from service import models
+
+logger = logging.getLogger("flask.app")
+
+
+class IdAllocator:
+    """
+    Hands out primary keys from blocks reserved ahead of time
+
+    A whole block of ids is reserved from the table's sequence in one round
+    trip, so rows can be inserted with their keys already known instead of
+    learning each one back from the database
+    """
+
+    def __init__(self, table: str, block_size: int = 100):
+        self.table = table
+        self.block_size = block_size
+        self._lock = threading.Lock()
+        self._ids = []
+
+    def allocate(self, count: int = 1):
+        """Returns count unused ids, reserving more blocks as needed"""
+        with self._lock:
+            if len(self._ids) < count:
+                self._ids.extend(self._reserve(max(self.block_size, count - len(self._ids))))
+            ids, self._ids = self._ids[:count], self._ids[count:]
+        return ids
+
+    def reset(self):
+        """Forgets the reserved ids, which a forked worker must not share"""
+        self._ids = []
+        self._lock = threading.Lock()
+
+    def _reserve(self, count: int):
+        """Reserves count ids from the database"""
+        logger.info("Reserving %s ids for %s", count, self.table)
+        connection = models.db.session.connection()
+        if connection.dialect.name == "postgresql":
+            sql = "SELECT nextval(pg_get_serial_sequence(:table, 'id')) " \
+                  "FROM generate_series(1, :count)"
+            rows = connection.execute(models.db.text(sql), table=f'"{self.table}"', count=count)
+            return [row[0] for row in rows]
+        # Without sequences carry on from the highest id, good for a single process only
+        highest = connection.execute(models.db.text(f'SELECT max(id) FROM "{self.table}"')).scalar()
+        start = max(highest or 0, self._ids[-1] if self._ids else 0) + 1
+        return list(range(start, start + count))
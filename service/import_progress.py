@@ -0,0 +1,40 @@
+"""
+Models for bulk imports
+
+How far each named import has got, so an interrupted one can resume
+"""
+import logging
+from datetime import datetime
+from service.models import db
+
+logger = logging.getLogger("flask.app")
+
+
+class ImportProgress(db.Model):
+    """
+    Class that represents the progress of a named bulk import
+
+    It is updated in the same transaction as each chunk of imported rows,
+    so a resumed import carries on exactly after the last committed chunk
+    """
+
+    __tablename__ = "import_progress"
+
+    # Table Schema
+    name = db.Column(db.String(255), primary_key=True)
+    records = db.Column(db.BigInteger, nullable=False, default=0)
+    updated_time = db.Column(db.DateTime(), nullable=False,
+                             default=datetime.now, onupdate=datetime.now)
+
+    def __repr__(self):
+        return f"<ImportProgress {self.name}: {self.records} records>"
+
+    @classmethod
+    def find_or_start(cls, name: str):
+        """Returns the progress of the named import, starting it if it is new"""
+        logger.info("Processing import progress for %s ...", name)
+        progress = cls.query.get(name)
+        if not progress:
+            progress = cls(name=name, records=0)
+            db.session.add(progress)
+        return progress
@@ -1,31 +1,249 @@
 """
 Models for Order
 
-All of the models are stored in this module
+The Order, Item and OrderChange models are stored in this module. The
+archive, the customer summary and the import progress have modules of
+their own, and their models can be imported from here as well
 """
 
 
+import io
+import os
+import csv
+import json
+import time
 import logging
+import threading
 from enum import Enum
 from datetime import datetime
+from itertools import groupby
+from contextlib import contextmanager
+from contextvars import ContextVar
+from flask import current_app
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, DDL
+from sqlalchemy.schema import CreateIndex, DropIndex
+from sqlalchemy.orm.util import identity_key
+from sqlalchemy.exc import OperationalError
+from service.id_allocation import IdAllocator
 
 logger = logging.getLogger("flask.app")
 
 # Create the SQLAlchemy object to be initialized later in init_db()
 db = SQLAlchemy()
 
+# Set while an atomic() block is running so commits are held back until it ends
+_in_atomic = ContextVar("in_atomic", default=False)
+
+# Most rows written by one multi-row INSERT statement
+BULK_INSERT_ROWS = 1000
+
+# Postgres advisory lock taken by transactions appending to the change outbox
+OUTBOX_LOCK_KEY = 0x6f7264657273
+
+# Postgres channel committed changes are NOTIFYed on when ORDER_EVENTS_NOTIFY is set
+NOTIFY_CHANNEL = "order_changes"
+
+# Most change events carried by one NOTIFY, keeping payloads under the 8000 byte limit
+NOTIFY_BATCH = 20
+
+# Callables given the list of change events once the transaction making them commits
+change_listeners = []
+
+# Set once this worker has reached the database
+_database_ready = threading.Event()
+
 
 class DataValidationError(Exception):
     """ Used for an data validation errors when deserializing """
+
+
+class DatabaseUnavailableError(Exception):
+    """ Used when the database cannot be reached """
 ######################################################################
 #  U T I L I T Y   F U N C T I O N S
 ######################################################################
 
 
-def init_db(app):
+def init_db(app, create_tables: bool = True):
     """ Initializes the SQLAlchemy app """
-    Order.init_db(app)
+    Order.init_db(app, create_tables)
+
+
+def upgrade_schema():
+    """
+    Adds the indexes and server defaults that tables made by earlier versions lack
+
+    create_all only makes missing tables, so these are compared with the
+    database and added one by one. Nothing is done when they are in place.
+    On Postgres indexes are built CONCURRENTLY, without holding back writes
+    to the table, and one left invalid by an interrupted build is rebuilt.
+    Run by `flask init-db`, never by the workers
+    """
+    inspector = db.inspect(db.engine)
+    tables = set(inspector.get_table_names())
+    invalid = _invalid_indexes()
+    for table in db.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        indexes = {index["name"] for index in inspector.get_indexes(table.name)} - invalid
+        for index in table.indexes:
+            if index.name not in indexes:
+                _create_index(index, index.name in invalid)
+        columns = inspector.get_columns(table.name)
+        defaults = {column["name"]: column["default"] for column in columns}
+        for column in table.columns:
+            if column.server_default is not None and defaults.get(column.name) is None:
+                logger.info("Adding the default of %s.%s", table.name, column.name)
+                dialect = db.engine.dialect
+                default = dialect.ddl_compiler(dialect, None).get_column_default_string(column)
+                with db.engine.begin() as connection:
+                    connection.execute(DDL(
+                        "ALTER TABLE %(fullname)s ALTER COLUMN %(column)s SET DEFAULT %(default)s",
+                        context={"column": dialect.identifier_preparer.format_column(column),
+                                 "default": default.replace("%", "%%")}
+                    ).against(table))
+
+
+def _invalid_indexes() -> set:
+    """Returns the names of the Postgres indexes an interrupted concurrent build left invalid"""
+    if db.engine.dialect.name != "postgresql":
+        return set()
+    with db.engine.connect() as connection:
+        return {row[0] for row in connection.execute(db.text(
+            "SELECT class.relname FROM pg_index "
+            "JOIN pg_class class ON class.oid = pg_index.indexrelid WHERE NOT pg_index.indisvalid"
+        ))}
+
+
+def _create_index(index, rebuild: bool = False):
+    """Creates an index, on Postgres CONCURRENTLY outside of any transaction"""
+    logger.info("Creating index %s", index.name)
+    if db.engine.dialect.name != "postgresql":
+        index.create(db.engine)
+        return
+    options = index.dialect_options["postgresql"]
+    options["concurrently"] = True
+    try:
+        with db.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+            if rebuild:
+                connection.execute(DropIndex(index))
+            connection.execute(CreateIndex(index))
+    finally:
+        options["concurrently"] = False
+
+
+def connect_db(retries: int = 3, backoff: float = 0.5):
+    """
+    Makes sure this worker can reach the database
+
+    Returns at once after the first success. Until then each call tries to
+    connect, retrying with exponential backoff, and gives up with a
+    DatabaseUnavailableError after the given number of retries
+    """
+    if _database_ready.is_set():
+        return
+    for attempt in range(retries + 1):
+        try:
+            with db.engine.connect() as connection:
+                connection.execute(db.text("SELECT 1"))
+            _database_ready.set()
+            logger.info("Connected to the database")
+            return
+        except OperationalError as error:
+            if attempt == retries:
+                raise DatabaseUnavailableError("The database is unavailable") from error
+            logger.warning("Cannot reach the database, retrying: %s", error)
+            time.sleep(backoff * 2 ** attempt)
+
+
+@contextmanager
+def atomic():
+    """
+    Runs every create, update and delete in the block as one transaction
+
+    Inside the block the persistent methods only flush their changes, the
+    single commit happens when the block ends and any exception rolls all
+    of them back
+    """
+    if _in_atomic.get():
+        yield
+        return
+    token = _in_atomic.set(True)
+    try:
+        yield
+        db.session.commit()
+    except BaseException:
+        db.session.rollback()
+        raise
+    finally:
+        _in_atomic.reset(token)
+
+
+def in_atomic() -> bool:
+    """True while an atomic() block is running"""
+    return _in_atomic.get()
+
+
+def commit():
+    """Commits the session, or only flushes it inside an atomic() block"""
+    if _in_atomic.get():
+        db.session.flush()
+    else:
+        db.session.commit()
+
+
+def load_rows(table, rows: list):
+    """
+    Loads rows into a table as fast as the database allows
+
+    On Postgres the rows are streamed with COPY, elsewhere they are sent
+    with executemany. Either way they join the session's transaction
+    """
+    if not rows:
+        return
+    columns = list(rows[0].keys())
+    connection = db.session.connection()
+    if connection.dialect.name != "postgresql":
+        connection.execute(table.insert(), rows)
+        return
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([value.name if isinstance(value, Enum) else value
+                         for value in row.values()])
+    buffer.seek(0)
+    names = ", ".join(columns)
+    with connection.connection.cursor() as cursor:
+        cursor.copy_expert(f'COPY "{table.name}" ({names}) FROM STDIN WITH (FORMAT csv)', buffer)
+
+
+def server_now() -> datetime:
+    """Returns the local time of the database, as it stamps the created_time of new Orders"""
+    return db.session.execute(db.select([db.cast(db.func.now(), db.DateTime())])).scalar()
+
+
+def local_time(value: datetime) -> datetime:
+    """
+    Turns a datetime into a naive local time comparable with created_time
+
+    created_time holds the local time of the database, so on Postgres a
+    time with a time zone is converted by the database in the TimeZone of
+    its session, which may differ from the zone of this worker
+    """
+    if not value.tzinfo:
+        return value
+    if db.session.connection().dialect.name == "postgresql":
+        return db.session.execute(db.select([
+            db.cast(db.literal(value, db.DateTime(timezone=True)), db.DateTime())
+        ])).scalar()
+    return value.astimezone().replace(tzinfo=None)
+
+
+def insert_rows(table, rows: list):
+    """Inserts rows into a table with one multi-row INSERT per BULK_INSERT_ROWS rows"""
+    for start in range(0, len(rows), BULK_INSERT_ROWS):
+        db.session.execute(table.insert().values(rows[start:start + BULK_INSERT_ROWS]))
 
 
 class OrderStatus(Enum):
@@ -52,34 +270,47 @@ class PersistentBase:
     def create(self):
         """
         Creates an Order/Item to the database
+
+        Ids are taken from the class's block allocator rather than from the
+        database on insert, so an Order and its Items go out as one INSERT
+        statement per table
         """
         logger.info("Creating %s", self.id)
-        self.id = None  # id must be none to generate next primary key
+        self.id = self.ids.allocate()[0]  # any given id is replaced by a fresh one
+        for item in getattr(self, "order_items", []):
+            if item.id is None:
+                item.id = item.ids.allocate()[0]
         db.session.add(self)
-        db.session.commit()
+        commit()
+
+    def row(self):
+        """Returns the values of the table columns of an Order/Item"""
+        return {column.name: getattr(self, column.name) for column in self.__table__.columns}
 
     def update(self):
         """
         Updates an Order/Item to the database
         """
         logger.info("Updating %s", self.id)
-        db.session.commit()
+        commit()
 
     def delete(self):
         """Removes an Order/Item from the database"""
         logger.info("Deleting %s", self.id)
         db.session.delete(self)
-        db.session.commit()
+        commit()
 
     @classmethod
-    def init_db(cls, app):
-        """Initializes the database session"""
+    def init_db(cls, app, create_tables: bool = True):
+        """Initializes the database session, and the tables unless create_tables is False"""
         logger.info("Initializing database")
         cls.app = app
         # This is where we initialize SQLAlchemy from the Flask app
         db.init_app(app)
         app.app_context().push()
-        db.create_all()  # make our sqlalchemy tables
+        if create_tables:
+            db.create_all()  # make our sqlalchemy tables
+            _database_ready.set()
 
     @classmethod
     def all(cls):
@@ -111,6 +342,16 @@ class Item(db.Model, PersistentBase):
     quantity = db.Column(db.Integer, nullable=False, default=1)
     price = db.Column(db.Float, nullable=False)
 
+    # Allocates the ids of new Items
+    ids = IdAllocator("item")
+
+    # Items are always read per order and in id order, so this index serves
+    # both the embedded items of an order and the paginated item listing
+    __table_args__ = (
+        db.Index("ix_item_order_id_id", "order_id", "id"),
+        db.Index("ix_item_product_id_order_id", "product_id", "order_id"),
+    )
+
     def __repr__(self):
         return f"<Item {self.product_id} id=[{self.id}] order[{self.order_id}]>"
 
@@ -147,6 +388,33 @@ class Item(db.Model, PersistentBase):
             ) from error
         return self
 
+    @classmethod
+    def find_by_order(cls, order_id: int, after: int = 0, limit: int = None):
+        """Returns a page of the Items of the given order ID
+
+        :param order_id: the id of the order the items belong to
+        :type order_id: int
+        :param after: only items with an id greater than this are returned
+        :type after: int
+        :param limit: the maximum number of items to return
+        :type limit: int
+
+        :return: a collection of Items of that order ordered by id
+        :rtype: list
+
+        """
+        logger.info("Processing item page query for order %s after %s ...", order_id, after)
+        query = cls.query.filter(cls.order_id == order_id, cls.id > after).order_by(cls.id)
+        if limit is not None:
+            query = query.limit(limit)
+        return query
+
+    @classmethod
+    def count_by_order(cls, order_id: int):
+        """Returns the number of Items of the given order ID"""
+        logger.info("Processing item count for order %s ...", order_id)
+        return cls.query.filter(cls.order_id == order_id).count()
+
 ######################################################################
 #  O R D E R   M O D E L
 #  Order: a collection of order items
@@ -160,15 +428,27 @@ class Order(db.Model, PersistentBase):
 
     app = None
 
+    # Allocates the ids of new Orders
+    ids = IdAllocator("order")
+
     # Table Schema
     id = db.Column(db.Integer, primary_key=True)
     customer_id = db.Column(db.Integer, nullable=False)
     tracking_id = db.Column(db.Integer)
-    created_time = db.Column(db.DateTime(), default=datetime.now)
-    status = db.Column(
-        db.Enum(OrderStatus), nullable=False, server_default=(OrderStatus.PLACED.name)
+    # Stamped by the database, which every worker agrees with, when no time is given
+    created_time = db.Column(db.DateTime(), server_default=db.func.now())
+    # active_history loads the old status on change so transitions can be recorded
+    status = db.column_property(
+        db.Column(db.Enum(OrderStatus), nullable=False, server_default=OrderStatus.PLACED.name),
+        active_history=True
+    )
+    order_items = db.relationship('Item', backref='order', passive_deletes=True, order_by='Item.id')
+
+    # Orders are appended in time order, so on Postgres a BRIN index of a
+    # few pages answers time ranges as well as a B-tree many times its size
+    __table_args__ = (
+        db.Index("ix_order_created_time", "created_time", postgresql_using="brin"),
     )
-    order_items = db.relationship('Item', backref='order', passive_deletes=True)
 
     def __repr__(self):
         str_return = f"<Order {self.id}: Customer_id=[{self.customer_id}], "
@@ -176,11 +456,22 @@ class Order(db.Model, PersistentBase):
         str_return += f"items_number=[{len(self.order_items)}]>"
         return str_return
 
-    def serialize(self):
-        """Serializes an order into a dictionary"""
-        items = []
-        for item in self.order_items:
-            items.append(Item.serialize(item))
+    def serialize(self, items_limit: int = None):
+        """Serializes an order into a dictionary
+
+        When items_limit is given only the first items_limit Items are
+        embedded, the rest can be paged through the item collection
+        """
+        if items_limit is None:
+            items = [Item.serialize(item) for item in self.order_items]
+            items_count = len(items)
+        elif "order_items" not in db.inspect(self).unloaded:
+            items = [Item.serialize(item) for item in self.order_items[:items_limit]]
+            items_count = len(self.order_items)
+        else:
+            items = Item.find_by_order(self.id, limit=items_limit)
+            items = [Item.serialize(item) for item in items]
+            items_count = Item.count_by_order(self.id)
 
         order = {
             "id": self.id,
@@ -188,7 +479,8 @@ class Order(db.Model, PersistentBase):
             "tracking_id": self.tracking_id,
             "created_time": self.created_time,
             "status": self.status.name,
-            "order_items": items
+            "order_items": items,
+            "items_count": items_count
         }
 
         return order
@@ -218,6 +510,120 @@ class Order(db.Model, PersistentBase):
             ) from error
         return self
 
+    @classmethod
+    def bulk_create(cls, orders: list):
+        """
+        Creates many Orders with their Items
+
+        Keys for all of the rows are allocated up front so each table is
+        written with multi-row INSERT statements instead of one per row
+
+        :param orders: the new Orders, with their order_items
+        :type orders: list
+
+        :return: the Orders, now with ids
+        :rtype: list
+
+        """
+        logger.info("Bulk creating %s orders", len(orders))
+        items = [item for order in orders for item in order.order_items]
+        now = server_now()
+        for order, order_id in zip(orders, cls.ids.allocate(len(orders))):
+            order.id = order_id
+            order.created_time = order.created_time or now
+            # Core inserts send every column, so the server defaults are filled in here
+            order.status = order.status or OrderStatus.PLACED
+            for item in order.order_items:
+                item.order_id = order_id
+        for item, item_id in zip(items, Item.ids.allocate(len(items))):
+            item.id = item_id
+        order_rows, item_rows = [order.row() for order in orders], [item.row() for item in items]
+        insert_rows(cls.__table__, order_rows)
+        insert_rows(Item.__table__, item_rows)
+        CustomerOrderSummary.apply(db.session, summarize_rows(order_rows, item_rows))
+        append_changes(db.session, [OrderChange.of(order, "create") for order in orders] +
+                       [OrderChange.of(item, "create") for item in items],
+                       [OrderChange.scope(db.session, order) for order in orders] +
+                       [OrderChange.scope(db.session, item, item.order) for item in items])
+        commit()
+        return orders
+
+    @classmethod
+    def stream_with_items(cls, created_after: datetime = None, created_before: datetime = None,
+                          statuses: list = None, batch_size: int = 1000):
+        """Yields serialized Orders with their Items, holding one batch of rows at a time
+
+        Orders are read joined to their Items in id order over a server-side
+        cursor, so memory stays flat however many Orders match
+
+        :param created_after: only Orders created at or after this time
+        :type created_after: datetime
+        :param created_before: only Orders created before this time
+        :type created_before: datetime
+        :param statuses: only Orders with one of these statuses
+        :type statuses: list
+        :param batch_size: the number of rows fetched per round trip
+        :type batch_size: int
+
+        """
+        logger.info("Processing order export ...")
+        query = db.session.query(
+            cls.id, cls.customer_id, cls.tracking_id, cls.created_time, cls.status,
+            Item.id.label("item_id"), Item.product_id, Item.quantity, Item.price
+        ).outerjoin(Item, Item.order_id == cls.id)
+        query = cls.created_between(query, created_after, created_before)
+        if statuses:
+            query = query.filter(cls.status.in_(statuses))
+        rows = query.order_by(cls.id, Item.id).yield_per(batch_size)
+        for _, order_rows in groupby(rows, key=lambda row: row.id):
+            order_rows = list(order_rows)
+            first = order_rows[0]
+            yield {
+                "id": first.id,
+                "customer_id": first.customer_id,
+                "tracking_id": first.tracking_id,
+                "created_time": first.created_time,
+                "status": first.status.name,
+                "order_items": [
+                    {"id": row.item_id, "order_id": row.id, "product_id": row.product_id,
+                     "quantity": row.quantity, "price": row.price}
+                    for row in order_rows if row.item_id is not None
+                ]
+            }
+
+    @classmethod
+    def find_many(cls, ids: list):
+        """Returns the Orders with the given IDs
+
+        The Items of all the Orders are loaded together so the whole
+        lookup costs two queries however many IDs are asked for
+
+        :param ids: the ids of the orders you want to fetch
+        :type ids: list
+
+        :return: the Orders that exist, in no particular order
+        :rtype: list
+
+        """
+        logger.info("Processing lookup for ids %s ...", ids)
+        query = cls.query.filter(cls.id.in_(set(ids)))
+        return query.options(db.selectinload(cls.order_items)).all()
+
+    @classmethod
+    def created_between(cls, query, created_after: datetime = None,
+                        created_before: datetime = None):
+        """Narrows a query of Orders to those created from created_after until created_before
+
+        Times with a time zone are compared as local times, like the
+        times the Orders are stamped with
+
+        """
+        if created_after:
+            query = query.filter(cls.created_time >= local_time(created_after))
+        if created_before:
+            query = query.filter(cls.created_time < local_time(created_before))
+        return query
+
     @classmethod
     def find_by_customer(cls, customer_id: int):
         """Returns all Orders of the given customer ID
@@ -247,15 +653,281 @@ class Order(db.Model, PersistentBase):
         return cls.query.filter(cls.status == status)
 
     @classmethod
-    def find_by_item(cls, product_id: int):
-        """Returns all Orders with the given item product id
+    def find_by_item(cls, product_ids, after: int = 0,  # pylint: disable=too-many-arguments
+                     limit: int = None, created_after: datetime = None,
+                     created_before: datetime = None):
+        """Returns a page of the Orders with an item of any of the given product ids
+
+        The (product_id, order_id) index on item yields the ids of the
+        matching Orders of a product in order, so a page reads only the
+        index entries it returns rather than testing every Order for its
+        items. A page of several products reads at most a page of entries
+        per product, one bounded index scan each, and merges them
+
+        :param product_ids: the product id, or ids, of the items you want to match
+        :type product_ids: int or list
+        :param after: only Orders with an id greater than this are returned
+        :type after: int
+        :param limit: the maximum number of Orders to return
+        :type limit: int
+        :param created_after: only Orders created at or after this time
+        :type created_after: datetime
+        :param created_before: only Orders created before this time
+        :type created_before: datetime
+
+        :return: a collection of Orders with such an item, ordered by id
+        :rtype: list
+
+        """
+        product_ids = [product_ids] if isinstance(product_ids, int) else list(product_ids)
+        logger.info("Processing item query for %s after %s ...", product_ids, after)
+
+        def matching(ids: list):
+            order_ids = db.session.query(Item.order_id).filter(
+                Item.product_id.in_(ids), Item.order_id > (after or 0)
+            ).distinct().order_by(Item.order_id)
+            if created_after or created_before:
+                order_ids = cls.created_between(order_ids.join(cls, cls.id == Item.order_id),
+                                                created_after, created_before)
+            return order_ids if limit is None else order_ids.limit(limit)
+
+        if limit is None or len(product_ids) < 2:
+            order_ids = matching(product_ids).subquery()
+        else:
+            # An IN list would read and sort every match of every product before the limit
+            pages = [matching([product_id]).subquery() for product_id in product_ids]
+            merged = db.union_all(*[db.select([page.c.order_id]) for page in pages]).alias()
+            order_ids = db.session.query(merged.c.order_id).distinct() \
+                .order_by(merged.c.order_id).limit(limit).subquery()
+        return cls.query.join(order_ids, cls.id == order_ids.c.order_id).order_by(cls.id)
+
+
+######################################################################
+#  O R D E R   C H A N G E   M O D E L
+#  OrderChange: an outbox row for every change made to an Order or Item
+######################################################################
+
+
+class OrderChange(db.Model):
+    """
+    Class that represents a change to an Order
+
+    Rows are appended in the same transaction as the change itself and
+    their ids follow commit order, so the id is the cursor of the feed
+    """
+
+    __tablename__ = "order_change"
+
+    # Table Schema
+    id = db.Column(db.BigInteger, primary_key=True)
+    order_id = db.Column(db.Integer, nullable=False)
+    item_id = db.Column(db.Integer)
+    customer_id = db.Column(db.Integer)
+    action = db.Column(db.String(16), nullable=False)
+    status = db.Column(db.Enum(OrderStatus))
+    previous_status = db.Column(db.Enum(OrderStatus))
+    changed_time = db.Column(db.DateTime(), nullable=False, server_default=db.func.now())
+
+    def __repr__(self):
+        return f"<OrderChange {self.id}: {self.action} Order[{self.order_id}] Item[{self.item_id}]>"
+
+    def serialize(self):
+        """Serializes a change into a dictionary"""
+        return {
+            "id": self.id,
+            "order_id": self.order_id,
+            "item_id": self.item_id,
+            "customer_id": self.customer_id,
+            "action": self.action,
+            "status": self.status.name if self.status else None,
+            "previous_status": self.previous_status.name if self.previous_status else None,
+            "changed_time": self.changed_time
+        }
+
+    @classmethod
+    def find_since(cls, cursor: int = 0, limit: int = 100):
+        """Returns the changes after the given cursor in commit order
 
-        :param product_id: the product id of the item you want to match
-        :type name: int
+        :param cursor: the id of the last change already read
+        :type cursor: int
+        :param limit: the maximum number of changes to return
+        :type limit: int
 
-        :return: a collection of coders with that item inside
+        :return: a collection of OrderChanges
         :rtype: list
 
         """
-        logger.info("Processing item query for %s ...", product_id)
-        return cls.query.filter(cls.order_items.any(Item.product_id == product_id))
+        logger.info("Processing change feed query after %s ...", cursor)
+        return cls.query.filter(cls.id > cursor).order_by(cls.id).limit(limit).all()
+
+    @staticmethod
+    def to_event(change: dict):
+        """Turns an outbox row into a JSON friendly change event"""
+        event_ = dict(change)
+        for key in ["status", "previous_status"]:
+            event_[key] = change[key].name if change[key] else None
+        return event_
+
+    @staticmethod
+    def of(record, action: str):
+        """Describes the change of an Order or Item as an outbox row"""
+        if isinstance(record, Item):
+            return {"order_id": record.order_id, "item_id": record.id, "customer_id": None,
+                    "action": action, "status": None, "previous_status": None}
+        if not isinstance(record, Order):
+            return None
+        history = db.inspect(record).attrs.status.history
+        previous = history.deleted[0] if history.deleted else None
+        if previous == record.status:
+            previous = None
+        if action == "update" and previous and record.status == OrderStatus.CANCELLED:
+            action = "cancel"
+        return {"order_id": record.id, "item_id": None, "customer_id": record.customer_id,
+                "action": action, "status": record.status, "previous_status": previous}
+
+    @staticmethod
+    def scope(session, record, order=None):
+        """
+        Returns the list filters whose results a change to an Order or Item alters
+
+        The values from before and after the change both count. The Order
+        of an Item is looked up when it is not given
+        """
+        if isinstance(record, Item):
+            products = {record.product_id, *_previous(record, "product_id")}
+            order = order or _order_of(session, record.order_id)
+            customers = {order.customer_id} if order else set()
+            statuses = {order.status} if order else set()
+        elif isinstance(record, Order):
+            customers = {record.customer_id, *_previous(record, "customer_id")}
+            statuses = {record.status, *_previous(record, "status")}
+            if "order_items" not in db.inspect(record).unloaded:
+                products = {item.product_id for item in record.order_items}
+            else:
+                products = {row.product_id for row in session.execute(
+                    db.select([Item.product_id]).where(Item.order_id == record.id).distinct()
+                )}
+        else:
+            return None
+        return {
+            "customer_id": sorted(value for value in customers if value is not None),
+            "status": sorted(value.name for value in statuses if value is not None),
+            "product_id": sorted(value for value in products if value is not None),
+        }
+
+
+def _previous(record, name: str) -> list:
+    """Returns the value an attribute had before it was changed in this flush"""
+    return list(db.inspect(record).attrs[name].history.deleted)
+
+
+def _order_of(session, order_id: int):
+    """Returns the Order with the id in the session, or else its customer and status"""
+    order = session.identity_map.get(identity_key(Order, order_id))
+    if order is not None:
+        return order
+    return session.execute(
+        db.select([Order.customer_id, Order.status]).where(Order.id == order_id)
+    ).first()
+
+
+@event.listens_for(db.session, "after_flush")
+def record_changes(session, _flush_context):
+    """Appends an OrderChange for each Order and Item written by the flush"""
+    written = [(record, "create") for record in session.new]
+    written += [(record, "update") for record in session.dirty if session.is_modified(record)]
+    written += [(record, "delete") for record in session.deleted]
+    append_changes(session, [OrderChange.of(record, action) for record, action in written],
+                   [OrderChange.scope(session, record) for record, _ in written])
+
+
+def append_changes(session, changes: list, scopes: list = None):
+    """
+    Appends OrderChange rows in the session's transaction
+
+    The scope of each change, the list filters it alters, is added to the
+    events handed to the change listeners of this worker but not stored
+    """
+    pairs = [pair for pair in zip(changes, scopes or [None] * len(changes)) if pair[0] is not None]
+    changes = [change for change, _ in pairs]
+    if not changes:
+        return
+    if session.connection().dialect.name == "postgresql":
+        # Serialize the writers from here to commit so change ids are
+        # handed out in the order the transactions become visible. Without
+        # it a reader could pass the id of a change still being committed
+        # and never see it, as the cursor of the feed is a plain id. The
+        # lock is only held from the flush to the commit, which for a
+        # request is its last few statements, and group commit takes it
+        # once for many creates. Ordering by txid instead would make
+        # readers hold the cursor back behind the oldest open
+        # transaction, changing what the cursor means to clients
+        session.execute(db.text("SELECT pg_advisory_xact_lock(:key)"), {"key": OUTBOX_LOCK_KEY})
+    session.execute(OrderChange.__table__.insert(), changes)
+    events = [OrderChange.to_event(change) for change in changes]
+    session.info.setdefault("order_changes", []).extend(
+        dict(change, scope=scope) if scope is not None else change
+        for change, (_, scope) in zip(events, pairs)
+    )
+    if current_app.config.get("ORDER_EVENTS_NOTIFY"):
+        # Delivered to every worker LISTENing once, and only if, this transaction commits
+        for start in range(0, len(events), NOTIFY_BATCH):
+            session.execute(
+                db.text("SELECT pg_notify(:channel, :payload)"),
+                {"channel": NOTIFY_CHANNEL,
+                 "payload": json.dumps(events[start:start + NOTIFY_BATCH])}
+            )
+
+
+def append_load(session):
+    """
+    Appends a "load" change, telling readers of the feed Orders were written in bulk
+
+    Bulk loads write no change per Order, so the change names none, its
+    order_id is 0, and readers keeping copies of the Orders read them again
+    """
+    append_changes(session, [{"order_id": 0, "item_id": None, "customer_id": None,
+                              "action": "load", "status": None, "previous_status": None}])
+
+
+@event.listens_for(db.session, "after_commit")
+def publish_changes(session):
+    """Hands the changes of the committed transaction to the change listeners"""
+    if session.transaction is not None and session.transaction.nested:
+        # Releasing a savepoint commits nothing yet
+        return
+    events = session.info.pop("order_changes", [])
+    if not events:
+        return
+    for listener in change_listeners:
+        try:
+            listener(events)
+        except Exception as error:  # pylint: disable=broad-except
+            logger.error("Change listener %s failed: %s", listener, error)
+
+
+@event.listens_for(db.session, "after_rollback")
+def discard_changes(session):
+    """Forgets the changes of a transaction that was rolled back, savepoints forget their own"""
+    if session.transaction is not None and session.transaction.nested:
+        return
+    session.info.pop("order_changes", None)
+
+
+def _reset_id_allocators():
+    """Drops the id blocks inherited from the parent process"""
+    Order.ids.reset()
+    Item.ids.reset()
+
+
+# A forked worker must reserve id blocks of its own
+os.register_at_fork(after_in_child=_reset_id_allocators)
+
+
+# The models kept in modules of their own
+# pylint: disable=wrong-import-position,unused-import
+from service.archive import ArchivedOrder, ArchivedItem  # noqa: F401, E402
+from service.summary import (  # noqa: F401, E402
+    CustomerOrderSummary, SUMMARY_LOCK_KEY, SUMMARY_SLICES, order_totals, summarize_rows
+)
+from service.import_progress import ImportProgress  # noqa: F401, E402
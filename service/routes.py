@@ -6,6 +6,8 @@ index             GET      /
 
 list_orders     GET      /orders
 create_orders   POST     /orders
+lookup_orders   POST     /orders/lookup
+list_changes    GET      /orders/changes
 get_orders      GET      /orders/<int:order_id>
 update_orders   PUT      /orders/<int:order_id>
 delete_orders   DELETE   /orders/<int:order_id>
@@ -15,12 +17,28 @@ create_items  POST     /orders/<int:order_id>/items
 get_items     GET      /orders/<int:order_id>/items/<int:item_id>
 update_items  PUT      /orders/<int:order_id>/items/<int:item_id>
 delete_items  DELETE   /orders/<int:order_id>/items/<int:item_id>
+
+product_report    GET      /reports/products
+customer_report   GET      /reports/customers
+revenue_report    GET      /reports/revenue
+
+get_customer_summary   GET   /customers/<int:customer_id>/summary
+
+The event stream and batch paths are in event_routes and batch_routes
 """
+import os
 
-from flask import jsonify, make_response
-from flask_restx import Resource, fields, reqparse
-from service.models import Order, Item, OrderStatus
+from flask import jsonify, make_response, request
+from flask_restx import Resource, fields, reqparse, inputs
+from service.models import (
+    Order, Item, OrderStatus, OrderChange, CustomerOrderSummary, ArchivedOrder, connect_db
+)
 from .utils import status  # HTTP Status CodesS
+from .utils.group_commit import group_committer
+from .utils.admission import admission_controller, NESTED_KEY
+from .utils.singleflight import order_reads
+from .utils.compression import compression_stats
+from .utils.shared_cache import shared_cache, MAX_DEPENDENCIES
 
 # Import Flask application
 from . import app, api
@@ -35,6 +53,47 @@ def healthcheck():
     return make_response(jsonify(status=200, message="OK"), status.HTTP_200_OK)
 
 
+######################################################################
+# GET METRICS
+######################################################################
+@app.route("/metrics")
+def metrics():
+    """Returns the counters of this worker"""
+    return make_response(jsonify(
+        pid=os.getpid(),
+        coalescing=order_reads.stats(),
+        admission=admission_controller.stats(),
+        compression=compression_stats.stats(),
+        cache=shared_cache.stats(),
+    ), status.HTTP_200_OK)
+
+
+######################################################################
+# ADMISSION CONTROL
+######################################################################
+@app.before_request
+def admit_request():
+    """Turns requests away when this worker has too many in progress"""
+    admission_controller.admit(request)
+
+
+@app.teardown_request
+def release_request(error):  # pylint: disable=unused-argument
+    """Frees the slot of an admitted request"""
+    admission_controller.release(request)
+
+
+######################################################################
+# CONNECT TO THE DATABASE
+######################################################################
+@app.before_request
+def connect_database():
+    """Holds requests needing the database until this worker has reached it"""
+    if request.endpoint not in ("healthcheck", "metrics", "index", "static"):
+        connect_db(app.config.get("DB_CONNECT_RETRIES", 3),
+                   app.config.get("DB_CONNECT_BACKOFF", 0.5))
+
+
 ######################################################################
 # GET INDEX
 ######################################################################
@@ -84,15 +143,132 @@ order_model = api.inherit(
         'order_items': fields.List(fields.Nested(item_model),
                                    required=False,
                                    description='The Items of the order'),
+        'items_count': fields.Integer(readOnly=True,
+                                      description='The total number of Items of the order'),
     }
 )
 
+order_lookup_model = api.model('OrderLookup', {
+    'id': fields.Integer(description='The requested Order ID'),
+    'found': fields.Boolean(description='Whether an Order with the ID exists'),
+    'order': fields.Nested(order_model, allow_null=True,
+                           description='The Order, null when it was not found'),
+})
+
+order_ids_model = api.model('OrderIds', {
+    'ids': fields.List(fields.Integer, required=True,
+                       description='The IDs of the Orders to fetch'),
+})
+
+# The time buckets the revenue report can total by
+REPORT_BUCKETS = ['day', 'week', 'month']
+
+# The most Orders a single lookup may ask for
+MAX_LOOKUP_IDS = 1000
+
+# The most products Orders may be listed by at once
+MAX_PRODUCT_IDS = 100
+
+order_change_model = api.model('OrderChange', {
+    'id': fields.Integer(description='The cursor of the change'),
+    'order_id': fields.Integer(description='The ID of the changed Order'),
+    'item_id': fields.Integer(description='The ID of the changed Item, if an Item changed'),
+    'customer_id': fields.Integer(description='The Customer ID of the changed Order'),
+    'action': fields.String(enum=['create', 'update', 'cancel', 'delete', 'archive', 'load'],
+                            description='What was done to the Order or Item'),
+    'status': fields.String(enum=OrderStatus._member_names_,
+                            description='The Status of the Order after the change'),
+    'previous_status': fields.String(enum=OrderStatus._member_names_,
+                                     description='The Status before the change, if it changed'),
+    'changed_time': fields.DateTime(description='When the change was made'),
+})
+
+change_feed_model = api.model('OrderChangeFeed', {
+    'changes': fields.List(fields.Nested(order_change_model),
+                           description='The changes after the cursor, in commit order'),
+    'next': fields.Integer(description='The cursor to ask for the following changes'),
+})
+
+change_args = reqparse.RequestParser()
+change_args.add_argument('since', type=inputs.natural, required=False, default=0, location='args',
+                         help='Return the changes after this cursor')
+change_args.add_argument('limit', type=inputs.int_range(1, 1000), required=False, default=100,
+                         location='args', help='Maximum number of changes to return')
+
 # query string arguments
 order_args = reqparse.RequestParser()
+order_args.add_argument('ids', type=str, required=False,
+                        help='Fetch the Orders with these comma separated ids')
 order_args.add_argument('customer_id', type=int, required=False, help='List Orders by customer_id')
 order_args.add_argument('status', type=str, required=False, help='List Orders by status')
-order_args.add_argument('product_id', type=int, required=False,
-                        help='List Orders by Item\'s product_id')
+order_args.add_argument('product_id', type=int, action='append', required=False,
+                        help='List Orders with an Item of this product_id, may be repeated')
+order_args.add_argument('created_after', type=inputs.datetime_from_iso8601, required=False,
+                        help='List only Orders created at or after this time')
+order_args.add_argument('created_before', type=inputs.datetime_from_iso8601, required=False,
+                        help='List only Orders created before this time')
+order_args.add_argument('after', type=inputs.natural, required=False, default=0,
+                        help='Return only Orders with an id greater than this, with product_id')
+order_args.add_argument('limit', type=inputs.positive, required=False,
+                        help='Maximum number of Orders to return, with product_id')
+
+order_get_args = reqparse.RequestParser()
+order_get_args.add_argument('items_limit', type=inputs.natural, required=False, location='args',
+                            help='Embed only the first N Items of the Order')
+order_get_args.add_argument('wait_for', type=str, required=False, location='args',
+                            help='Hold the response until the Order reaches this status')
+order_get_args.add_argument('timeout', type=inputs.int_range(0, 60), required=False, default=30,
+                            location='args', help='Seconds to wait for the status at most')
+
+item_args = reqparse.RequestParser()
+item_args.add_argument('limit', type=inputs.positive, required=False, location='args',
+                       help='Maximum number of Items to return')
+item_args.add_argument('after', type=inputs.natural, required=False, default=0, location='args',
+                       help='Return only Items with an id greater than this')
+
+report_args = reqparse.RequestParser()
+report_args.add_argument('status', type=str, action='append', required=False, location='args',
+                         choices=OrderStatus._member_names_,
+                         help='Count only Orders with this status, may be repeated. '
+                              'All but CANCELLED by default')
+report_args.add_argument('created_after', type=inputs.datetime_from_iso8601, required=False,
+                         location='args', help='Count only Orders created at or after this time')
+report_args.add_argument('created_before', type=inputs.datetime_from_iso8601, required=False,
+                         location='args', help='Count only Orders created before this time')
+report_args.add_argument('top', type=inputs.positive, required=False, location='args',
+                         help='Return only this many rows, highest revenue first')
+
+revenue_args = report_args.copy()
+revenue_args.remove_argument('top')
+revenue_args.add_argument('bucket', type=str, required=False, default='day', location='args',
+                          choices=REPORT_BUCKETS, help='Total the revenue per day, week or month')
+
+report_totals_model = api.model('ReportTotals', {
+    'orders': fields.Integer(description='The number of Orders counted'),
+    'quantity': fields.Integer(description='The total quantity of their Items'),
+    'revenue': fields.Float(description='The total of quantity times price of their Items'),
+})
+
+product_report_model = api.inherit('ProductReport', report_totals_model, {
+    'product_id': fields.Integer(description='The Product ID of the Items'),
+})
+
+customer_report_model = api.inherit('CustomerReport', report_totals_model, {
+    'customer_id': fields.Integer(description='The Customer ID of the Orders'),
+})
+
+revenue_report_model = api.inherit('RevenueReport', report_totals_model, {
+    'period': fields.String(description='The first day of the day, week or month'),
+})
+
+customer_summary_model = api.model('CustomerSummary', {
+    'customer_id': fields.Integer(description='The Customer ID'),
+    'orders': fields.Integer(description='The number of Orders of the customer'),
+    'orders_by_status': fields.Raw(description='The number of Orders in each status'),
+    'spend': fields.Float(
+        description='The total of quantity times price of all but cancelled Orders'
+    ),
+})
 
 
 # ---------------------------------------------------------------------
@@ -117,21 +293,32 @@ class OrderResource(Resource):
     # ------------------------------------------------------------------
     @api.doc('get_orders')
     @api.response(404, 'Order not found')
+    @api.expect(order_get_args, validate=True)
     @api.marshal_with(order_model)
     def get(self, order_id):
         """
         Retrieve a single Order
 
-        This endpoint will return an Order based on it's id
+        This endpoint will return an Order based on it's id, looking in the
+        archive for Orders no longer in the order table. With wait_for
+        the response is held until the Order reaches that status or
+        timeout seconds pass, and then returns the Order as it is
         """
         app.logger.info("Request for Order with id: %s", order_id)
-        order = Order.find(order_id)
-        if not order:
+        args = order_get_args.parse_args()
+        if args["wait_for"]:
+            wanted = getattr(OrderStatus, args["wait_for"].upper(), None)
+            if not isinstance(wanted, OrderStatus):
+                abort(status.HTTP_400_BAD_REQUEST, f"Invalid status '{args['wait_for']}'.")
+            wait_for_status(order_id, wanted, args["timeout"])
+        key = ("order", order_id, args["items_limit"])
+        result = read_through(key, [f"order:{order_id}"], find_order, *key[1:])
+        if not result:
             abort(
                 status.HTTP_404_NOT_FOUND,
                 f"Order with id '{order_id}' could not be found.",
             )
-        return order.serialize(), status.HTTP_200_OK
+        return result, status.HTTP_200_OK
 
     # ------------------------------------------------------------------
     # UPDATE AN EXISTING ORDER
@@ -191,29 +378,33 @@ class OrderCollection(Resource):
     # ------------------------------------------------------------------
     @api.doc('list_orders')
     @api.expect(order_args, validate=True)
-    @api.marshal_list_with(order_model)
+    @api.response(200, 'Success', [order_model])
+    @api.response(400, 'The ids were not valid')
     def get(self):
-        """Returns all of the Orders"""
+        """
+        Returns all of the Orders
+
+        When ids are given the matching Orders are returned as lookup
+        results instead, in the order they were asked for. Orders listed
+        by product_id are returned in id order, and when a limit is given
+        the cursor for the next page is sent in X-Next-After
+        """
         app.logger.info("Request for order list")
-        orders = []
         args = order_args.parse_args()
-        if args["customer_id"]:
-            app.logger.info("Find by customer id: %s", args["customer_id"])
-            orders = Order.find_by_customer(args["customer_id"])
-        elif args["status"]:
-            app.logger.info("Find by status: %s", args["status"])
-            # create enum from string
-            orders = Order.find_by_status(args["status"].upper())
-        elif args["product_id"]:
-            app.logger.info("Find by items: %s", args["product_id"])
-            orders = Order.find_by_item(args["product_id"])
-        else:
-            app.logger.info("Find all")
-            orders = Order.all()
-
-        results = [order.serialize() for order in orders]
+        if args["ids"]:
+            app.logger.info("Find by ids: %s", args["ids"])
+            try:
+                ids = [int(order_id) for order_id in args["ids"].split(",")]
+            except ValueError:
+                abort(status.HTTP_400_BAD_REQUEST, f"Invalid Order ids '{args['ids']}'.")
+            return api.marshal(lookup_orders(ids), order_lookup_model), status.HTTP_200_OK
+        key, dependencies = list_query(args)
+        results = read_through(key, dependencies, list_orders, *key[1:])
+        headers = {}
+        if args["product_id"] and args["limit"] and len(results) == args["limit"]:
+            headers["X-Next-After"] = results[-1]["id"]
         app.logger.info("[%s] Orders returned", len(results))
-        return results, status.HTTP_200_OK
+        return results, status.HTTP_200_OK, headers
 
     # ------------------------------------------------------------------
     # ADD A NEW ORDER
@@ -231,10 +422,56 @@ class OrderCollection(Resource):
         order = Order()
         app.logger.debug('Payload = %s', api.payload)
         order.deserialize(api.payload)
-        order.create()
-        app.logger.info('Order with new id [%s] created!', order.id)
-        location_url = api.url_for(OrderResource, order_id=order.id, _external=True)
-        return order.serialize(), status.HTTP_201_CREATED, {"Location": location_url}
+        result = group_committer.run(create_order, order)
+        app.logger.info('Order with new id [%s] created!', result["id"])
+        location_url = api.url_for(OrderResource, order_id=result["id"], _external=True)
+        return result, status.HTTP_201_CREATED, {"Location": location_url}
+
+
+######################################################################
+#  PATH: /orders/lookup
+######################################################################
+@api.route('/orders/lookup', strict_slashes=False)
+class OrderLookup(Resource):
+    """ Fetches many Orders by id at once """
+    @api.doc('lookup_orders')
+    @api.response(400, 'The posted ids were not valid')
+    @api.expect(order_ids_model, validate=True)
+    @api.marshal_list_with(order_lookup_model)
+    def post(self):
+        """
+        Lookup Orders
+
+        This endpoint does the same as listing Orders by ids but takes
+        the ids in the body, for lists too long for a query string
+        """
+        app.logger.info("Request to lookup Orders")
+        return lookup_orders(api.payload["ids"]), status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /orders/changes
+######################################################################
+@api.route('/orders/changes', strict_slashes=False)
+class OrderChangeFeed(Resource):
+    """ Reads the feed of changes made to Orders """
+    @api.doc('list_changes')
+    @api.expect(change_args, validate=True)
+    @api.marshal_with(change_feed_model)
+    def get(self):
+        """
+        Returns the changes made to Orders
+
+        Changes are returned in commit order starting after the since
+        cursor. Pass back the next cursor to read only newer changes
+        """
+        args = change_args.parse_args()
+        app.logger.info("Request for Order changes since %s", args["since"])
+        changes = OrderChange.find_since(args["since"], args["limit"])
+        changes = [change.serialize() for change in changes]
+        cursor = changes[-1]["id"] if changes else args["since"]
+        app.logger.info("[%s] Order changes returned", len(changes))
+        return {"changes": changes, "next": cursor}, status.HTTP_200_OK
 
 
 ######################################################################
@@ -377,10 +614,18 @@ class ItemCollection(Resource):
     # ------------------------------------------------------------------
     @api.doc('list_items')
     @api.response(404, 'Order not found')
+    @api.expect(item_args, validate=True)
     @api.marshal_list_with(item_model)
     def get(self, order_id):
-        """Returns all of the Items for an order"""
+        """
+        Returns the Items for an order
+
+        Items are returned in id order. When a limit is given the response
+        carries the total in X-Total-Count and, if more Items remain, the
+        cursor for the next page in X-Next-After
+        """
         app.logger.info("Request for all Items for Order with id: %s", order_id)
+        args = item_args.parse_args()
         order = Order.find(order_id)
         if not order:
             abort(
@@ -388,9 +633,15 @@ class ItemCollection(Resource):
                 f"Order with id '{order_id}' could not be found.",
             )
 
-        results = [item.serialize() for item in order.order_items]
+        items = Item.find_by_order(order_id, args["after"], args["limit"])
+        results = [item.serialize() for item in items]
+        headers = {}
+        if args["limit"]:
+            headers["X-Total-Count"] = Item.count_by_order(order_id)
+            if len(results) == args["limit"]:
+                headers["X-Next-After"] = results[-1]["id"]
         app.logger.info("[%s] Items returned", len(results))
-        return results, status.HTTP_200_OK
+        return results, status.HTTP_200_OK, headers
 
     # ------------------------------------------------------------------
     # ADD AN ITEM TO AN ORDER
@@ -406,19 +657,10 @@ class ItemCollection(Resource):
         This endpoint will add an item to an order
         """
         app.logger.info("Request to create an Item for Order with id: %s", order_id)
-        order = Order.find(order_id)
-        if not order:
-            abort(
-                status.HTTP_404_NOT_FOUND,
-                f"Order with id '{order_id}' could not be found.",
-            )
-
         item = Item()
         app.logger.debug('Payload = %s', api.payload)
         item.deserialize(api.payload)
-        order.order_items.append(item)
-        order.update()
-        return item.serialize(), status.HTTP_201_CREATED
+        return group_committer.run(add_item, order_id, item), status.HTTP_201_CREATED
 
 
 ######################################################################
@@ -443,10 +685,223 @@ class AllItemCollection(Resource):
         return results, status.HTTP_200_OK
 
 
+######################################################################
+#  PATH: /reports/products
+######################################################################
+@api.route('/reports/products', strict_slashes=False)
+class ProductReport(Resource):
+    """ Revenue per product """
+    @api.doc('product_report')
+    @api.expect(report_args, validate=True)
+    @api.marshal_list_with(product_report_model)
+    def get(self):
+        """Returns the Orders, quantity and revenue of each product, highest revenue first"""
+        args = report_args.parse_args()
+        app.logger.info("Request for the product report")
+        return revenue_report("product_id", args), status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /reports/customers
+######################################################################
+@api.route('/reports/customers', strict_slashes=False)
+class CustomerReport(Resource):
+    """ Revenue per customer """
+    @api.doc('customer_report')
+    @api.expect(report_args, validate=True)
+    @api.marshal_list_with(customer_report_model)
+    def get(self):
+        """Returns the Orders, quantity and revenue of each customer, highest revenue first"""
+        args = report_args.parse_args()
+        app.logger.info("Request for the customer report")
+        return revenue_report("customer_id", args), status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /reports/revenue
+######################################################################
+@api.route('/reports/revenue', strict_slashes=False)
+class RevenueReport(Resource):
+    """ Revenue over time """
+    @api.doc('revenue_report')
+    @api.expect(revenue_args, validate=True)
+    @api.marshal_list_with(revenue_report_model)
+    def get(self):
+        """Returns the Orders, quantity and revenue of each day, week or month, oldest first"""
+        args = revenue_args.parse_args()
+        app.logger.info("Request for the %s revenue report", args["bucket"])
+        return revenue_report("period", args), status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /customers/{customer_id}/summary
+######################################################################
+@api.route('/customers/<int:customer_id>/summary')
+@api.param('customer_id', 'The Customer identifier')
+class CustomerSummaryResource(Resource):
+    """ The Orders and spend of a customer """
+    @api.doc('get_customer_summary')
+    @api.marshal_with(customer_summary_model)
+    def get(self, customer_id):
+        """
+        Returns the number of Orders of a customer in each status and their lifetime spend
+
+        The counts are kept up to date as Orders are written, so they are
+        read without going through the customer's Orders
+        """
+        app.logger.info("Request for the summary of customer %s", customer_id)
+        return CustomerOrderSummary.find_by_customer(customer_id), status.HTTP_200_OK
+
+
 ######################################################################
 #  U T I L I T Y   F U N C T I O N S
 ######################################################################
+
+
+def read_through(key: tuple, dependencies: list, work, *args):
+    """
+    Answers a read from the shared cache, or else with work(*args)
+
+    The work is shared with the identical reads in progress and its result
+    cached until a counter in dependencies is bumped by a write. The calls
+    of a batch skip both, as they may read their own uncommitted writes
+    """
+    if request.environ.get(NESTED_KEY):
+        return work(*args)
+    cache_key = ":".join(str(part) for part in key)
+    result = shared_cache.get(cache_key)
+    if result is not None:
+        return result
+
+    def fetch():
+        generations = shared_cache.generations(dependencies)
+        result = work(*args)
+        shared_cache.put(cache_key, result, dependencies, generations)
+        return result
+    return order_reads.do(key, fetch)
+
+
+def find_order(order_id: int, items_limit: int = None):
+    """Returns an Order serialized and marshalled, from the archive if it was moved there"""
+    order = Order.find(order_id) or ArchivedOrder.find(order_id)
+    return api.marshal(order.serialize(items_limit), order_model) if order else None
+
+
+def list_query(args: dict) -> tuple:
+    """
+    Returns the cache key of a list of Orders and the counters it depends on
+
+    The key holds only the filters list_orders uses, so requests naming
+    other filters besides share it. A filtered list depends on the counter
+    of its customer, status or products, moved only by the Orders it may
+    hold, and on "lists", moved by writes whose filters are not known. A
+    list of more products than an entry can depend on depends on "orders"
+    """
+    customer_id = args["customer_id"] or None
+    status_name = (args["status"] or "").upper() or None
+    product_ids = tuple(sorted(set(args["product_id"] or [])))
+    if len(product_ids) > MAX_PRODUCT_IDS:
+        abort(status.HTTP_400_BAD_REQUEST,
+              f"Cannot list Orders by more than {MAX_PRODUCT_IDS} products.")
+    window = (args["created_after"], args["created_before"])
+    if customer_id:
+        key = ("orders", customer_id, None, (), None, window)
+        return key, [f"customer_id:{customer_id}", "lists"]
+    if status_name:
+        return ("orders", None, status_name, (), None, window), [f"status:{status_name}", "lists"]
+    if product_ids:
+        key = ("orders", None, None, product_ids, (args["after"] or 0, args["limit"]), window)
+        if len(product_ids) >= MAX_DEPENDENCIES:
+            return key, ["orders"]
+        return key, [f"product_id:{product_id}" for product_id in product_ids] + ["lists"]
+    return ("orders", None, None, (), None, window), ["orders"]
+
+
+def list_orders(customer_id: int = None, status_name: str = None, product_ids: tuple = (),
+                page: tuple = None, window: tuple = (None, None)):
+    """
+    Returns the Orders matching the first filter given, serialized and marshalled
+
+    :param page: the id the Orders found by product follow and the most to return
+    :param window: the times the Orders were created at or after and before
+    """
+    if customer_id:
+        app.logger.info("Find by customer id: %s", customer_id)
+        orders = Order.find_by_customer(customer_id)
+    elif status_name:
+        app.logger.info("Find by status: %s", status_name)
+        orders = Order.find_by_status(status_name)
+    elif product_ids:
+        app.logger.info("Find by items: %s", product_ids)
+        orders = Order.find_by_item(product_ids, *(page or (0, None)), *window)
+    else:
+        app.logger.info("Find all")
+        orders = Order.query
+    if not product_ids:
+        orders = Order.created_between(orders, *window)
+    return api.marshal([order.serialize() for order in orders], order_model)
+
+
+def create_order(order: Order):
+    """Creates an Order and returns it serialized"""
+    order.create()
+    return order.serialize()
+
+
+def add_item(order_id: int, item: Item):
+    """Adds an Item to an Order and returns it serialized"""
+    order = Order.find(order_id)
+    if not order:
+        abort(
+            status.HTTP_404_NOT_FOUND,
+            f"Order with id '{order_id}' could not be found.",
+        )
+    order.order_items.append(item)
+    order.update()
+    return item.serialize()
+
+
+def lookup_orders(ids: list):
+    """Fetches the Orders with the given ids as lookup results in request order"""
+    if len(ids) > MAX_LOOKUP_IDS:
+        abort(
+            status.HTTP_400_BAD_REQUEST,
+            f"Cannot lookup more than {MAX_LOOKUP_IDS} Orders at once."
+        )
+    orders = {order.id: order.serialize() for order in Order.find_many(ids)}
+    app.logger.info("[%s] of [%s] Orders found", len(orders), len(ids))
+    return [
+        {"id": order_id, "found": order_id in orders, "order": orders.get(order_id)}
+        for order_id in ids
+    ]
+
+
+def revenue_report(key: str, args: dict):
+    """Answers a report from the analytics snapshot, refreshed once ANALYTICS_MAX_AGE_SECONDS old"""
+    # NumPy is loaded by the first report instead of by every worker at startup
+    from .utils import analytics  # pylint: disable=import-outside-toplevel
+    items = analytics.snapshot.refresh_if_older(app.config.get("ANALYTICS_MAX_AGE_SECONDS", 30))
+    if key == "period":
+        totals = items.revenue_by_period(args["bucket"], **report_filters(args))
+        return analytics.report(totals, key, ranked=False)
+    return analytics.report(items.revenue_by(key, **report_filters(args)), key, args["top"])
+
+
+def report_filters(args: dict):
+    """Turns the query arguments of a report into snapshot filters"""
+    return {
+        "statuses": [OrderStatus[name] for name in args["status"] or []],
+        "created_after": args["created_after"],
+        "created_before": args["created_before"],
+    }
+
+
 def abort(error_code: int, message: str):
     """Logs errors before aborting"""
     app.logger.error(message)
     api.abort(error_code, message)
+
+
+# The wait and event stream endpoints need abort() from this module
+# pylint: disable=wrong-import-position
+from .event_routes import wait_for_status  # noqa: E402
@@ -34,6 +34,22 @@ $(function () {
         $("#flash_message").val(message);
     }
 
+    // Keeps the status field in step with the retrieved order
+    var status_events = null;
+
+    function watch_order_status(order_id) {
+        if (status_events) {
+            status_events.close();
+        }
+        status_events = new EventSource(`/api/orders/events?order_id=${order_id}`);
+        status_events.addEventListener("status", function (e) {
+            var change = JSON.parse(e.data);
+            if (change.order_id == $("#order_id").val()) {
+                $("#status").val(change.status);
+            }
+        });
+    }
+
     // ****************************************
     // Create an Order
     // ****************************************
@@ -127,6 +143,7 @@ $(function () {
         ajax.done(function (res) {
             //alert(res.toSource())
             update_form_data(res)
+            watch_order_status(res.id)
             flash_message("Success")
         });
 
@@ -0,0 +1,199 @@
+"""
+Models for the customer Order summary
+
+The Orders and spend of each customer per status, kept up to date with
+every write to an Order or its Items
+"""
+import logging
+from sqlalchemy import event
+from sqlalchemy.dialects import postgresql
+from service.models import db, Order, Item, OrderStatus, _previous
+from service.archive import ArchivedOrder, ArchivedItem
+
+logger = logging.getLogger("flask.app")
+
+# Postgres advisory lock key, taken per part of the customers by summary writers and rebuilds
+SUMMARY_LOCK_KEY = 0x73756d6d
+
+# Parts the customers are split into by the summary rebuild, customer_id modulo this
+SUMMARY_SLICES = 64
+
+
+class CustomerOrderSummary(db.Model):
+    """
+    Class that represents the Orders of a customer in one status
+
+    Rows are kept up to date in the same transaction as every write to an
+    Order or its Items, so a customer's counts and spend are read from at
+    most one row per status. Archived Orders stay counted. Writes bypassing
+    the session, such as bulk deletes and restored snapshots, need a rebuild()
+    """
+
+    __tablename__ = "customer_order_summary"
+
+    # Table Schema
+    customer_id = db.Column(db.Integer, primary_key=True)
+    status = db.Column(db.Enum(OrderStatus), primary_key=True)
+    orders = db.Column(db.Integer, nullable=False, default=0)
+    spend = db.Column(db.Float, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"<CustomerOrderSummary {self.customer_id} {self.status}: {self.orders} orders>"
+
+    @classmethod
+    def find_by_customer(cls, customer_id: int):
+        """Returns the summary of a customer's Orders
+
+        :param customer_id: the id of the customer
+        :type customer_id: int
+
+        :return: the customer's Orders per status, in total and the spend on all but cancelled ones
+        :rtype: dict
+
+        """
+        logger.info("Processing summary query for customer %s ...", customer_id)
+        rows = cls.query.filter(cls.customer_id == customer_id).all()
+        by_status = {status.name: 0 for status in OrderStatus}
+        by_status.update({row.status.name: row.orders for row in rows})
+        spend = sum(row.spend for row in rows if row.status != OrderStatus.CANCELLED)
+        return {
+            "customer_id": customer_id,
+            "orders": sum(by_status.values()),
+            "orders_by_status": by_status,
+            "spend": round(spend, 2),
+        }
+
+    @classmethod
+    def apply(cls, session, deltas: dict):
+        """
+        Adds the Orders and spend of deltas to the summary in the session's transaction
+
+        :param deltas: (orders, spend) to add under each (customer_id, status)
+        """
+        rows = [{"customer_id": customer_id, "status": status, "orders": orders, "spend": spend}
+                for (customer_id, status), (orders, spend)
+                in sorted(deltas.items(), key=_summary_order) if orders or spend]
+        if not rows:
+            return
+        connection = session.connection()
+        if connection.dialect.name != "postgresql":
+            for row in rows:
+                updated = connection.execute(cls.__table__.update().where(
+                    (cls.customer_id == row["customer_id"]) & (cls.status == row["status"])
+                ).values(orders=cls.orders + row["orders"], spend=cls.spend + row["spend"]))
+                if not updated.rowcount:
+                    connection.execute(cls.__table__.insert(), row)
+            return
+        # Wait for any rebuild of these customers, which sees this transaction's writes
+        # only once it commits, and keep rebuilds out until then
+        for bucket in sorted({row["customer_id"] % SUMMARY_SLICES for row in rows}):
+            session.execute(db.text("SELECT pg_advisory_xact_lock_shared(:key, :bucket)"),
+                            {"key": SUMMARY_LOCK_KEY, "bucket": bucket})
+        upsert = postgresql.insert(cls.__table__)
+        session.execute(upsert.on_conflict_do_update(
+            index_elements=[cls.customer_id, cls.status],
+            set_={"orders": cls.orders + upsert.excluded.orders,
+                  "spend": cls.spend + upsert.excluded.spend}
+        ), rows)
+
+    @classmethod
+    def rebuild(cls, part: int):
+        """
+        Recomputes the summary of the customers in one of SUMMARY_SLICES parts
+
+        Writers of those customers are held back until the transaction
+        commits, so the part is exact however many writes go on meanwhile
+
+        :return: the number of summary rows written
+        """
+        logger.info("Rebuilding customer summary part %s ...", part)
+        session = db.session
+        if session.connection().dialect.name == "postgresql":
+            session.execute(db.text("SELECT pg_advisory_xact_lock(:key, :bucket)"),
+                            {"key": SUMMARY_LOCK_KEY, "bucket": part})
+        session.execute(cls.__table__.delete().where(cls.customer_id % SUMMARY_SLICES == part))
+        # Live and archived Orders are read by one statement, which sees an Order being
+        # archived meanwhile in exactly one of the two
+        totals = db.union_all(*[
+            db.select([order.customer_id, order.status, _order_spend(order, item).label("spend")])
+            .where(order.customer_id % SUMMARY_SLICES == part)
+            for order, item in ((Order, Item), (ArchivedOrder, ArchivedItem))
+        ]).alias()
+        summary = db.select([totals.c.customer_id, totals.c.status, db.func.count(),
+                             db.func.sum(totals.c.spend)]) \
+            .group_by(totals.c.customer_id, totals.c.status)
+        return session.execute(cls.__table__.insert().from_select(
+            ["customer_id", "status", "orders", "spend"], summary
+        )).rowcount
+
+
+def _summary_order(delta: tuple):
+    """Sorts summary rows the same way in every transaction so their row locks cannot deadlock"""
+    (customer_id, status), _ = delta
+    return customer_id, status.value
+
+
+def _order_spend(order=Order, item=Item):
+    """Returns the total of quantity times price of an Order's Items as a scalar subquery"""
+    return db.select([db.func.coalesce(db.func.sum(item.quantity * item.price), 0.0)]) \
+        .where(item.order_id == order.id).as_scalar()
+
+
+def order_totals(session, order_ids: set, lock: bool = False) -> dict:
+    """Returns the customer, status and spend of each existing Order, locking their rows if asked"""
+    if not order_ids:
+        return {}
+    query = db.select([Order.id, Order.customer_id, Order.status, _order_spend()]) \
+        .where(Order.id.in_(order_ids))
+    if lock:
+        query = query.with_for_update(of=Order.__table__)
+    return {row[0]: tuple(row[1:]) for row in session.execute(query)}
+
+
+def summarize_rows(order_rows: list, item_rows: list) -> dict:
+    """Returns the summary deltas of loading new Order and Item rows"""
+    spend = {}
+    for row in item_rows:
+        spend[row["order_id"]] = spend.get(row["order_id"], 0.0) + row["quantity"] * row["price"]
+    deltas = {}
+    for row in order_rows:
+        status = row["status"] or OrderStatus.PLACED
+        key = (row["customer_id"], OrderStatus[status] if isinstance(status, str) else status)
+        orders, total = deltas.get(key, (0, 0.0))
+        deltas[key] = (orders + 1, total + spend.get(row["id"], 0.0))
+    return deltas
+
+
+def _touched_orders(session) -> set:
+    """Returns the ids of the Orders the pending writes of the session change"""
+    order_ids = set()
+    for record in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(record, Order):
+            order_ids.add(record.id)
+        elif isinstance(record, Item):
+            # The Order an Item was appended to, which holds its id until the flush sets order_id
+            parent = None if "order" in db.inspect(record).unloaded else record.order
+            order_ids.update([record.order_id, parent.id if parent else None,
+                              *_previous(record, "order_id")])
+    order_ids.discard(None)
+    return order_ids
+
+
+@event.listens_for(db.session, "before_flush")
+def read_summary_before(session, _flush_context, _instances):
+    """Locks the Orders the flush changes and keeps their totals from before it"""
+    order_ids = _touched_orders(session)
+    session.info["summary_before"] = order_totals(session, order_ids, lock=True), order_ids
+
+
+@event.listens_for(db.session, "after_flush")
+def update_summary(session, _flush_context):
+    """Moves the Orders the flush changed in the customer summary"""
+    before, order_ids = session.info.pop("summary_before", ({}, set()))
+    after = order_totals(session, order_ids | _touched_orders(session))
+    deltas = {}
+    for totals, sign in ((before, -1), (after, 1)):
+        for customer_id, status, spend in totals.values():
+            orders, total = deltas.get((customer_id, status), (0, 0.0))
+            deltas[(customer_id, status)] = (orders + sign, total + sign * spend)
+    CustomerOrderSummary.apply(session, deltas)
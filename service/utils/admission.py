@@ -0,0 +1,244 @@
+"""
+Admission Control
+
+This module bounds the requests a worker works on at once so a slow
+database cannot pile them up until gunicorn kills the worker. Reads and
+writes each have a number of slots. A request waits a short while for
+a slot and is otherwise turned away with a 503, so the requests that are
+admitted keep their latency. Each client may also be limited to a rate
+of requests by a token bucket, and is answered with a 429 beyond it
+"""
+import math
+import time
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# Methods that only read, every other method is a write
+READ_METHODS = {"GET", "HEAD", "OPTIONS"}
+
+# Endpoints that only read although they are posted to
+READ_ENDPOINTS = {"order_lookup"}
+
+# Endpoints that never take a slot: they do not use the database or park
+# for a long time without a connection
+EXEMPT_ENDPOINTS = {
+    "healthcheck", "metrics", "index", "static", "doc", "root", "specs", "order_event_stream"
+}
+
+# Where an admitted request keeps its slot
+ENVIRON_KEY = "orders.admission"
+
+# Set on the requests a batch makes, which run inside its slot
+NESTED_KEY = "orders.nested"
+
+
+class RequestShedError(Exception):
+    """Raised when a request is turned away, with the seconds to wait before retrying"""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class OverloadedError(RequestShedError):
+    """Raised when no slot became free in time"""
+
+
+class RateLimitedError(RequestShedError):
+    """Raised when a client sends more requests than its rate allows"""
+
+
+class AdmissionGate:  # pylint: disable=too-many-instance-attributes
+    """A number of slots that requests wait for a short while at most"""
+
+    def __init__(self, name: str, slots: int, max_waiting: int):
+        self.name = name
+        self.slots = slots
+        self.max_waiting = max_waiting
+        self._slots = threading.BoundedSemaphore(slots)
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.shed = 0
+
+    def acquire(self, timeout: float) -> bool:
+        """Takes a slot, waiting up to timeout seconds, unless too many requests already wait"""
+        if self._slots.acquire(blocking=False):  # pylint: disable=consider-using-with
+            return self._admit()
+        with self._lock:
+            if self.waiting >= self.max_waiting:
+                self.shed += 1
+                return False
+            self.waiting += 1
+        try:
+            acquired = self._slots.acquire(timeout=timeout)  # pylint: disable=consider-using-with
+        finally:
+            with self._lock:
+                self.waiting -= 1
+        if acquired:
+            return self._admit()
+        with self._lock:
+            self.shed += 1
+        return False
+
+    def _admit(self) -> bool:
+        with self._lock:
+            self.in_flight += 1
+            self.admitted += 1
+        return True
+
+    def release(self):
+        """Gives a slot back"""
+        with self._lock:
+            self.in_flight -= 1
+        self._slots.release()
+
+    def stats(self) -> dict:
+        """Returns the counters of the gate"""
+        with self._lock:
+            return {
+                "slots": self.slots, "in_flight": self.in_flight, "waiting": self.waiting,
+                "admitted": self.admitted, "shed": self.shed,
+            }
+
+
+class TokenBucket:
+    """Allows bursts of up to burst requests refilled at rate requests a second"""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def take(self) -> float:
+        """Takes a token and returns 0, or returns the seconds until one is available"""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """A token bucket for each of the most recently seen clients"""
+
+    def __init__(self, rate: float, burst: int, max_clients: int = 10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self.limited = 0
+
+    def take(self, client: str) -> float:
+        """Takes a token of the client and returns 0, or the seconds until one is available"""
+        with self._lock:
+            bucket = self._buckets.pop(client, None) or TokenBucket(self.rate, self.burst)
+            self._buckets[client] = bucket
+            if len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+            wait = bucket.take()
+            if wait:
+                self.limited += 1
+            return wait
+
+
+class AdmissionController:
+    """Admits the requests of this worker through the gate of reads or of writes"""
+
+    def __init__(self):
+        self.app = None
+        self.gates = {}
+        self.limiter = None
+
+    def configure(self, app):
+        """Sizes the gates and the rate limit from the settings of the app"""
+        self.app = app
+        max_waiting = app.config.get("ADMISSION_MAX_WAITING", 16)
+        self.gates = {
+            "read": AdmissionGate("read", app.config.get("ADMISSION_MAX_READS", 8), max_waiting),
+            "write": AdmissionGate("write", app.config.get("ADMISSION_MAX_WRITES", 4), max_waiting),
+        }
+        rate = app.config.get("RATE_LIMIT_PER_SECOND", 0)
+        self.limiter = RateLimiter(rate, app.config.get("RATE_LIMIT_BURST", 20)) if rate else None
+
+    @property
+    def enabled(self):
+        """True when requests go through admission control"""
+        return bool(self.app and self.app.config.get("ADMISSION_ENABLED"))
+
+    def admit(self, request):
+        """
+        Takes a slot for the request or raises why it was turned away
+
+        Requests to exempt endpoints and requests made inside an admitted
+        request are let through
+        """
+        if not self.enabled or request.endpoint in EXEMPT_ENDPOINTS:
+            return
+        if request.environ.get(NESTED_KEY):
+            return
+        if self.limiter:
+            wait = self.limiter.take(client_address(request))
+            if wait:
+                raise RateLimitedError("Too many requests, slow down.", math.ceil(wait))
+        reads = request.method in READ_METHODS or request.endpoint in READ_ENDPOINTS
+        self._acquire(request, self.gates["read" if reads else "write"])
+
+    def _acquire(self, request, gate: AdmissionGate):
+        if not gate.acquire(self.app.config.get("ADMISSION_QUEUE_TIMEOUT_MS", 250) / 1000):
+            raise OverloadedError(
+                f"Too many {gate.name} requests in progress, try again later.",
+                self.app.config.get("ADMISSION_RETRY_AFTER", 1)
+            )
+        request.environ[ENVIRON_KEY] = gate
+
+    @contextmanager
+    def parked(self, request):
+        """
+        Gives the slot of the request back while it is parked
+
+        The slot is taken again when the request resumes, raising an
+        OverloadedError when none becomes free in time
+        """
+        gate = request.environ.pop(ENVIRON_KEY, None)
+        if not gate:
+            yield
+            return
+        gate.release()
+        try:
+            yield
+        finally:
+            self._acquire(request, gate)
+
+    @staticmethod
+    def release(request):
+        """Gives back the slot of an admitted request"""
+        gate = request.environ.pop(ENVIRON_KEY, None)
+        if gate:
+            gate.release()
+
+    def stats(self) -> dict:
+        """Returns the counters of every gate and of the rate limit"""
+        stats = {name: gate.stats() for name, gate in self.gates.items()}
+        stats["rate_limited"] = self.limiter.limited if self.limiter else 0
+        return stats
+
+
+def client_address(request) -> str:
+    """Returns the address of the client, as set by ProxyFix behind the trusted proxies"""
+    return request.remote_addr or ""
+
+
+# The admission controller of this worker
+admission_controller = AdmissionController()
+
+
+def init_admission(app):
+    """Reads the admission control settings of the app"""
+    admission_controller.configure(app)
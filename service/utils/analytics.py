@@ -0,0 +1,273 @@
+"""
+Item Analytics
+
+This module keeps a columnar snapshot of every Item, together with the
+customer, status and creation time of its Order, in NumPy arrays and
+answers revenue reports over it with vectorized group-bys instead of
+iterating over models.
+
+The snapshot refreshes incrementally. Items with an id above the
+watermark are appended, and the Orders named in the change feed since
+the last refresh are reloaded, which also catches status changes,
+deletes and Items committed out of id order. A load change, appended
+by the bulk loads that record no change per Order, makes the refresh
+read everything again. Archived Orders are read from the archive tables
+alongside, so reports keep counting them. Orders removed with bulk
+deletes bypass the change feed and need a reset()
+"""
+import io
+import time
+import threading
+from itertools import islice
+import numpy as np
+from service.models import (
+    db, Order, Item, OrderChange, OrderStatus, ArchivedOrder, ArchivedItem, local_time
+)
+
+# The tables Items are read from, live ones first
+SOURCES = [(Item, Order), (ArchivedItem, ArchivedOrder)]
+
+# The columns of the snapshot and their types
+COLUMNS = {
+    "item_id": np.int64,
+    "order_id": np.int64,
+    "customer_id": np.int64,
+    "product_id": np.int64,
+    "quantity": np.int64,
+    "price": np.float64,
+    "status": np.int8,
+    "created_time": "datetime64[us]",
+}
+
+# Statuses counted as revenue unless others are asked for
+REVENUE_STATUSES = [status for status in OrderStatus if status != OrderStatus.CANCELLED]
+
+# Time buckets of the revenue report and the NumPy unit they truncate to
+BUCKETS = {"day": "D", "week": "W", "month": "M"}
+
+# The integer NumPy reads as a missing time
+NAT = np.iinfo(np.int64).min
+
+# 1970-01-01 was a Thursday, weeks are shifted by this many days to start on Monday
+WEEK_OFFSET_DAYS = 3
+
+
+def empty_columns():
+    """Returns a snapshot without any rows"""
+    return {name: np.empty(0, dtype=dtype) for name, dtype in COLUMNS.items()}
+
+
+def to_columns(rows: list):
+    """Turns rows holding the values of COLUMNS, in order, into arrays"""
+    if not rows:
+        return empty_columns()
+    values = list(zip(*rows))
+    values[6] = [status.value for status in values[6]]
+    return {name: np.array(column, dtype=dtype)
+            for (name, dtype), column in zip(COLUMNS.items(), values)}
+
+
+def to_datetime64(value):
+    """Turns a datetime into a NumPy time comparable with the naive local times of Orders"""
+    return np.datetime64(local_time(value), "us")
+
+
+def copy_columns(connection, item, order, *criteria):
+    """
+    Reads the Items of a table matching the criteria into arrays with COPY
+
+    Statuses and times are turned into numbers by Postgres, so NumPy
+    parses the whole result at once without building a Python object
+    per row
+    """
+    status = db.case({status.name: status.value for status in OrderStatus},
+                     value=db.cast(order.status, db.String))
+    created = db.func.coalesce(
+        db.cast(db.extract("epoch", order.created_time) * 1000000, db.BigInteger), NAT
+    )
+    query = db.session.query(
+        item.id, item.order_id, order.customer_id, item.product_id, item.quantity, item.price,
+        status, created
+    ).join(order, item.order_id == order.id).filter(*criteria)
+    sql = query.statement.compile(dialect=connection.dialect,
+                                  compile_kwargs={"literal_binds": True})
+    buffer = io.StringIO()
+    with connection.connection.cursor() as cursor:
+        cursor.copy_expert(f"COPY ({sql}) TO STDOUT WITH (FORMAT csv)", buffer)
+    if not buffer.tell():
+        return empty_columns()
+    buffer.seek(0)
+    rows = np.loadtxt(buffer, delimiter=",", ndmin=1, dtype=[
+        (name, np.int64 if name == "created_time" else dtype) for name, dtype in COLUMNS.items()
+    ])
+    columns = {name: np.ascontiguousarray(rows[name]) for name in COLUMNS}
+    columns["created_time"] = columns["created_time"].view(COLUMNS["created_time"])
+    return columns
+
+
+def concatenate(*parts):
+    """Joins snapshots column by column"""
+    return {name: np.concatenate([part[name] for part in parts]) for name in COLUMNS}
+
+
+class ItemSnapshot:
+    """The Items of every Order as NumPy columns"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.columns = empty_columns()
+        self.item_watermark = 0
+        self.change_watermark = None
+        self.refreshed = None
+
+    def __len__(self):
+        return len(self.columns["item_id"])
+
+    def reset(self):
+        """Drops the snapshot so the next refresh loads everything again"""
+        with self._lock:
+            self.columns = empty_columns()
+            self.item_watermark = 0
+            self.change_watermark = None
+            self.refreshed = None
+
+    def refresh(self, batch_size: int = 10000):
+        """
+        Brings the snapshot up to date with the database
+
+        :return: the number of rows read from the database
+        """
+        with self._lock:
+            columns, item_watermark = self.columns, self.item_watermark
+            if self.change_watermark is None:
+                touched = set()
+                latest = db.session.query(db.func.max(OrderChange.id)).scalar() or 0
+            else:
+                changes = db.session.query(
+                    OrderChange.id, OrderChange.order_id, OrderChange.action
+                ).filter(OrderChange.id > self.change_watermark).all()
+                touched = {change.order_id for change in changes}
+                latest = max([change.id for change in changes], default=self.change_watermark)
+                if any(change.action == "load" for change in changes):
+                    # Bulk loaded Items may have ids below the watermark
+                    columns, item_watermark, touched = empty_columns(), 0, set()
+
+            parts = []
+            if touched:
+                keep = ~np.isin(columns["order_id"], np.fromiter(touched, dtype=np.int64))
+                columns = {name: values[keep] for name, values in columns.items()}
+                parts.append(self._load(batch_size, lambda item: (
+                    item.order_id.in_(touched), item.id <= item_watermark
+                )))
+            parts.append(self._load(batch_size, lambda item: (item.id > item_watermark,)))
+            db.session.commit()
+
+            # Swapped in whole so readers never see a half refreshed snapshot
+            self.columns = concatenate(columns, *parts)
+            self.item_watermark = max(item_watermark, int(parts[-1]["item_id"].max(initial=0)))
+            self.change_watermark = latest
+            self.refreshed = time.monotonic()
+            return sum(len(part["item_id"]) for part in parts)
+
+    def refresh_if_older(self, max_age: float):
+        """Refreshes the snapshot if it was last refreshed more than max_age seconds ago"""
+        if self.refreshed is None or time.monotonic() - self.refreshed > max_age:
+            self.refresh()
+        return self
+
+    @staticmethod
+    def _load(batch_size: int, criteria):
+        """
+        Reads the live and archived Items matching criteria(item) with their Orders into arrays
+
+        The live tables are read first, so an Order archived in between is
+        read from both and its archived rows are dropped as already read
+        """
+        live, archived = [ItemSnapshot._read(batch_size, item, order, *criteria(item))
+                          for item, order in SOURCES]
+        keep = ~np.isin(archived["item_id"], live["item_id"])
+        return concatenate({name: values[keep] for name, values in archived.items()}, live)
+
+    @staticmethod
+    def _read(batch_size: int, item, order, *criteria):
+        """Reads the Items of a table matching the criteria with their Orders into arrays"""
+        connection = db.session.connection()
+        if connection.dialect.name == "postgresql":
+            return copy_columns(connection, item, order, *criteria)
+        rows = iter(db.session.query(
+            item.id, item.order_id, order.customer_id, item.product_id, item.quantity, item.price,
+            order.status, order.created_time
+        ).join(order, item.order_id == order.id).filter(*criteria).yield_per(batch_size))
+        parts = [empty_columns()]
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                break
+            parts.append(to_columns(batch))
+        return concatenate(*parts)
+
+    def select(self, statuses: list = None, created_after=None, created_before=None):
+        """Returns the rows of Orders with one of the statuses created in the given range"""
+        columns = self.columns
+        wanted = [status.value for status in (statuses or REVENUE_STATUSES)]
+        mask = np.isin(columns["status"], wanted)
+        if created_after:
+            mask &= columns["created_time"] >= to_datetime64(created_after)
+        if created_before:
+            mask &= columns["created_time"] < to_datetime64(created_before)
+        return {name: values[mask] for name, values in columns.items()}
+
+    def revenue_by(self, key: str, **filters):
+        """
+        Totals the revenue of the selected rows per value of a column
+
+        :param key: the column to group by, e.g. product_id or customer_id
+        :return: the distinct values with their number of Orders, quantity and revenue
+        """
+        rows = self.select(**filters)
+        return group_totals(rows[key], rows)
+
+    def revenue_by_period(self, bucket: str = "day", **filters):
+        """Totals the revenue of the selected rows per day, week or month of Order creation"""
+        rows = self.select(**filters)
+        created = rows["created_time"]
+        if bucket == "week":
+            days = created.astype("datetime64[D]").astype(np.int64)
+            keys = (days - (days + WEEK_OFFSET_DAYS) % 7).astype("datetime64[D]")
+        else:
+            keys = created.astype(f"datetime64[{BUCKETS[bucket]}]").astype("datetime64[D]")
+        return group_totals(keys, rows)
+
+
+def group_totals(keys, rows: dict):
+    """Returns the distinct keys with the number of Orders, quantity and revenue of each"""
+    groups, inverse = np.unique(keys, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    revenue = np.bincount(inverse, weights=rows["quantity"] * rows["price"], minlength=len(groups))
+    quantity = np.bincount(inverse, weights=rows["quantity"], minlength=len(groups))
+    # Each (group, order) pair once as a single integer, then counted per group
+    stride = int(rows["order_id"].max(initial=0)) + 1
+    pairs = np.sort(inverse * stride + rows["order_id"])
+    first = np.ones(len(pairs), dtype=bool)
+    first[1:] = pairs[1:] != pairs[:-1]
+    pairs = pairs[first]
+    orders = np.bincount(pairs // stride, minlength=len(groups))
+    return groups, orders, quantity.astype(np.int64), revenue
+
+
+def report(totals, key: str, top: int = None, ranked: bool = True):
+    """Turns group totals into report rows, highest revenue first when ranked, at most top rows"""
+    groups, orders, quantity, revenue = totals
+    positions = np.argsort(-revenue, kind="stable") if ranked else np.arange(len(groups))
+    positions = positions[:top]
+    if np.issubdtype(groups.dtype, np.datetime64):
+        groups = np.datetime_as_string(groups, unit="D")
+    return [
+        {key: groups[position].item(), "orders": int(orders[position]),
+         "quantity": int(quantity[position]), "revenue": round(float(revenue[position]), 2)}
+        for position in positions
+    ]
+
+
+# The snapshot of this worker
+snapshot = ItemSnapshot()
@@ -1,8 +1,35 @@
 """
 Flask CLI Command Extensions
 """
+import os
+import sys
+import csv
+import gzip
+import json
+import time
+import shutil
+import tempfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta
+from itertools import groupby, islice
+import click
 from service import app
-from service.models import db
+from service.models import (
+    db, Order, Item, OrderStatus, ImportProgress, CustomerOrderSummary, ArchivedOrder,
+    DataValidationError, SUMMARY_SLICES, append_load, load_rows, server_now, summarize_rows,
+    upgrade_schema
+)
+from service.utils.datagen import GeneratorSettings, generate_chunk, parse_status_mix
+
+# Tables saved by snapshot and replaced by restore, parents first
+SNAPSHOT_TABLES = [Order.__table__, Item.__table__]
+
+# Columns of the CSV export, one row per Item
+CSV_COLUMNS = [
+    "order_id", "customer_id", "tracking_id", "created_time", "status",
+    "item_id", "product_id", "quantity", "price"
+]
 
 
 ######################################################################
@@ -18,3 +45,562 @@ def create_db():
     db.drop_all()
     db.create_all()
     db.session.commit()
+
+
+######################################################################
+# Command to create any missing tables, once per deployment
+# Usage: flask init-db
+######################################################################
+@app.cli.command("init-db")
+def init_db():
+    """
+    Creates the tables that do not exist yet and the indexes and defaults
+    existing tables lack, keeping existing data. Run it before starting
+    workers with DB_INIT_MODE=lazy
+    """
+    db.create_all()
+    db.session.commit()
+    upgrade_schema()
+    click.echo("Database tables are ready", err=True)
+
+
+######################################################################
+# Command to export Orders with their Items
+# Usage: flask export-orders --format csv --gzip -o orders.csv.gz
+######################################################################
+@app.cli.command("export-orders")
+@click.option("--format", "file_format", type=click.Choice(["ndjson", "csv"]), default="ndjson",
+              help="One JSON Order per line, or one CSV row per Item")
+@click.option("--output", "-o", default="-", help="File to write to, - for stdout")
+@click.option("--gzip", "compress", is_flag=True, help="Compress the output with gzip")
+@click.option("--created-after", type=click.DateTime(),
+              help="Only Orders created at or after this time")
+@click.option("--created-before", type=click.DateTime(),
+              help="Only Orders created before this time")
+@click.option("--status", "statuses", multiple=True,
+              type=click.Choice(OrderStatus._member_names_, case_sensitive=False),
+              help="Only Orders with this status, may be repeated")
+@click.option("--batch-size", default=1000, show_default=True, help="Rows fetched per round trip")
+def export_orders(file_format, output, compress, created_after, created_before, statuses,
+                  batch_size):
+    """
+    Streams Orders with their Items to NDJSON or CSV in constant memory
+    """
+    statuses = [OrderStatus[name.upper()] for name in statuses]
+    orders = Order.stream_with_items(created_after, created_before, statuses, batch_size)
+    with open_output(output, compress) as out:
+        if file_format == "csv":
+            count = write_csv(orders, out)
+        else:
+            count = write_ndjson(orders, out)
+    click.echo(f"Exported {count} orders", err=True)
+
+
+######################################################################
+# Command to import Orders with their Items
+# Usage: flask import-orders orders.ndjson.gz
+######################################################################
+@app.cli.command("import-orders")
+@click.argument("source", type=click.Path(exists=True, dir_okay=False))
+@click.option("--format", "file_format", type=click.Choice(["ndjson", "csv"]),
+              help="Input format, guessed from the file name when not given")
+@click.option("--chunk-size", default=5000, show_default=True,
+              help="Orders committed per transaction")
+@click.option("--job", help="Name the progress is kept under, the file name by default")
+@click.option("--restart", is_flag=True, help="Start over instead of resuming a previous run")
+def import_orders(source, file_format, chunk_size, job, restart):
+    """
+    Loads Orders with their Items from NDJSON or CSV, as written by export-orders
+
+    Records are validated like the API validates them, invalid ones are
+    reported and skipped. Each chunk is committed together with the
+    progress of the import, so running the command again resumes after
+    the last committed chunk. Imported Orders get new ids, and each chunk
+    appends a single load change to the change feed instead of one per Order
+    """
+    file_format = file_format or ("csv" if ".csv" in os.path.basename(source) else "ndjson")
+    progress = ImportProgress.find_or_start(job or os.path.basename(source))
+    if restart:
+        progress.records = 0
+    if progress.records:
+        click.echo(f"Resuming after {progress.records} records", err=True)
+
+    totals = {"orders": 0, "items": 0, "invalid": 0}
+    started = time.monotonic()
+    with open_input(source) as source_file:
+        records = read_csv(source_file) if file_format == "csv" else read_ndjson(source_file)
+        records = islice(records, progress.records, None)
+        while True:
+            chunk = list(islice(records, chunk_size))
+            if not chunk:
+                break
+            import_chunk(chunk, totals, progress.records)
+            progress.records += len(chunk)
+            db.session.commit()
+
+    elapsed = max(time.monotonic() - started, 1e-9)
+    click.echo(
+        f"Imported {totals['orders']} orders and {totals['items']} items in {elapsed:.1f}s "
+        f"({totals['orders'] / elapsed:.0f} orders/s, {totals['items'] / elapsed:.0f} items/s), "
+        f"skipped {totals['invalid']} invalid records",
+        err=True
+    )
+
+
+######################################################################
+# Command to generate synthetic Orders for performance testing
+# Usage: flask generate-orders --orders 1000000 --workers 8
+######################################################################
+@app.cli.command("generate-orders")
+@click.option("--orders", default=10000, show_default=True, help="Number of Orders to generate")
+@click.option("--customers", default=100000, show_default=True, help="Number of distinct customers")
+@click.option("--products", default=10000, show_default=True, help="Number of distinct products")
+@click.option("--zipf", default=1.1, show_default=True,
+              help="Skew of customers and products, 0 for uniform")
+@click.option("--items-mean", default=3.0, show_default=True,
+              help="Average number of Items per Order")
+@click.option("--status-mix", default="PLACED=10,PAID=10,SHIPPED=15,DELIVERED=60,CANCELLED=5",
+              show_default=True, help="Relative weight of each status")
+@click.option("--days", default=365, show_default=True,
+              help="Spread the Orders over this many past days")
+@click.option("--workers", default=os.cpu_count(), show_default=True, help="Generator processes")
+@click.option("--chunk-size", default=10000, show_default=True,
+              help="Orders generated and committed together")
+@click.option("--seed", type=int, help="Seed for a reproducible dataset")
+def generate_orders(orders, customers, products, zipf, items_mean, status_mix, days, workers,
+                    chunk_size, seed):
+    """
+    Generates skewed synthetic Orders with Items and bulk loads them
+
+    Each chunk appends a single load change to the change feed
+    """
+    mix = parse_status_mix(status_mix)
+    unknown = set(mix) - set(OrderStatus._member_names_)
+    if unknown:
+        raise click.BadParameter(f"unknown statuses {', '.join(sorted(unknown))}",
+                                 param_hint="--status-mix")
+    settings = GeneratorSettings(customers, products, zipf, items_mean, mix, days, seed)
+    sizes = [min(chunk_size, orders - start) for start in range(0, orders, chunk_size)]
+
+    totals = {"orders": 0, "items": 0}
+    started = time.monotonic()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        # Keep only a few chunks in flight so memory does not grow with the dataset
+        pending = deque()
+        for chunk, size in enumerate(sizes):
+            pending.append(pool.submit(generate_chunk, settings, chunk, len(sizes), size))
+            if len(pending) >= workers * 2:
+                load_generated(pending.popleft().result(), totals)
+        while pending:
+            load_generated(pending.popleft().result(), totals)
+
+    elapsed = max(time.monotonic() - started, 1e-9)
+    click.echo(
+        f"Generated {totals['orders']} orders and {totals['items']} items in {elapsed:.1f}s "
+        f"({totals['orders'] / elapsed:.0f} orders/s)",
+        err=True
+    )
+
+
+######################################################################
+# Command to report revenue from the analytics snapshot
+# Usage: flask report products --top 20
+######################################################################
+@app.cli.command("report")
+@click.argument("group_by", type=click.Choice(["products", "customers", "revenue"]))
+@click.option("--bucket", type=click.Choice(["day", "week", "month"]), default="day",
+              show_default=True, help="Time bucket of the revenue report")
+@click.option("--status", "statuses", multiple=True,
+              type=click.Choice(OrderStatus._member_names_, case_sensitive=False),
+              help="Only Orders with this status, may be repeated, all but CANCELLED by default")
+@click.option("--created-after", type=click.DateTime(),
+              help="Only Orders created at or after this time")
+@click.option("--created-before", type=click.DateTime(),
+              help="Only Orders created before this time")
+@click.option("--top", type=click.IntRange(min=1),
+              help="Only this many rows, highest revenue first")
+@click.option("--format", "file_format", type=click.Choice(["csv", "json"]), default="csv",
+              show_default=True)
+def revenue_report(group_by, bucket, statuses, created_after, created_before, top, file_format):
+    """
+    Reports the revenue per product, per customer or over time
+    """
+    # NumPy backed modules are imported by their commands to keep them out of worker startup
+    from service.utils.analytics import ItemSnapshot, report  # pylint: disable=import-outside-toplevel
+    started = time.monotonic()
+    items = ItemSnapshot()
+    items.refresh()
+    loaded = time.monotonic()
+    filters = {"statuses": [OrderStatus[name.upper()] for name in statuses],
+               "created_after": created_after, "created_before": created_before}
+    key = group_by_key(group_by)
+    if key == "period":
+        rows = report(items.revenue_by_period(bucket, **filters), key, top, ranked=False)
+    else:
+        rows = report(items.revenue_by(key, **filters), key, top)
+    answered = time.monotonic()
+
+    with click.open_file("-", "w") as out:
+        if file_format == "json":
+            json.dump(rows, out, indent=2)
+            out.write("\n")
+        else:
+            writer = csv.writer(out)
+            writer.writerow([key, "orders", "quantity", "revenue"])
+            writer.writerows([list(row.values()) for row in rows])
+        out.flush()
+    click.echo(f"Loaded {len(items)} items in {loaded - started:.2f}s, "
+               f"reported in {(answered - loaded) * 1000:.1f}ms", err=True)
+
+
+######################################################################
+# Command to recompute the customer order summary
+# Usage: flask rebuild-summary --workers 8
+######################################################################
+@app.cli.command("rebuild-summary")
+@click.option("--workers", default=4, show_default=True,
+              help="Parts of the customers rebuilt at once")
+def rebuild_summary(workers):
+    """
+    Recomputes the customer order summary from the Orders and Items
+
+    The customers are split into parts rebuilt in parallel, each in a
+    transaction of its own that holds back writes to its customers only,
+    so the service can keep running meanwhile
+    """
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        rows = sum(pool.map(rebuild_summary_part, range(SUMMARY_SLICES)))
+    click.echo(f"Rebuilt {rows} summary rows in {time.monotonic() - started:.1f}s", err=True)
+
+
+######################################################################
+# Command to move old delivered and cancelled Orders to the archive
+# Usage: flask archive-orders --retention-days 90
+######################################################################
+@app.cli.command("archive-orders")
+@click.option("--retention-days", type=click.IntRange(min=0), default=None,
+              help="Days Orders are kept, ARCHIVE_RETENTION_DAYS by default")
+@click.option("--batch-size", default=1000, show_default=True, help="Orders moved per transaction")
+@click.option("--max-batches", type=click.IntRange(min=1), default=None,
+              help="Stop after this many batches")
+def archive_orders(retention_days, batch_size, max_batches):
+    """
+    Moves DELIVERED and CANCELLED Orders created before the retention
+    window, with their Items, to the archive tables
+
+    Each batch is moved in a transaction of its own, so the command can
+    be stopped at any point and run on a schedule while the service is up
+    """
+    if retention_days is None:
+        retention_days = app.config["ARCHIVE_RETENTION_DAYS"]
+    cutoff = server_now() - timedelta(days=retention_days)
+    started = time.monotonic()
+    orders = items = batches = 0
+    while max_batches is None or batches < max_batches:
+        moved, moved_items = ArchivedOrder.archive(db.session, cutoff, batch_size)
+        db.session.commit()
+        if not moved:
+            break
+        orders, items, batches = orders + moved, items + moved_items, batches + 1
+    click.echo(f"Archived {orders} orders and {items} items created before {cutoff:%Y-%m-%d %H:%M} "
+               f"in {time.monotonic() - started:.1f}s", err=True)
+
+
+######################################################################
+# Command to save Orders and Items as a binary snapshot
+# Usage: flask snapshot ./snapshots/staging
+######################################################################
+@app.cli.command("snapshot")
+@click.argument("directory", type=click.Path(file_okay=False))
+@click.option("--chunk-rows", default=100000, show_default=True, help="Rows copied per round trip")
+def snapshot_tables(directory, chunk_rows):
+    """
+    Saves the Order and Item tables as memory mappable NumPy columns
+    """
+    from service.utils.snapshot import save_snapshot  # pylint: disable=import-outside-toplevel
+    require_postgres()
+    os.makedirs(directory, exist_ok=True)
+    started = time.monotonic()
+    manifest = save_snapshot(directory, SNAPSHOT_TABLES, chunk_rows)
+    click.echo(f"Saved {describe_tables(manifest)} to {directory} "
+               f"({directory_size(directory) / 2 ** 20:.1f} MiB) "
+               f"in {time.monotonic() - started:.1f}s", err=True)
+
+
+######################################################################
+# Command to replace Orders and Items with a binary snapshot
+# Usage: flask restore ./snapshots/staging --yes
+######################################################################
+@app.cli.command("restore")
+@click.argument("directory", type=click.Path(exists=True, file_okay=False))
+@click.option("--chunk-rows", default=100000, show_default=True, help="Rows copied per round trip")
+@click.confirmation_option(prompt="This replaces every Order and Item, continue?")
+@click.pass_context
+def restore_tables(ctx, directory, chunk_rows):
+    """
+    Replaces the Order and Item tables with a snapshot, then rebuilds the customer summary
+    """
+    from service.utils.snapshot import restore_snapshot  # pylint: disable=import-outside-toplevel
+    require_postgres()
+    started = time.monotonic()
+    try:
+        manifest = restore_snapshot(directory, SNAPSHOT_TABLES, chunk_rows)
+    except DataValidationError as error:
+        raise click.ClickException(str(error)) from error
+    Order.ids.reset()
+    Item.ids.reset()
+    click.echo(f"Restored {describe_tables(manifest)} in {time.monotonic() - started:.1f}s",
+               err=True)
+    ctx.invoke(rebuild_summary)
+
+
+######################################################################
+# Command to compare snapshot and restore with a plain dump and reload
+# Usage: flask benchmark-snapshot --yes
+######################################################################
+@app.cli.command("benchmark-snapshot")
+@click.option("--chunk-rows", default=100000, show_default=True, help="Rows copied per round trip")
+@click.confirmation_option(prompt="This reloads every Order and Item, continue?")
+@click.pass_context
+def benchmark_snapshot(ctx, chunk_rows):
+    """
+    Times snapshot and restore against export-orders and import-orders
+
+    Every Order and Item is dumped and reloaded both ways. The database
+    ends up restored from the snapshot, ids included, and the customer
+    summary rebuilt
+    """
+    from service.utils.snapshot import save_snapshot, restore_snapshot  # pylint: disable=import-outside-toplevel
+    require_postgres()
+    workdir = tempfile.mkdtemp(prefix="orders-benchmark-")
+    try:
+        snapshot_dir = os.path.join(workdir, "snapshot")
+        dump = os.path.join(workdir, "orders.ndjson")
+        os.makedirs(snapshot_dir)
+        timings = [
+            ("snapshot", timed(save_snapshot, snapshot_dir, SNAPSHOT_TABLES, chunk_rows),
+             directory_size(snapshot_dir)),
+            ("export-orders", timed(ctx.invoke, export_orders, output=dump), os.path.getsize(dump)),
+        ]
+        timings.append(("restore", timed(restore_snapshot, snapshot_dir, SNAPSHOT_TABLES,
+                                         chunk_rows), None))
+        db.session.execute(db.text('TRUNCATE "order", item'))
+        db.session.commit()
+        timings.append(("import-orders", timed(ctx.invoke, import_orders, source=dump,
+                                               restart=True), None))
+        restore_snapshot(snapshot_dir, SNAPSHOT_TABLES, chunk_rows)
+        Order.ids.reset()
+        Item.ids.reset()
+        ctx.invoke(rebuild_summary)
+    finally:
+        shutil.rmtree(workdir)
+    for name, seconds, size in timings:
+        size = f"{size / 2 ** 20:10.1f} MiB" if size is not None else ""
+        click.echo(f"{name:<15}{seconds:8.2f}s{size}")
+
+
+######################################################################
+#  U T I L I T Y   F U N C T I O N S
+######################################################################
+def require_postgres():
+    """Stops the command unless the database is Postgres"""
+    if db.engine.dialect.name != "postgresql":
+        raise click.ClickException("Snapshots need a Postgres database")
+
+
+def describe_tables(manifest: dict):
+    """Returns how many rows of each table a snapshot holds"""
+    return ", ".join(f"{entry['rows']} {name} rows" for name, entry in manifest["tables"].items())
+
+
+def directory_size(directory: str):
+    """Returns the total size of the files in a directory"""
+    return sum(entry.stat().st_size for entry in os.scandir(directory) if entry.is_file())
+
+
+def timed(function, *args, **kwargs):
+    """Runs a function and returns the seconds it took"""
+    started = time.monotonic()
+    function(*args, **kwargs)
+    return time.monotonic() - started
+
+
+def group_by_key(group_by: str):
+    """Returns the column a report is grouped by"""
+    return {"products": "product_id", "customers": "customer_id", "revenue": "period"}[group_by]
+
+
+def rebuild_summary_part(part: int):
+    """Rebuilds one part of the customer summary in a transaction and session of its own"""
+    with app.app_context():
+        try:
+            rows = CustomerOrderSummary.rebuild(part)
+            db.session.commit()
+            return rows
+        finally:
+            db.session.remove()
+
+
+def load_generated(orders: list, totals: dict):
+    """Loads a chunk of generated Orders and commits it"""
+    order_ids = Order.ids.allocate(len(orders))
+    item_ids = iter(Item.ids.allocate(sum(len(order[4]) for order in orders)))
+    order_rows, item_rows = [], []
+    for order_id, (customer_id, tracking_id, created_time, status, items) in zip(order_ids, orders):
+        order_rows.append({"id": order_id, "customer_id": customer_id, "tracking_id": tracking_id,
+                           "created_time": created_time, "status": status})
+        for product_id, quantity, price in items:
+            item_rows.append({"id": next(item_ids), "order_id": order_id, "product_id": product_id,
+                              "quantity": quantity, "price": price})
+    load_rows(Order.__table__, order_rows)
+    load_rows(Item.__table__, item_rows)
+    CustomerOrderSummary.apply(db.session, summarize_rows(order_rows, item_rows))
+    append_load(db.session)
+    db.session.commit()
+    totals["orders"] += len(order_rows)
+    totals["items"] += len(item_rows)
+
+
+def open_input(source: str):
+    """Opens a file for reading text, gunzipping it if it ends in .gz"""
+    if source.endswith(".gz"):
+        return gzip.open(source, "rt", newline="")
+    return open(source, newline="", encoding="utf-8")
+
+
+def read_ndjson(source_file):
+    """Yields each line of NDJSON as a dictionary, or the error it raised"""
+    for line in source_file:
+        try:
+            yield json.loads(line)
+        except ValueError as error:
+            yield DataValidationError(f"Invalid JSON: {error}")
+
+
+def read_csv(source_file):
+    """
+    Yields the rows of each Order of an export-orders CSV as one dictionary,
+    or the error they raised
+    """
+    rows = csv.DictReader(source_file)
+    for _, order_rows in groupby(rows, key=lambda row: row["order_id"]):
+        try:
+            yield csv_record(list(order_rows))
+        except (KeyError, TypeError, ValueError) as error:
+            yield DataValidationError(f"Invalid CSV row: {error}")
+
+
+def csv_record(rows: list):
+    """Turns the CSV rows of one Order into the dictionary the API would receive"""
+    first = rows[0]
+    return {
+        "customer_id": int(first["customer_id"]),
+        "tracking_id": int(first["tracking_id"]) if first["tracking_id"] else None,
+        "created_time": first["created_time"] or None,
+        "status": first["status"],
+        "order_items": [
+            {"order_id": row["order_id"], "product_id": int(row["product_id"]),
+             "quantity": int(row["quantity"]), "price": float(row["price"])}
+            for row in rows if row["product_id"]
+        ],
+    }
+
+
+def to_order(record):
+    """Validates a record the way the API does and returns it as an Order"""
+    if isinstance(record, Exception):
+        raise record
+    order = Order().deserialize(record)
+    if not isinstance(order.customer_id, int) or \
+            not isinstance(order.tracking_id, (int, type(None))):
+        raise DataValidationError("Invalid Order: customer_id and tracking_id must be integers")
+    if not isinstance(order.status, OrderStatus):
+        raise DataValidationError(f"Invalid Order: unknown status {record['status']}")
+    for item in order.order_items:
+        if not all(isinstance(value, int) and not isinstance(value, bool)
+                   for value in (item.product_id, item.quantity)) or \
+                not isinstance(item.price, (int, float)) or isinstance(item.price, bool):
+            raise DataValidationError("Invalid Item: product_id and quantity must be integers "
+                                      "and price a number")
+    try:
+        created_time = record.get("created_time")
+        order.created_time = datetime.fromisoformat(created_time) if created_time else None
+    except (TypeError, ValueError) as error:
+        raise DataValidationError(
+            f"Invalid Order: bad created_time {record['created_time']}"
+        ) from error
+    return order
+
+
+def import_chunk(chunk: list, totals: dict, offset: int):
+    """Validates a chunk of records and loads the valid ones into the session's transaction"""
+    orders = []
+    for position, record in enumerate(chunk, start=offset + 1):
+        try:
+            orders.append(to_order(record))
+        except (DataValidationError, AttributeError, ValueError, KeyError) as error:
+            click.echo(f"Record {position}: {error}", err=True)
+            totals["invalid"] += 1
+
+    items = [item for order in orders for item in order.order_items]
+    now = server_now()
+    for order, order_id in zip(orders, Order.ids.allocate(len(orders))):
+        order.id = order_id
+        order.created_time = order.created_time or now
+        for item in order.order_items:
+            item.order_id = order_id
+    for item, item_id in zip(items, Item.ids.allocate(len(items))):
+        item.id = item_id
+    order_rows, item_rows = [order.row() for order in orders], [item.row() for item in items]
+    load_rows(Order.__table__, order_rows)
+    load_rows(Item.__table__, item_rows)
+    CustomerOrderSummary.apply(db.session, summarize_rows(order_rows, item_rows))
+    if orders:
+        append_load(db.session)
+    totals["orders"] += len(orders)
+    totals["items"] += len(items)
+
+
+def open_output(output: str, compress: bool):
+    """Opens a file, or stdout for -, for writing text"""
+    if output == "-":
+        if compress:
+            return gzip.open(sys.stdout.buffer, "wt", newline="")
+        return click.open_file("-", "w")
+    if compress:
+        return gzip.open(output, "wt", newline="")
+    return open(output, "w", newline="", encoding="utf-8")
+
+
+def write_ndjson(orders, out):
+    """Writes each Order as one line of JSON and returns how many were written"""
+    count = 0
+    for order in orders:
+        order["created_time"] = order["created_time"].isoformat() if order["created_time"] else None
+        out.write(json.dumps(order))
+        out.write("\n")
+        count += 1
+    return count
+
+
+def write_csv(orders, out):
+    """
+    Writes one CSV row per Item, or per Order without Items, and returns
+    how many Orders were written
+    """
+    writer = csv.writer(out)
+    writer.writerow(CSV_COLUMNS)
+    count = 0
+    for order in orders:
+        created_time = order["created_time"].isoformat() if order["created_time"] else ""
+        head = [order["id"], order["customer_id"], order["tracking_id"], created_time,
+                order["status"]]
+        for item in order["order_items"] or [None]:
+            if item:
+                writer.writerow(head + [item["id"], item["product_id"], item["quantity"],
+                                        item["price"]])
+            else:
+                writer.writerow(head + ["", "", "", ""])
+        count += 1
+    return count
@@ -0,0 +1,198 @@
+"""
+Response Compression
+
+This module compresses the JSON and text responses of the service with
+the best encoding the client accepts: brotli or zstd when their packages
+are installed, otherwise gzip. Responses below COMPRESSION_MIN_SIZE are
+sent as they are, as are event streams, which must reach the client one
+event at a time, and files sent straight from disk.
+
+Streamed responses are compressed chunk by chunk as they are sent. The
+CPU time spent compressing is counted per encoding for /metrics and sent
+to the client as a Server-Timing header on responses compressed whole
+"""
+import time
+import zlib
+import threading
+from flask import current_app, request
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+# Content types worth compressing
+COMPRESSIBLE_TYPES = {
+    "application/json", "application/javascript", "text/html", "text/plain", "text/css", "text/csv"
+}
+
+# Content types that are never compressed
+STREAMING_TYPES = {"text/event-stream"}
+
+# Tells zlib to write a gzip header and trailer
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+class GzipEncoder:
+    """Compresses into the gzip format"""
+
+    def __init__(self, level: int):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+
+    def compress(self, data: bytes) -> bytes:
+        """Returns the compressed bytes ready so far"""
+        return self._compressor.compress(data)
+
+    def flush(self) -> bytes:
+        """Returns the rest of the compressed bytes"""
+        return self._compressor.flush()
+
+
+class BrotliEncoder:
+    """Compresses into the brotli format"""
+
+    def __init__(self, level: int):
+        self._compressor = brotli.Compressor(quality=min(level, 11))
+
+    def compress(self, data: bytes) -> bytes:
+        """Returns the compressed bytes ready so far"""
+        return self._compressor.process(data)
+
+    def flush(self) -> bytes:
+        """Returns the rest of the compressed bytes"""
+        return self._compressor.finish()
+
+
+class ZstdEncoder:
+    """Compresses into the zstd format"""
+
+    def __init__(self, level: int):
+        self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data: bytes) -> bytes:
+        """Returns the compressed bytes ready so far"""
+        return self._compressor.compress(data)
+
+    def flush(self) -> bytes:
+        """Returns the rest of the compressed bytes"""
+        return self._compressor.flush()
+
+
+# The encodings that can be used, most preferred first
+ENCODERS = {"gzip": GzipEncoder}
+if zstandard:
+    ENCODERS = {"zstd": ZstdEncoder, **ENCODERS}
+if brotli:
+    ENCODERS = {"br": BrotliEncoder, **ENCODERS}
+
+
+class CompressionStats:
+    """Counts the responses, bytes and CPU time of each encoding"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = {}
+
+    def add(self, encoding: str, size: int, compressed: int, cpu_seconds: float):
+        """Counts one compressed response"""
+        with self._lock:
+            counts = self._counts.setdefault(
+                encoding, {"responses": 0, "bytes_in": 0, "bytes_out": 0, "cpu_seconds": 0.0}
+            )
+            counts["responses"] += 1
+            counts["bytes_in"] += size
+            counts["bytes_out"] += compressed
+            counts["cpu_seconds"] += cpu_seconds
+
+    def stats(self) -> dict:
+        """Returns the counts of each encoding"""
+        with self._lock:
+            return {encoding: dict(counts) for encoding, counts in self._counts.items()}
+
+
+# The compression counters of this worker
+compression_stats = CompressionStats()
+
+
+def choose_encoding(accept_encoding):
+    """Returns the encoding the client accepts best, or None to send the response as it is"""
+    return accept_encoding.best_match(list(ENCODERS))
+
+
+def compressed_stream(chunks, encoder, encoding: str):
+    """Yields the chunks of a streamed response compressed, counting the work once it ends"""
+    size = compressed = 0
+    cpu_seconds = 0.0
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode("utf-8")
+            started = time.thread_time()
+            data = encoder.compress(chunk)
+            cpu_seconds += time.thread_time() - started
+            size += len(chunk)
+            compressed += len(data)
+            if data:
+                yield data
+        started = time.thread_time()
+        data = encoder.flush()
+        cpu_seconds += time.thread_time() - started
+        compressed += len(data)
+        yield data
+        compression_stats.add(encoding, size, compressed, cpu_seconds)
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+
+def compressible(response) -> bool:
+    """True for responses with a body worth compressing that may be sent compressed"""
+    return bool(
+        request.method != "HEAD"
+        and response.status_code >= 200 and response.status_code not in (204, 304)
+        and not response.direct_passthrough
+        and response.mimetype in COMPRESSIBLE_TYPES
+        and response.mimetype not in STREAMING_TYPES
+        and "Content-Encoding" not in response.headers
+    )
+
+
+def compress_response(response):
+    """Compresses a response with the encoding the client accepts best"""
+    config = current_app.config
+    if not config.get("COMPRESSION_ENABLED") or not compressible(response):
+        return response
+
+    response.vary.add("Accept-Encoding")
+    encoding = choose_encoding(request.accept_encodings)
+    if not encoding:
+        return response
+    level = config.get("COMPRESSION_LEVEL", 6)
+
+    if response.is_streamed:
+        encoder = ENCODERS[encoding](level)
+        response.response = compressed_stream(response.response, encoder, encoding)
+        response.headers.pop("Content-Length", None)
+    else:
+        data = response.get_data()
+        if len(data) < config.get("COMPRESSION_MIN_SIZE", 1024):
+            return response
+        encoder = ENCODERS[encoding](level)
+        started = time.thread_time()
+        compressed = encoder.compress(data) + encoder.flush()
+        cpu_seconds = time.thread_time() - started
+        compression_stats.add(encoding, len(data), len(compressed), cpu_seconds)
+        response.set_data(compressed)
+        response.headers.add("Server-Timing", f"compress;dur={cpu_seconds * 1000:.3f}")
+    response.headers["Content-Encoding"] = encoding
+    return response
+
+
+def init_compression(app):
+    """Compresses the responses of the app"""
+    app.after_request(compress_response)
@@ -0,0 +1,94 @@
+"""
+Synthetic Order Data
+
+This module generates realistic looking Orders and Items for
+performance testing. Customers and products are drawn from Zipf
+distributions so a few of them account for most of the Orders, the way
+they do in production. Chunks are generated in separate processes and
+hold plain tuples, so they are cheap to send back for loading
+"""
+import random
+import bisect
+from functools import lru_cache
+from datetime import datetime, timedelta
+
+
+class GeneratorSettings:
+    """The shape of the dataset to generate"""
+
+    def __init__(self, customers=100000, products=10000, zipf=1.1, items_mean=3.0,
+                 status_mix=None, days=365, seed=None):
+        self.customers = customers
+        self.products = products
+        self.zipf = zipf
+        self.items_mean = items_mean
+        self.status_mix = status_mix or {
+            "PLACED": 10, "PAID": 10, "SHIPPED": 15, "DELIVERED": 60, "CANCELLED": 5
+        }
+        self.days = days
+        self.seed = seed
+        self.end = datetime.now()
+
+
+def parse_status_mix(text: str):
+    """Parses a status mix such as PLACED=10,DELIVERED=90 into a dictionary of weights"""
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        mix[name.strip().upper()] = float(weight)
+    return mix
+
+
+@lru_cache(maxsize=8)
+def zipf_cumulative_weights(count: int, exponent: float):
+    """Returns the cumulative weights of ranks 1..count under a Zipf distribution"""
+    total = 0.0
+    weights = []
+    for rank in range(1, count + 1):
+        total += 1.0 / rank ** exponent
+        weights.append(total)
+    return weights
+
+
+def zipf_sample(rng: random.Random, count: int, exponent: float):
+    """Draws one rank in 1..count from a Zipf distribution"""
+    weights = zipf_cumulative_weights(count, exponent)
+    return bisect.bisect_left(weights, rng.random() * weights[-1]) + 1
+
+
+def product_price(product_id: int):
+    """Returns the list price of a product, the same every time it is asked for"""
+    return round(random.Random(product_id).uniform(1, 500), 2)
+
+
+def generate_chunk(settings: GeneratorSettings, chunk: int, chunks: int, count: int):
+    """
+    Generates one chunk of Orders
+
+    Chunks cover consecutive slices of the time range and are sorted by
+    creation time, so ids rise with time as they do in production
+
+    :return: a list of (customer_id, tracking_id, created_time, status, items)
+             where items is a list of (product_id, quantity, price)
+    """
+    rng = random.Random(None if settings.seed is None else settings.seed * 100003 + chunk)
+    span = timedelta(days=settings.days) / chunks
+    start = settings.end - timedelta(days=settings.days) + span * chunk
+    statuses = list(settings.status_mix.keys())
+    status_weights = list(settings.status_mix.values())
+    times = sorted(start + span * rng.random() for _ in range(count))
+    orders = []
+    for created_time in times:
+        items = []
+        for _ in range(max(1, round(rng.expovariate(1 / settings.items_mean)))):
+            product_id = zipf_sample(rng, settings.products, settings.zipf)
+            quantity = min(1 + int(rng.expovariate(1.0)), 20)
+            items.append((product_id, quantity, product_price(product_id)))
+        orders.append((
+            zipf_sample(rng, settings.customers, settings.zipf),
+            rng.randint(0, 10000000),
+            created_time,
+            rng.choices(statuses, status_weights)[0],
+            items,
+        ))
+    return orders
@@ -17,10 +17,14 @@
 """
 Module: error_handlers
 """
-from service.models import DataValidationError
+from service.models import DataValidationError, DatabaseUnavailableError
+from service.utils.admission import OverloadedError, RateLimitedError
 from service import app, api
 from . import status
 
+# Seconds clients are asked to wait before retrying while the database is unavailable
+DATABASE_RETRY_AFTER = 5
+
 
 ######################################################################
 # Error Handlers
@@ -35,3 +39,39 @@ def request_validation_error(error):
         'error': 'Bad Request',
         'message': message
     }, status.HTTP_400_BAD_REQUEST
+
+
+@api.errorhandler(DatabaseUnavailableError)
+def database_unavailable(error):
+    """ Handles a database that could not be reached """
+    message = str(error)
+    app.logger.critical(message)
+    return {
+        'status_code': status.HTTP_503_SERVICE_UNAVAILABLE,
+        'error': 'Service Unavailable',
+        'message': message
+    }, status.HTTP_503_SERVICE_UNAVAILABLE, {'Retry-After': str(DATABASE_RETRY_AFTER)}
+
+
+@api.errorhandler(OverloadedError)
+def overloaded(error):
+    """ Handles requests turned away because too many are in progress """
+    message = str(error)
+    app.logger.warning(message)
+    return {
+        'status_code': status.HTTP_503_SERVICE_UNAVAILABLE,
+        'error': 'Service Unavailable',
+        'message': message
+    }, status.HTTP_503_SERVICE_UNAVAILABLE, {'Retry-After': str(error.retry_after)}
+
+
+@api.errorhandler(RateLimitedError)
+def rate_limited(error):
+    """ Handles clients sending more requests than their rate allows """
+    message = str(error)
+    app.logger.warning(message)
+    return {
+        'status_code': status.HTTP_429_TOO_MANY_REQUESTS,
+        'error': 'Too Many Requests',
+        'message': message
+    }, status.HTTP_429_TOO_MANY_REQUESTS, {'Retry-After': str(error.retry_after)}
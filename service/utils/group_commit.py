@@ -0,0 +1,160 @@
+"""
+Group Commit
+
+This module coalesces the writes of concurrent requests into a single
+transaction. Each request hands its unit of work to a writer thread,
+which runs the units that arrive within a short window inside one
+transaction, each under its own savepoint, and commits them together.
+Every request still gets back its own result or its own exception.
+
+Work asked for inside an atomic() block or a batch runs in place, as it
+belongs to the transaction of its caller, which the writer thread could
+neither join nor wait for
+"""
+import time
+import queue
+import logging
+import threading
+from flask import has_request_context, request
+from service.models import db, atomic, in_atomic
+from service.utils.admission import OverloadedError, NESTED_KEY
+
+logger = logging.getLogger("flask.app")
+
+
+class _Job:  # pylint: disable=too-many-instance-attributes
+    """A unit of work waiting for the writer thread"""
+
+    def __init__(self, work, args):
+        self.work = work
+        self.args = args
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+        self._lock = threading.Lock()
+        self._started = False
+        self._abandoned = False
+
+    def start(self) -> bool:
+        """Marks the job as taken up by the writer, unless its caller gave up on it"""
+        with self._lock:
+            self._started = not self._abandoned
+            return self._started
+
+    def abandon(self) -> bool:
+        """Gives up on the job, True if the writer had not taken it up yet and never will"""
+        with self._lock:
+            self._abandoned = not self._started
+            return self._abandoned
+
+
+class GroupCommitter:
+    """Runs units of work from many threads in shared transactions"""
+
+    def __init__(self):
+        self.app = None
+        self._jobs = queue.Queue()
+        self._lock = threading.Lock()
+        self._writer = None
+
+    @property
+    def enabled(self):
+        """True when units of work are grouped rather than run in place"""
+        return bool(self.app and self.app.config.get("GROUP_COMMIT_ENABLED"))
+
+    def run(self, work, *args):
+        """
+        Runs work(*args) and returns its result
+
+        When group commit is enabled the work runs in the writer thread and
+        is committed together with the work of other requests, otherwise it
+        runs right here, as it does inside an atomic() block or a batch. The
+        work must return plain data, not models, as those belong to the
+        session of the thread that loaded them. An OverloadedError is raised
+        when the work is not done within GROUP_COMMIT_TIMEOUT_SECONDS
+        """
+        nested = has_request_context() and request.environ.get(NESTED_KEY)
+        if not self.enabled or in_atomic() or nested:
+            return work(*args)
+        self._start_writer()
+        job = _Job(work, args)
+        self._jobs.put(job)
+        if not job.done.wait(self.app.config.get("GROUP_COMMIT_TIMEOUT_SECONDS", 10)):
+            if job.abandon():
+                raise OverloadedError("Too many writes waiting to be committed, try again later.",
+                                      self.app.config.get("ADMISSION_RETRY_AFTER", 1))
+            # Taken up meanwhile, its outcome is known only once the writer is done with it
+            raise OverloadedError("Timed out committing the write, its outcome is unknown.",
+                                  self.app.config.get("ADMISSION_RETRY_AFTER", 1))
+        if job.error:
+            raise job.error
+        return job.result
+
+    def _start_writer(self):
+        """Starts the writer thread of this worker, once, after any fork"""
+        with self._lock:
+            if self._writer and self._writer.is_alive():
+                return
+            self._writer = threading.Thread(target=self._write, name="group-commit", daemon=True)
+            self._writer.start()
+
+    def _collect(self):
+        """Waits for a job, then gathers more until the window closes or the batch is full"""
+        batch = [self._jobs.get()]
+        window = self.app.config.get("GROUP_COMMIT_WINDOW_MS", 2) / 1000
+        max_batch = self.app.config.get("GROUP_COMMIT_MAX_BATCH", 50)
+        deadline = time.monotonic() + window
+        while len(batch) < max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._jobs.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self):
+        """Runs batches of jobs in one transaction each, forever"""
+        with self.app.app_context():
+            while True:
+                batch = self._collect()
+                try:
+                    self._commit(batch)
+                finally:
+                    db.session.remove()
+                    for job in batch:
+                        job.done.set()
+
+    @staticmethod
+    def _commit(batch: list):
+        """Runs each job under its own savepoint and commits the batch once"""
+        try:
+            with atomic():
+                for job in batch:
+                    if not job.start():
+                        continue
+                    # The events of a job rolled back to its savepoint must not be published
+                    pending = list(db.session.info.get("order_changes", []))
+                    savepoint = db.session.begin_nested()
+                    try:
+                        job.result = job.work(*job.args)
+                        savepoint.commit()
+                    except Exception as error:  # pylint: disable=broad-except
+                        savepoint.rollback()
+                        db.session.info["order_changes"] = pending
+                        job.error = error
+            logger.info("Group committed %s units of work", len(batch))
+        except Exception as error:  # pylint: disable=broad-except
+            logger.error("Group commit of %s units of work failed: %s", len(batch), error)
+            for job in batch:
+                job.error = job.error or error
+
+
+# The group committer of this worker
+group_committer = GroupCommitter()
+
+
+def init_group_commit(app):
+    """Reads the group commit settings of the app"""
+    group_committer.app = app
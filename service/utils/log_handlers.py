@@ -18,19 +18,166 @@
 Log Handlers
 
 This module contains utility functions to set up logging
-consistently
+consistently. Records can be written as text or as one JSON object per
+line, handed to a background thread so requests never wait on log I/O,
+and sampled per level so busy info lines do not flood the log
 """
+import os
+import json
+import queue
+import atexit
 import logging
+import weakref
+import itertools
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
+
+TEXT_FORMAT = "[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s"
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S %z"
+
+# Background handlers of this process, restarted after a fork and flushed at exit
+_background_handlers = weakref.WeakSet()
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats each record as a JSON object on a single line"""
+
+    def format(self, record):
+        created = datetime.fromtimestamp(record.created).astimezone()
+        entry = {
+            "time": created.isoformat("T", "milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "module": record.module,
+            "message": record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):  # pylint: disable=too-few-public-methods
+    """
+    Passes one in every 1 / rate records of each sampled level
+
+    Warnings and above are never sampled, and a rate of 0 drops every
+    record of its level
+    """
+
+    def __init__(self, rates: dict):
+        super().__init__()
+        self.every = {level: round(1 / rate) if rate > 0 else 0 for level, rate in rates.items()}
+        self._counters = {level: itertools.count() for level in self.every}
+
+    def filter(self, record):
+        every = self.every.get(record.levelno)
+        if every is None or record.levelno >= logging.WARNING:
+            return True
+        return every > 0 and next(self._counters[record.levelno]) % every == 0
+
+
+def parse_sample_rates(rates: str) -> dict:
+    """Turns "INFO=0.1,DEBUG=0" into the rate of each level number"""
+    levels = {}
+    for pair in filter(None, (part.strip() for part in rates.split(","))):
+        name, rate = pair.split("=")
+        level = logging.getLevelName(name.strip().upper())
+        if not isinstance(level, int):
+            raise ValueError(f"Unknown log level: {name}")
+        levels[level] = min(1.0, float(rate))
+    return levels
+
+
+class BackgroundHandler(QueueHandler):
+    """
+    Hands records to a listener thread that passes them on to handlers
+
+    Requests only pay for merging the message with its arguments, the
+    listener formats and writes it. When the queue is full records are
+    dropped and counted rather than making the request wait
+    """
+
+    def __init__(self, handlers: list, maxsize: int = 10000):
+        super().__init__(queue.Queue(maxsize))
+        self.targets = list(handlers)
+        self.dropped = 0
+        self.listener = None
+        self.start()
+        _background_handlers.add(self)
+
+    def start(self):
+        """Starts the listener thread"""
+        self.listener = QueueListener(self.queue, *self.targets, respect_handler_level=True)
+        self.listener.start()
+
+    def stop(self):
+        """Writes out the records still queued and stops the listener thread"""
+        if self.listener:
+            self.listener.stop()
+            self.listener = None
+
+    def prepare(self, record):
+        # The arguments are merged now while they still hold the logged
+        # values, the formatting is left to the listener
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def restart(self):
+        """Starts over in a forked child, which has the queue but not the thread"""
+        self.queue = queue.Queue(self.queue.maxsize)
+        self.start()
+
+
+def _restart_background_handlers():
+    for handler in list(_background_handlers):
+        if handler.listener:
+            handler.restart()
+
+
+def _stop_background_handlers():
+    for handler in list(_background_handlers):
+        handler.stop()
+
+
+os.register_at_fork(after_in_child=_restart_background_handlers)
+atexit.register(_stop_background_handlers)
 
 
 def init_logging(app, logger_name: str):
     """Set up logging for production"""
     app.logger.propagate = False
     gunicorn_logger = logging.getLogger(logger_name)
-    app.logger.handlers = gunicorn_logger.handlers
     app.logger.setLevel(gunicorn_logger.level)
     # Make all log formats consistent
-    formatter = logging.Formatter("[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s", "%Y-%m-%d %H:%M:%S %z")
-    for handler in app.logger.handlers:
+    if app.config.get("LOG_FORMAT") == "json":
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter(TEXT_FORMAT, DATE_FORMAT)
+    for handler in gunicorn_logger.handlers:
         handler.setFormatter(formatter)
+
+    for handler in app.logger.handlers:
+        if isinstance(handler, BackgroundHandler):
+            handler.stop()
+    if app.config.get("LOG_QUEUE_ENABLED"):
+        maxsize = app.config.get("LOG_QUEUE_SIZE", 10000)
+        app.logger.handlers = [BackgroundHandler(gunicorn_logger.handlers, maxsize)]
+    else:
+        app.logger.handlers = gunicorn_logger.handlers
+
+    for log_filter in list(app.logger.filters):
+        if isinstance(log_filter, SamplingFilter):
+            app.logger.removeFilter(log_filter)
+    rates = parse_sample_rates(app.config.get("LOG_SAMPLE_RATES", ""))
+    if rates:
+        app.logger.addFilter(SamplingFilter(rates))
     app.logger.info("Logging handler established")
@@ -0,0 +1,163 @@
+"""
+Order Event Broker
+
+This module publishes the changes committed to Orders to subscribers
+inside the worker, such as the server-sent event streams. With
+ORDER_EVENTS_NOTIFY set the changes travel through Postgres
+LISTEN/NOTIFY instead, so every worker sees the changes made by all
+of them, and by the commands run against the same database
+"""
+import json
+import queue
+import select
+import logging
+import threading
+from sqlalchemy import create_engine
+from sqlalchemy.pool import NullPool
+from service.models import db, change_listeners, NOTIFY_CHANNEL
+
+logger = logging.getLogger("flask.app")
+
+# Events a slow subscriber may fall behind by before new ones are dropped
+SUBSCRIPTION_BACKLOG = 100
+
+# Seconds between checks for shutdown while waiting for notifications
+LISTEN_POLL_SECONDS = 5
+
+
+class Subscription:
+    """A queue of the change events matching an order id and/or customer id"""
+
+    def __init__(self, broker, order_id: int = None, customer_id: int = None):
+        self.broker = broker
+        self.order_id = order_id
+        self.customer_id = customer_id
+        self.events = queue.Queue(maxsize=SUBSCRIPTION_BACKLOG)
+
+    def matches(self, event: dict):
+        """Returns True if the event is one this subscription asked for"""
+        if self.order_id is not None and event["order_id"] != self.order_id:
+            return False
+        if self.customer_id is not None and event["customer_id"] != self.customer_id:
+            return False
+        return True
+
+    def put(self, event: dict):
+        """Queues an event, dropping it if the subscriber has fallen behind"""
+        try:
+            self.events.put_nowait(event)
+        except queue.Full:
+            logger.warning("Dropping event for slow subscriber of order %s", self.order_id)
+
+    def get(self, timeout: float = None):
+        """Returns the next event, or None if none arrived within timeout seconds"""
+        try:
+            return self.events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        """Stops receiving events"""
+        self.broker.unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class Broker:
+    """Fans change events out to the subscriptions of this worker"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscriptions = set()
+        self._listener = None
+        self.app = None
+        # Callables given the change events NOTIFYed by any process
+        self.listeners = []
+
+    def subscribe(self, order_id: int = None, customer_id: int = None):
+        """Returns a new Subscription to the events of an order and/or customer"""
+        self._start_listener()
+        subscription = Subscription(self, order_id, customer_id)
+        with self._lock:
+            self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        """Removes a Subscription"""
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    def publish(self, events: list):
+        """Delivers change events to the subscriptions they match"""
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+        for event in events:
+            for subscription in subscriptions:
+                if subscription.matches(event):
+                    subscription.put(event)
+
+    def publish_local(self, events: list):
+        """Publishes committed changes unless they will come back through NOTIFY"""
+        if not self.app.config.get("ORDER_EVENTS_NOTIFY"):
+            # Subscribers get the events as NOTIFY sends them, without their scope
+            self.publish([{key: value for key, value in event.items() if key != "scope"}
+                          for event in events])
+
+    def receive(self, events: list):
+        """Hands change events NOTIFYed by any process to the listeners and subscriptions"""
+        for listener in self.listeners:
+            listener(events)
+        self.publish(events)
+
+    def start_listening(self):
+        """Listens for NOTIFY in this worker when something is waiting for the events"""
+        if self.listeners:
+            self._start_listener()
+
+    def _start_listener(self):
+        """Starts listening for NOTIFY in this worker, once, after any fork"""
+        if not self.app or not self.app.config.get("ORDER_EVENTS_NOTIFY"):
+            return
+        with self._lock:
+            if self._listener and self._listener.is_alive():
+                return
+            self._listener = threading.Thread(target=self._listen, name="order-events", daemon=True)
+            self._listener.start()
+
+    def _listen(self):
+        """Publishes the changes NOTIFYed by any worker, reconnecting on failure"""
+        # A connection of its own so LISTEN never holds one of the pool's
+        with self.app.app_context():
+            engine = create_engine(db.engine.url, poolclass=NullPool)
+        while True:
+            try:
+                connection = engine.raw_connection()
+                connection.connection.autocommit = True
+                cursor = connection.cursor()
+                cursor.execute(f"LISTEN {NOTIFY_CHANNEL}")
+                logger.info("Listening for order changes on %s", NOTIFY_CHANNEL)
+                while True:
+                    select.select([connection.connection], [], [], LISTEN_POLL_SECONDS)
+                    connection.connection.poll()
+                    while connection.connection.notifies:
+                        notify = connection.connection.notifies.pop(0)
+                        self.receive(json.loads(notify.payload))
+            except Exception as error:  # pylint: disable=broad-except
+                logger.error("Order change listener failed, reconnecting: %s", error)
+                threading.Event().wait(LISTEN_POLL_SECONDS)
+
+
+# The broker of this worker
+broker = Broker()
+
+
+def init_pubsub(app):
+    """Publishes the changes committed by this app to the broker"""
+    broker.app = app
+    change_listeners.append(broker.publish_local)
+    # Workers are forked after the app is made, so each starts its listener on its first request
+    app.before_request(broker.start_listening)
@@ -0,0 +1,318 @@
+"""
+Shared Cache
+
+This module keeps serialized Orders and list results in a file mapped
+into the memory of every worker on the host, so the cache is shared by
+the workers, filled once for all of them and survives the recycling of
+any one of them.
+
+The file holds a table of generation counters followed by tiers of fixed
+size slots, small ones for single Orders and large ones for lists. A key
+hashes to a set of slots in a tier and, when the set is full, evicts its
+least recently used slot. Each entry records the generation of the
+counters it depends on, such as the counter of its Order or of the
+customer a list is filtered by, and a write invalidates every entry
+depending on a counter by bumping it. With ORDER_EVENTS_NOTIFY set the
+changes committed by other hosts and by commands such as archive-orders
+bump the counters too, as they arrive through LISTEN/NOTIFY. Entries
+also expire after CACHE_TTL_SECONDS, which bounds how long the changes
+made on other hosts without NOTIFY can go unseen.
+
+Workers lock the file with flock for each operation, and threads within
+a worker with a lock of their own
+"""
+import os
+import json
+import mmap
+import time
+import fcntl
+import struct
+import hashlib
+import threading
+from contextlib import contextmanager
+from service.models import change_listeners
+from service.utils.pubsub import broker
+
+# Identifies the layout of the file, which is rebuilt when it differs
+MAGIC = b"ORDCACH1"
+
+# magic, number of counters, number of tiers, LRU clock
+HEADER = struct.Struct("<8sIIQ")
+# slot size, sets and ways of a tier
+TIER = struct.Struct("<III")
+# key hash, last use, expiry time, value length, key length, dependencies
+SLOT = struct.Struct("<QQdIHH")
+# counter index and generation of a dependency
+DEPENDENCY = struct.Struct("<IQ")
+COUNTER = struct.Struct("<Q")
+
+# Most counters an entry may depend on
+MAX_DEPENDENCIES = 4
+SLOT_HEADER_SIZE = SLOT.size + MAX_DEPENDENCIES * DEPENDENCY.size
+
+# Slot sizes of the tiers, each given an equal share of the file
+SLOT_SIZES = (2048, 32768)
+WAYS = 8
+COUNTERS = 4096
+
+
+def key_hash(text: str) -> int:
+    """Returns a hash of the text that is the same in every worker, never 0"""
+    digest = hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little") or 1
+
+
+class SharedCache:  # pylint: disable=too-many-instance-attributes
+    """A size limited LRU cache in a memory mapped file shared by processes"""
+
+    def __init__(self, path: str = None, size: int = 8 * 1024 * 1024, ttl: float = 60):
+        self.path = path
+        self.size = size
+        self.ttl = ttl
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._fd = None
+        self._map = None
+        self._tiers = []
+        self._slots_offset = 0
+        self._counts = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0, "skipped": 0}
+        os.register_at_fork(after_in_child=self._forget)
+
+    def configure(self, path: str, size: int, ttl: float, enabled: bool = True):
+        """Points the cache at a file of the given size, opened on first use, zeroing the counts"""
+        with self._lock:
+            self._close()
+            self.path, self.size, self.ttl, self.enabled = path, size, ttl, enabled
+            self._counts = dict.fromkeys(self._counts, 0)
+
+    # ------------------------------------------------------------------
+    # Reading and writing
+    # ------------------------------------------------------------------
+    def get(self, key: str):
+        """Returns the value cached for the key, or None if it is missing, expired or invalidated"""
+        if not self.enabled:
+            return None
+        wanted, encoded = key_hash(key), key.encode("utf-8")
+        with self._locked() as view:
+            for offset in self._candidates(wanted):
+                header = SLOT.unpack_from(view, offset)
+                if header[0] != wanted or not header[1] or \
+                        not self._same_key(view, offset, header, encoded):
+                    continue
+                if header[2] < time.time() or not self._current(view, offset, header[5]):
+                    SLOT.pack_into(view, offset, 0, 0, 0, 0, 0, 0)
+                    break
+                SLOT.pack_into(view, offset, wanted, self._tick(view), *header[2:])
+                start = offset + SLOT_HEADER_SIZE + header[4]
+                data = bytes(view[start:start + header[3]])
+                self._counts["hits"] += 1
+                return json.loads(data)
+            self._counts["misses"] += 1
+        return None
+
+    def generations(self, names: list) -> list:
+        """Returns the current generation of each counter, read before fetching a value"""
+        if not self.enabled:
+            return []
+        with self._locked() as view:
+            return [self._counter(view, name)[1] for name in names]
+
+    def put(self, key: str, value, names: list, generations: list):
+        """
+        Caches the value unless a counter it depends on moved since generations were read
+
+        :param names: the counters the value depends on
+        :param generations: their generations from before the value was fetched
+        """
+        if not self.enabled or value is None:
+            return
+        wanted, encoded = key_hash(key), key.encode("utf-8")
+        data = json.dumps(value, separators=(",", ":")).encode("utf-8")
+        needed = SLOT_HEADER_SIZE + len(encoded) + len(data)
+        with self._locked() as view:
+            tier = next((tier for tier in self._tiers if tier[0] >= needed), None)
+            counters = [self._counter(view, name) for name in names[:MAX_DEPENDENCIES]]
+            if tier is None or len(names) > MAX_DEPENDENCIES or \
+                    [current for _, current in counters] != list(generations):
+                self._counts["skipped"] += 1
+                return
+            for offset in self._candidates(wanted):
+                header = SLOT.unpack_from(view, offset)
+                if header[0] == wanted and header[1] and \
+                        self._same_key(view, offset, header, encoded):
+                    SLOT.pack_into(view, offset, 0, 0, 0, 0, 0, 0)
+            offset = self._victim(view, tier, wanted)
+            for position, (index, generation) in enumerate(counters):
+                DEPENDENCY.pack_into(view, offset + SLOT.size + position * DEPENDENCY.size,
+                                     index, generation)
+            start = offset + SLOT_HEADER_SIZE
+            view[start:start + len(encoded)] = encoded
+            view[start + len(encoded):start + len(encoded) + len(data)] = data
+            SLOT.pack_into(view, offset, wanted, self._tick(view), time.time() + self.ttl,
+                           len(data), len(encoded), len(counters))
+            self._counts["stores"] += 1
+
+    def bump(self, names):
+        """Invalidates every entry depending on the named counters"""
+        if not self.enabled:
+            return
+        with self._locked() as view:
+            for name in set(names):
+                index, generation = self._counter(view, name)
+                COUNTER.pack_into(view, self._counter_offset(index), generation + 1)
+
+    def clear(self):
+        """Drops every entry"""
+        if not self.enabled:
+            return
+        with self._locked() as view:
+            view[self._slots_offset:] = bytes(len(view) - self._slots_offset)
+
+    def stats(self) -> dict:
+        """Returns the counters of this worker's use of the cache"""
+        with self._lock:
+            return dict(self._counts, size=self.size if self.enabled else 0)
+
+    # ------------------------------------------------------------------
+    # Slots and counters
+    # ------------------------------------------------------------------
+    def _candidates(self, wanted: int):
+        """Yields the offsets of the slots the key may be in, in every tier"""
+        offset = self._slots_offset
+        for slot_size, sets, ways in self._tiers:
+            first = offset + (wanted % sets) * ways * slot_size
+            for way in range(ways):
+                yield first + way * slot_size
+            offset += sets * ways * slot_size
+
+    def _victim(self, view, tier: tuple, wanted: int) -> int:
+        """Returns the offset of an empty or else the least recently used slot of the key's set"""
+        offset = self._slots_offset
+        for slot_size, sets, ways in self._tiers:
+            if (slot_size, sets, ways) == tier:
+                break
+            offset += sets * ways * slot_size
+        slot_size, sets, ways = tier
+        first = offset + (wanted % sets) * ways * slot_size
+        slots = [first + way * slot_size for way in range(ways)]
+        used = [SLOT.unpack_from(view, slot)[1] for slot in slots]
+        if min(used):
+            self._counts["evictions"] += 1
+        return slots[used.index(min(used))]
+
+    @staticmethod
+    def _same_key(view, offset: int, header: tuple, encoded: bytes) -> bool:
+        start = offset + SLOT_HEADER_SIZE
+        return header[4] == len(encoded) and view[start:start + header[4]] == encoded
+
+    def _current(self, view, offset: int, count: int) -> bool:
+        """True when no counter an entry depends on has moved since it was stored"""
+        for position in range(count):
+            index, generation = DEPENDENCY.unpack_from(
+                view, offset + SLOT.size + position * DEPENDENCY.size
+            )
+            if COUNTER.unpack_from(view, self._counter_offset(index))[0] != generation:
+                return False
+        return True
+
+    def _counter(self, view, name: str) -> tuple:
+        """Returns the index and generation of a counter, counters sharing an index move together"""
+        index = key_hash(name) % COUNTERS
+        return index, COUNTER.unpack_from(view, self._counter_offset(index))[0]
+
+    def _counter_offset(self, index: int) -> int:
+        return HEADER.size + len(self._tiers) * TIER.size + index * COUNTER.size
+
+    @staticmethod
+    def _tick(view) -> int:
+        """Advances the LRU clock shared by the workers"""
+        magic, counters, tiers, clock = HEADER.unpack_from(view, 0)
+        HEADER.pack_into(view, 0, magic, counters, tiers, clock + 1)
+        return clock + 1
+
+    # ------------------------------------------------------------------
+    # The file
+    # ------------------------------------------------------------------
+    def _layout(self) -> list:
+        """Returns the slot size, sets and ways of each tier for the size of the cache"""
+        share = self.size // len(SLOT_SIZES)
+        return [(slot_size, max(1, share // (slot_size * WAYS)), WAYS) for slot_size in SLOT_SIZES]
+
+    @contextmanager
+    def _locked(self):
+        """Holds the locks of this thread and process on the mapped file, opening it if need be"""
+        with self._lock:
+            if self._map is None:
+                self._open()
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                yield self._map
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _open(self):
+        """Maps the file, making or rebuilding it when it does not have the layout wanted"""
+        tiers = self._layout()
+        slots_offset = HEADER.size + len(tiers) * TIER.size + COUNTERS * COUNTER.size
+        size = slots_offset + sum(slot_size * sets * ways for slot_size, sets, ways in tiers)
+        layout = b"".join(TIER.pack(*tier) for tier in tiers)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            header = os.pread(fd, HEADER.size + len(layout), 0)
+            if os.fstat(fd).st_size != size or header[:8] != MAGIC or \
+                    header[HEADER.size:] != layout or \
+                    HEADER.unpack_from(header)[1:3] != (COUNTERS, len(tiers)):
+                # Zeroed by truncating, which empties every slot and counter
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+                os.pwrite(fd, HEADER.pack(MAGIC, COUNTERS, len(tiers), 0) + layout, 0)
+            view = mmap.mmap(fd, size)
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        self._fd, self._map, self._tiers, self._slots_offset = fd, view, tiers, slots_offset
+
+    def _close(self):
+        if self._map is not None:
+            self._map.close()
+            os.close(self._fd)
+        self._fd = self._map = None
+
+    def _forget(self):
+        """Drops the file and lock inherited from the parent, a forked child opens its own"""
+        self._lock = threading.Lock()
+        self._fd = self._map = None
+
+
+def order_dependencies(event: dict) -> list:
+    """
+    Returns the counters a change to an Order or its Items moves
+
+    These are the counters of the Order, of every list and of the filtered
+    lists in the scope of the change. A change whose scope is not known
+    moves the counter of all filtered lists
+    """
+    names = [f"order:{event['order_id']}", "orders"]
+    scope = event.get("scope")
+    if scope is None:
+        return names + ["lists"]
+    return names + [f"{field}:{value}" for field, values in scope.items() for value in values]
+
+
+def invalidate(events: list):
+    """Bumps the counters of the Orders changed by a commit"""
+    shared_cache.bump(name for event in events for name in order_dependencies(event))
+
+
+# The cache of this host
+shared_cache = SharedCache()
+
+
+def init_shared_cache(app):
+    """Reads the cache settings of the app and invalidates the cache on every commit it hears of"""
+    shared_cache.configure(app.config["CACHE_PATH"], int(app.config["CACHE_SIZE_MB"] * 1024 * 1024),
+                           app.config["CACHE_TTL_SECONDS"], app.config["CACHE_ENABLED"])
+    change_listeners.append(invalidate)
+    if app.config["CACHE_ENABLED"] and app.config.get("ORDER_EVENTS_NOTIFY"):
+        # The commits of this worker are also NOTIFYed back, bumping their counters twice
+        broker.listeners.append(invalidate)
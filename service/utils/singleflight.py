@@ -0,0 +1,96 @@
+"""
+Single Flight
+
+This module coalesces identical reads. The first request for a key
+fetches and serializes the result while the requests for the same key
+that arrive in the meantime wait for it and share it, so a burst of
+polls for one Order costs a single query.
+
+A commit in this worker ends every flight in progress for newcomers,
+so a read that starts after a write never shares a fetch from before
+it. Writes committed by other workers are seen by the next flight
+"""
+import threading
+from service.models import change_listeners
+
+
+class _Flight:
+    """A fetch in progress and the requests waiting for it"""
+
+    def __init__(self):
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class SingleFlight:
+    """Runs the work for each key once for all of the callers asking at the same time"""
+
+    def __init__(self):
+        self.app = None
+        self._lock = threading.Lock()
+        self._flights = {}
+        self._counts = {}
+
+    @property
+    def enabled(self):
+        """True when identical reads are coalesced"""
+        return bool(self.app and self.app.config.get("SINGLEFLIGHT_ENABLED"))
+
+    def do(self, key: tuple, work, *args):
+        """
+        Returns work(*args), shared with the callers of the same key in progress
+
+        The first element of the key names the kind of read it is counted
+        under. The result is shared, so it must be plain data that callers
+        do not change
+        """
+        if not self.enabled:
+            return work(*args)
+        with self._lock:
+            counts = self._counts.setdefault(key[0], {"fetches": 0, "coalesced": 0})
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                counts["fetches"] += 1
+            else:
+                counts["coalesced"] += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = work(*args)
+        except Exception as error:
+            flight.error = error
+            raise
+        finally:
+            with self._lock:
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+            flight.done.set()
+        return flight.result
+
+    def expire(self, _events: list = None):
+        """Lets the flights in progress finish without taking on more callers"""
+        with self._lock:
+            self._flights.clear()
+
+    def stats(self) -> dict:
+        """Returns the fetches made and the callers coalesced for each kind of read"""
+        with self._lock:
+            return {kind: dict(counts) for kind, counts in self._counts.items()}
+
+
+# The coalesced Order reads of this worker
+order_reads = SingleFlight()
+
+
+def init_singleflight(app):
+    """Coalesces the reads of the app, starting over after each commit"""
+    order_reads.app = app
+    change_listeners.append(order_reads.expire)
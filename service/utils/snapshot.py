@@ -0,0 +1,314 @@
+"""
+Binary Table Snapshots
+
+This module saves tables to a directory of NumPy .npy files, one fixed
+width array per column plus a manifest, and loads them back. Rows travel
+in Postgres' binary COPY format in both directions and are converted
+with vectorized NumPy operations, so no Python object is built per row.
+The files can be memory mapped, so neither saving nor restoring holds a
+whole table in memory
+"""
+import io
+import json
+import struct
+from datetime import datetime
+import numpy as np
+from service.models import db, DataValidationError, append_load
+
+# The version of the snapshot layout written to the manifest
+FORMAT_VERSION = 1
+
+# The name of the file describing a snapshot
+MANIFEST = "manifest.json"
+
+# Binary COPY framing: signature, flags and header extension length, then the end marker
+SIGNATURE = b"PGCOPY\n\xff\r\n\x00"
+HEADER = SIGNATURE + struct.pack(">ii", 0, 0)
+TRAILER = struct.pack(">h", -1)
+
+# Postgres counts timestamps in microseconds from 2000-01-01
+PG_EPOCH_US = 946684800 * 1000000
+
+
+class ColumnSpec:
+    """How a column is stored in a snapshot and sent over COPY"""
+
+    def __init__(self, column):
+        self.column = column
+        self.name = column.name
+        self.nullable = bool(column.nullable) and not column.primary_key
+        self.labels = None
+        if isinstance(column.type, db.Enum):
+            # Stored as the position of the label, sent as the label itself
+            self.kind, self.dtype, self.wire = "enum", "i1", ">i2"
+            self.labels = list(column.type.enums)
+        elif isinstance(column.type, db.BigInteger):
+            self.kind, self.dtype, self.wire = "number", "i8", ">i8"
+        elif isinstance(column.type, db.Integer):
+            self.kind, self.dtype, self.wire = "number", "i4", ">i4"
+        elif isinstance(column.type, db.Float):
+            self.kind, self.dtype, self.wire = "number", "f8", ">f8"
+        elif isinstance(column.type, db.DateTime):
+            self.kind, self.dtype, self.wire = "timestamp", "datetime64[us]", ">i8"
+        else:
+            raise DataValidationError(f"Cannot snapshot column {self.name} of type {column.type}")
+
+    def expression(self):
+        """Returns the SQL selecting the column as a value that is never NULL"""
+        column = self.column
+        if self.kind == "enum":
+            codes = {label: code for code, label in enumerate(self.labels)}
+            column = db.cast(db.case(codes, value=db.cast(column, db.String), else_=0),
+                             db.SmallInteger)
+        elif self.kind == "timestamp" and self.nullable:
+            column = db.func.coalesce(column, db.literal_column("TIMESTAMP '2000-01-01'"))
+        elif self.nullable:
+            column = db.func.coalesce(column, 0)
+        return column
+
+    def manifest(self):
+        """Describes the column for the manifest"""
+        return {"name": self.name, "dtype": self.dtype, "nullable": self.nullable,
+                "labels": self.labels}
+
+
+def column_specs(table):
+    """Returns the ColumnSpec of each column of a table"""
+    return [ColumnSpec(column) for column in table.columns]
+
+
+def wire_dtype(specs: list):
+    """Returns the NumPy layout of a binary COPY row of the columns, each with its NULL flag"""
+    fields = [("fields", ">i2")]
+    for spec in specs:
+        fields += [(f"{spec.name}.length", ">i4"), (spec.name, spec.wire)]
+        if spec.nullable:
+            fields += [(f"{spec.name}.null.length", ">i4"), (f"{spec.name}.null", "?")]
+    return np.dtype(fields)
+
+
+def decode_rows(data: bytes, dtype):
+    """Reads the rows of a binary COPY whose fields all have a fixed width"""
+    if not data.startswith(SIGNATURE):
+        raise DataValidationError("Not a binary COPY stream")
+    start = len(HEADER) + struct.unpack(">i", data[len(SIGNATURE) + 4:len(HEADER)])[0]
+    count = (len(data) - start - len(TRAILER)) // dtype.itemsize
+    return np.frombuffer(data, dtype=dtype, count=count, offset=start)
+
+
+def encode_rows(specs: list, columns: dict, nulls: dict):
+    """
+    Writes rows as a binary COPY stream
+
+    Each row is first laid out at a fixed width, with enum labels padded
+    to the longest label, then the padding bytes and the values of NULLs
+    are dropped with one boolean mask over the whole buffer
+    """
+    count = len(columns[specs[0].name])
+    fields = [("fields", ">i2")]
+    for spec in specs:
+        wire = f"S{max(len(label) for label in spec.labels)}" if spec.labels else spec.wire
+        fields += [(f"{spec.name}.length", ">i4"), (spec.name, wire)]
+    records = np.zeros(count, dtype=fields)
+    records["fields"] = len(specs)
+    keep = np.ones((count, records.dtype.itemsize), dtype=bool)
+    for spec in specs:
+        values = columns[spec.name]
+        offset = records.dtype.fields[spec.name][1]
+        width = records.dtype[spec.name].itemsize
+        lengths = np.full(count, width, dtype=np.int32)
+        if spec.labels:
+            labels = [label.encode() for label in spec.labels]
+            records[spec.name] = np.array(labels)[values]
+            lengths = np.array([len(label) for label in labels], dtype=np.int32)[values]
+        elif spec.kind == "timestamp":
+            records[spec.name] = values.astype("datetime64[us]").view(np.int64) - PG_EPOCH_US
+        else:
+            records[spec.name] = values
+        if spec.name in nulls:
+            lengths = np.where(nulls[spec.name], -1, lengths)
+        records[f"{spec.name}.length"] = lengths
+        keep[:, offset:offset + width] = np.arange(width) < np.maximum(lengths, 0)[:, None]
+    return HEADER + records.view(np.uint8).reshape(count, -1)[keep].tobytes() + TRAILER
+
+
+def open_column(path: str, dtype, count: int):
+    """Creates a .npy file for count values and returns it memory mapped"""
+    if not count:
+        np.save(path, np.empty(0, dtype=dtype))
+        return np.empty(0, dtype=dtype)
+    return np.lib.format.open_memmap(path, mode="w+", dtype=np.dtype(dtype), shape=(count,))
+
+
+def open_columns(directory: str, table, specs: list, count: int):
+    """Creates the .npy files of a table's columns and NULL flags"""
+    files = {}
+    for spec in specs:
+        files[spec.name] = open_column(f"{directory}/{table.name}.{spec.name}.npy", spec.dtype,
+                                       count)
+        if spec.nullable:
+            path = f"{directory}/{table.name}.{spec.name}.null.npy"
+            files[f"{spec.name}.null"] = open_column(path, "?", count)
+    return files
+
+
+def copy_out(connection, query, dtype):
+    """Runs a query with a binary COPY and returns its rows"""
+    sql = query.compile(dialect=connection.dialect, compile_kwargs={"literal_binds": True})
+    buffer = io.BytesIO()
+    with connection.connection.cursor() as cursor:
+        cursor.copy_expert(f"COPY ({sql}) TO STDOUT WITH (FORMAT binary)", buffer)
+    return decode_rows(buffer.getvalue(), dtype)
+
+
+def save_table(connection, table, directory, chunk_rows: int):
+    """
+    Saves a table into the directory, chunk_rows rows per COPY
+
+    :return: the manifest entry of the table
+    """
+    specs = column_specs(table)
+    wire = wire_dtype(specs)
+    count = connection.execute(db.select([db.func.count()]).select_from(table)).scalar()
+    files = open_columns(directory, table, specs, count)
+    expressions = []
+    for spec in specs:
+        expressions.append(spec.expression())
+        if spec.nullable:
+            expressions.append(spec.column.is_(None))
+
+    position = 0
+    query = db.select(expressions).order_by(table.c.id).limit(chunk_rows)
+    while position < count:
+        rows = copy_out(connection, query, wire)[:count - position]
+        if not len(rows):
+            break
+        for spec in specs:
+            values = rows[spec.name]
+            if spec.kind == "timestamp":
+                values = (values.astype(np.int64) + PG_EPOCH_US).view("datetime64[us]")
+            files[spec.name][position:position + len(rows)] = values
+            if spec.nullable:
+                nulls = rows[f"{spec.name}.null"]
+                files[f"{spec.name}.null"][position:position + len(rows)] = nulls
+        position += len(rows)
+        # Keyset pagination, each chunk starts after the last id of the one before
+        query = db.select(expressions).where(table.c.id > int(rows["id"][-1]))
+        query = query.order_by(table.c.id).limit(chunk_rows)
+    for values in files.values():
+        if isinstance(values, np.memmap):
+            values.flush()
+    return {"rows": position, "columns": [spec.manifest() for spec in specs]}
+
+
+def save_snapshot(directory: str, tables: list, chunk_rows: int = 100000):
+    """
+    Saves tables into a directory as one .npy file per column
+
+    The tables are read in one REPEATABLE READ transaction, so they are
+    consistent with each other even while Orders are being written
+
+    :return: the manifest of the snapshot
+    """
+    db.session.commit()
+    connection = db.session.connection(execution_options={"isolation_level": "REPEATABLE READ"})
+    manifest = {"version": FORMAT_VERSION, "created": datetime.now().isoformat(), "tables": {}}
+    for table in tables:
+        manifest["tables"][table.name] = save_table(connection, table, directory, chunk_rows)
+    db.session.commit()
+    with open(f"{directory}/{MANIFEST}", "w", encoding="utf-8") as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    return manifest
+
+
+def read_manifest(directory: str, tables: list):
+    """Returns the manifest of a snapshot after checking it matches the tables"""
+    with open(f"{directory}/{MANIFEST}", encoding="utf-8") as manifest_file:
+        manifest = json.load(manifest_file)
+    if manifest.get("version") != FORMAT_VERSION:
+        raise DataValidationError(f"Unsupported snapshot version {manifest.get('version')}")
+    for table in tables:
+        entry = manifest["tables"].get(table.name)
+        expected = [spec.manifest() for spec in column_specs(table)]
+        if entry is None or entry["columns"] != expected:
+            raise DataValidationError(
+                f"The snapshot of table {table.name} does not match its schema"
+            )
+    return manifest
+
+
+def restore_table(connection, table, directory: str, rows: int, chunk_rows: int):
+    """Loads the saved columns of a table with one binary COPY per chunk_rows rows"""
+    specs = column_specs(table)
+    columns = {spec.name: np.load(f"{directory}/{table.name}.{spec.name}.npy", mmap_mode="r")
+               for spec in specs}
+    nulls = {spec.name: np.load(f"{directory}/{table.name}.{spec.name}.null.npy", mmap_mode="r")
+             for spec in specs if spec.nullable}
+    names = ", ".join(f'"{spec.name}"' for spec in specs)
+    for start in range(0, rows, chunk_rows):
+        chunk = slice(start, start + chunk_rows)
+        data = encode_rows(specs, {name: values[chunk] for name, values in columns.items()},
+                           {name: values[chunk] for name, values in nulls.items()})
+        with connection.connection.cursor() as cursor:
+            cursor.copy_expert(f'COPY "{table.name}" ({names}) FROM STDIN WITH (FORMAT binary)',
+                               io.BytesIO(data))
+
+
+def drop_secondary(connection, table):
+    """
+    Drops the foreign keys and secondary indexes of a table
+
+    :return: the statements creating them again
+    """
+    keys = connection.execute(db.text(
+        "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+        "WHERE conrelid = CAST(:table AS regclass) AND contype = 'f'"
+    ), {"table": f'"{table.name}"'}).fetchall()
+    indexes = connection.execute(db.text(
+        "SELECT index.relname, pg_get_indexdef(index.oid) FROM pg_index "
+        "JOIN pg_class index ON index.oid = pg_index.indexrelid "
+        "WHERE pg_index.indrelid = CAST(:table AS regclass) AND NOT EXISTS "
+        "(SELECT 1 FROM pg_constraint WHERE pg_constraint.conindid = pg_index.indexrelid)"
+    ), {"table": f'"{table.name}"'}).fetchall()
+    for name, _ in keys:
+        connection.execute(db.text(f'ALTER TABLE "{table.name}" DROP CONSTRAINT "{name}"'))
+    for name, _ in indexes:
+        connection.execute(db.text(f'DROP INDEX "{name}"'))
+    return [definition for _, definition in indexes] + [
+        f'ALTER TABLE "{table.name}" ADD CONSTRAINT "{name}" {definition}'
+        for name, definition in keys
+    ]
+
+
+def restore_snapshot(directory: str, tables: list, chunk_rows: int = 100000):
+    """
+    Replaces the rows of tables with those saved in a directory
+
+    The tables are emptied and reloaded in one transaction, parents
+    first, and their id sequences are moved past the restored ids. Like
+    pg_restore, foreign keys and secondary indexes are dropped during the
+    load and built again once at the end, which is much cheaper than
+    checking and indexing row by row. Restored rows are not written to
+    the change feed, which gets a single load change instead
+
+    :return: the manifest of the snapshot
+    """
+    manifest = read_manifest(directory, tables)
+    connection = db.session.connection()
+    connection.execute(db.text("TRUNCATE " + ", ".join(f'"{table.name}"' for table in tables)))
+    rebuild = [statement for table in tables for statement in drop_secondary(connection, table)]
+    for table in tables:
+        rows = manifest["tables"][table.name]["rows"]
+        restore_table(connection, table, directory, rows, chunk_rows)
+        # Never move a sequence back, other workers may still hold blocks of ids from it
+        connection.execute(db.text(
+            f"SELECT setval(pg_get_serial_sequence(:table, 'id'), GREATEST("
+            f"(SELECT COALESCE(MAX(id), 0) FROM \"{table.name}\"), "
+            f"COALESCE(pg_sequence_last_value("
+            f"pg_get_serial_sequence(:table, 'id')::regclass), 0), 1))"
+        ), {"table": f'"{table.name}"'})
+    for statement in rebuild:
+        connection.execute(db.text(statement))
+    append_load(db.session)
+    db.session.commit()
+    return manifest
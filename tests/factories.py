@@ -3,8 +3,7 @@ Test Factory to make fake objects for testing
 """
 
 import factory
-import random
-from factory.fuzzy import FuzzyChoice
+from factory.fuzzy import FuzzyChoice, FuzzyInteger, FuzzyFloat
 from service.models import Order, Item, OrderStatus
 
 
@@ -15,8 +14,8 @@ class OrderFactory(factory.Factory):
         model = Order
 
     id = factory.Sequence(lambda n: n)
-    customer_id = random.randint(0, 10000000)
-    tracking_id = random.randint(0, 10000000)
+    customer_id = FuzzyInteger(0, 10000000)
+    tracking_id = FuzzyInteger(0, 10000000)
     status = FuzzyChoice(OrderStatus)
 
     @factory.post_generation
@@ -36,7 +35,7 @@ class ItemFactory(factory.Factory):
 
     id = factory.Sequence(lambda n: n)
     order_id = None
-    product_id = random.randint(0, 100000)
-    quantity = random.randint(0, 100000)
-    price = random.uniform(0, 100000)
+    product_id = FuzzyInteger(0, 100000)
+    quantity = FuzzyInteger(0, 100000)
+    price = FuzzyFloat(0, 100000)
     order = factory.SubFactory(OrderFactory)
@@ -0,0 +1,53 @@
+"""
+Test cases for Admission Control
+"""
+import time
+import threading
+from unittest import TestCase
+from service.utils.admission import AdmissionGate, TokenBucket, RateLimiter
+
+
+class TestAdmissionGate(TestCase):
+    """Test Cases for the AdmissionGate"""
+
+    def test_wait_for_slot(self):
+        """It should admit a waiting request once a slot is given back"""
+        gate = AdmissionGate("read", 1, max_waiting=1)
+        self.assertTrue(gate.acquire(0))
+        threading.Timer(0.05, gate.release).start()
+        self.assertTrue(gate.acquire(5))
+        self.assertEqual(gate.stats(), {"slots": 1, "in_flight": 1, "waiting": 0, "admitted": 2, "shed": 0})
+
+    def test_shed(self):
+        """It should shed requests that wait too long or find too many waiting"""
+        gate = AdmissionGate("write", 1, max_waiting=0)
+        self.assertTrue(gate.acquire(0))
+        self.assertFalse(gate.acquire(5))
+        gate.max_waiting = 1
+        started = time.monotonic()
+        self.assertFalse(gate.acquire(0.05))
+        self.assertGreaterEqual(time.monotonic() - started, 0.05)
+        self.assertEqual(gate.stats()["shed"], 2)
+
+
+class TestRateLimiter(TestCase):
+    """Test Cases for the token buckets"""
+
+    def test_token_bucket(self):
+        """It should allow a burst and then refill at the rate"""
+        bucket = TokenBucket(rate=100, burst=2)
+        self.assertEqual(bucket.take(), 0)
+        self.assertEqual(bucket.take(), 0)
+        self.assertGreater(bucket.take(), 0)
+        time.sleep(0.02)
+        self.assertEqual(bucket.take(), 0)
+
+    def test_forget_clients(self):
+        """It should only keep the buckets of the latest clients"""
+        limiter = RateLimiter(rate=0.1, burst=1, max_clients=2)
+        self.assertEqual(limiter.take("a"), 0)
+        self.assertGreater(limiter.take("a"), 0)
+        limiter.take("b")
+        limiter.take("c")
+        self.assertEqual(limiter.take("a"), 0)
+        self.assertEqual(limiter.limited, 1)
@@ -0,0 +1,65 @@
+"""
+Test cases for Response Compression
+"""
+import gzip
+import json
+from unittest import TestCase
+from unittest.mock import patch
+from flask import Response
+from service import app
+from service.utils.compression import compress_response, compression_stats
+
+
+class TestCompression(TestCase):
+    """Test Cases for compressing responses"""
+
+    def setUp(self):
+        self.body = json.dumps([{"id": number, "status": "PLACED"} for number in range(100)])
+
+    def _compress(self, response, accept="gzip, deflate"):
+        """Runs a response through compression for a request accepting the given encodings"""
+        with app.test_request_context("/api/orders", headers={"Accept-Encoding": accept}):
+            return compress_response(response)
+
+    def test_gzip(self):
+        """It should gzip a large JSON response the client accepts gzipped"""
+        before = compression_stats.stats().get("gzip", {"responses": 0})
+        response = self._compress(Response(self.body, mimetype="application/json"))
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        self.assertIn("Accept-Encoding", response.headers["Vary"])
+        self.assertTrue(response.headers["Server-Timing"].startswith("compress;dur="))
+        self.assertEqual(gzip.decompress(response.get_data()).decode(), self.body)
+        self.assertLess(int(response.headers["Content-Length"]), len(self.body))
+        self.assertEqual(compression_stats.stats()["gzip"]["responses"], before["responses"] + 1)
+
+    def test_not_compressed(self):
+        """It should leave small, unaccepted and event stream responses as they are"""
+        response = self._compress(Response('{"id": 1}', mimetype="application/json"))
+        self.assertNotIn("Content-Encoding", response.headers)
+        response = self._compress(Response(self.body, mimetype="application/json"), accept="identity")
+        self.assertNotIn("Content-Encoding", response.headers)
+        response = self._compress(Response(self.body, mimetype="application/json"), accept="gzip;q=0")
+        self.assertNotIn("Content-Encoding", response.headers)
+        response = self._compress(Response(iter([self.body]), mimetype="text/event-stream"))
+        self.assertNotIn("Content-Encoding", response.headers)
+        with patch.dict(app.config, {"COMPRESSION_ENABLED": False}):
+            response = self._compress(Response(self.body, mimetype="application/json"))
+        self.assertNotIn("Content-Encoding", response.headers)
+
+    def test_streamed(self):
+        """It should compress a streamed response chunk by chunk"""
+        chunks = [self.body[:500], self.body[500:]]
+        response = self._compress(Response(iter(chunks), mimetype="text/csv"))
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        self.assertNotIn("Content-Length", response.headers)
+        self.assertEqual(gzip.decompress(b"".join(response.response)).decode(), self.body)
+
+    def test_level(self):
+        """It should compress at the configured level"""
+        sizes = []
+        for level in (0, 6):
+            with patch.dict(app.config, {"COMPRESSION_LEVEL": level}):
+                response = self._compress(Response(self.body, mimetype="application/json"))
+            sizes.append(len(response.get_data()))
+        self.assertGreater(sizes[0], len(self.body))
+        self.assertLess(sizes[1], len(self.body) / 4)
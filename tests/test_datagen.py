@@ -0,0 +1,33 @@
+"""
+Test cases for the Synthetic Order Data generator
+"""
+from collections import Counter
+from unittest import TestCase
+from service.utils.datagen import GeneratorSettings, generate_chunk, parse_status_mix, product_price
+
+
+class TestDataGenerator(TestCase):
+    """Test Cases for generating Orders"""
+
+    def test_parse_status_mix(self):
+        """It should parse a status mix"""
+        self.assertEqual(parse_status_mix("placed=1, DELIVERED=3.5"), {"PLACED": 1.0, "DELIVERED": 3.5})
+
+    def test_generate_chunk(self):
+        """It should generate a reproducible skewed chunk of Orders"""
+        settings = GeneratorSettings(customers=1000, products=100, zipf=1.2, items_mean=2,
+                                     status_mix={"PLACED": 1, "DELIVERED": 3}, seed=7)
+        orders = generate_chunk(settings, 1, 4, 2000)
+        self.assertEqual(orders, generate_chunk(settings, 1, 4, 2000))
+        self.assertEqual(len(orders), 2000)
+
+        times = [order[2] for order in orders]
+        self.assertEqual(times, sorted(times))
+        customers = Counter(order[0] for order in orders)
+        self.assertTrue(all(1 <= customer <= 1000 for customer in customers))
+        # the most popular customer places far more than an even share of the Orders
+        self.assertGreater(customers.most_common(1)[0][1], 10 * 2000 / 1000)
+        self.assertEqual(set(order[3] for order in orders), {"PLACED", "DELIVERED"})
+        items = [item for order in orders for item in order[4]]
+        self.assertTrue(all(order[4] for order in orders))
+        self.assertTrue(all(price == product_price(product) for product, _, price in items))
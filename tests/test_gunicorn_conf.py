@@ -0,0 +1,49 @@
+"""
+Test cases for the Gunicorn Configuration
+"""
+import os
+import runpy
+import tempfile
+from unittest import TestCase
+
+CONFIG = runpy.run_path(os.path.join(os.path.dirname(__file__), "..", "gunicorn.conf.py"))
+
+
+class TestGunicornConf(TestCase):
+    """Test Cases for sizing the workers"""
+
+    def test_cgroup_quota(self):
+        """It should read the CPU quota of cgroup v2 and v1"""
+        with tempfile.TemporaryDirectory() as root:
+            self.assertIsNone(CONFIG["cgroup_quota"](root))
+            os.mkdir(os.path.join(root, "cpu"))
+            for name, value in (("cpu.cfs_quota_us", "150000"), ("cpu.cfs_period_us", "100000")):
+                with open(os.path.join(root, "cpu", name), "w", encoding="utf-8") as limit:
+                    limit.write(value)
+            self.assertEqual(CONFIG["cgroup_quota"](root), 1.5)
+            with open(os.path.join(root, "cpu.max"), "w", encoding="utf-8") as limit:
+                limit.write("max 100000\n")
+            self.assertIsNone(CONFIG["cgroup_quota"](root))
+            with open(os.path.join(root, "cpu.max"), "w", encoding="utf-8") as limit:
+                limit.write("20000 100000\n")
+            self.assertEqual(CONFIG["cgroup_quota"](root), 0.2)
+            self.assertEqual(CONFIG["cpu_limit"](root), 1)
+
+    def test_size_workers(self):
+        """It should size workers from the CPUs and threads from the pool and the streams"""
+        size_workers = CONFIG["size_workers"]
+        self.assertEqual(size_workers({}, cpus=4), ("gthread", 4, 16))
+        self.assertEqual(size_workers({"DB_POOL_SIZE": "5", "DB_POOL_OVERFLOW": "0"}, cpus=1), ("gthread", 2, 9))
+        self.assertEqual(size_workers({"GUNICORN_STREAM_THREADS": "0", "GROUP_COMMIT_ENABLED": "true"}, cpus=2),
+                         ("gthread", 2, 11))
+        self.assertEqual(size_workers({"GUNICORN_WORKER_CLASS": "sync"}, cpus=2), ("sync", 5, 1))
+        self.assertEqual(size_workers({"GUNICORN_WORKERS": "3", "GUNICORN_THREADS": "4"}, cpus=8), ("gthread", 3, 4))
+
+    def test_size_workers_to_connections(self):
+        """It should keep the connections of all workers within DB_MAX_CONNECTIONS"""
+        size_workers = CONFIG["size_workers"]
+        self.assertEqual(size_workers({"DB_MAX_CONNECTIONS": "30"}, cpus=8), ("gthread", 2, 16))
+        self.assertEqual(size_workers({"DB_MAX_CONNECTIONS": "38", "ORDER_EVENTS_NOTIFY": "true"}, cpus=8),
+                         ("gthread", 2, 16))
+        self.assertEqual(size_workers({"DB_MAX_CONNECTIONS": "12"}, cpus=8), ("gthread", 1, 16))
+        self.assertRaises(ValueError, size_workers, {"DB_MAX_CONNECTIONS": "12", "ORDER_EVENTS_NOTIFY": "true"}, cpus=8)
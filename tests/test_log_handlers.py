@@ -0,0 +1,104 @@
+"""
+Test cases for Log Handlers
+"""
+import json
+import logging
+from unittest import TestCase
+from flask import Flask
+from service.utils.log_handlers import (
+    init_logging, parse_sample_rates, BackgroundHandler, JsonFormatter, SamplingFilter
+)
+
+
+class ListHandler(logging.Handler):
+    """Keeps the formatted records it handles"""
+
+    def __init__(self):
+        super().__init__()
+        self.lines = []
+
+    def emit(self, record):
+        self.lines.append(self.format(record))
+
+
+class TestLogHandlers(TestCase):
+    """Test Cases for setting up logging"""
+
+    def setUp(self):
+        self.app = Flask("log-test")
+        self.handler = ListHandler()
+        self.server_logger = logging.getLogger("log-test.server")
+        self.server_logger.handlers = [self.handler]
+        self.server_logger.setLevel(logging.INFO)
+
+    def tearDown(self):
+        for handler in self.app.logger.handlers:
+            if isinstance(handler, BackgroundHandler):
+                handler.stop()
+        self.server_logger.handlers = []
+
+    def test_text_lines(self):
+        """It should write text lines through the server handlers"""
+        init_logging(self.app, "log-test.server")
+        self.app.logger.info("Order %d created", 7)
+        self.app.logger.debug("Payload = %s", {})
+        self.assertEqual(len(self.handler.lines), 2)
+        self.assertTrue(self.handler.lines[1].endswith("[INFO] [test_log_handlers] Order 7 created"))
+
+    def test_json_lines_from_background(self):
+        """It should write JSON lines from the listener thread"""
+        self.app.config.update(LOG_FORMAT="json", LOG_QUEUE_ENABLED=True)
+        init_logging(self.app, "log-test.server")
+        background = self.app.logger.handlers[0]
+        self.assertIsInstance(background, BackgroundHandler)
+        try:
+            raise ValueError("bad data")
+        except ValueError:
+            self.app.logger.exception("Order %s failed", "abc")
+        background.stop()
+        entry = json.loads(self.handler.lines[-1])
+        self.assertEqual(entry["level"], "ERROR")
+        self.assertEqual(entry["message"], "Order abc failed")
+        self.assertIn("ValueError: bad data", entry["exception"])
+
+    def test_full_queue(self):
+        """It should drop records rather than wait for a full queue"""
+        background = BackgroundHandler([self.handler], maxsize=1)
+        background.stop()
+        logger = logging.getLogger("log-test.full")
+        logger.propagate = False
+        logger.handlers = [background]
+        logger.warning("one")
+        logger.warning("two")
+        self.assertEqual(background.dropped, 1)
+
+    def test_sampling(self):
+        """It should keep one in every 1 / rate records of a sampled level"""
+        self.app.config["LOG_SAMPLE_RATES"] = "INFO=0.25"
+        init_logging(self.app, "log-test.server")
+        for number in range(8):
+            self.app.logger.info("Request %d", number)
+            self.app.logger.warning("Slow request %d", number)
+        lines = self.handler.lines[1:]
+        self.assertEqual(sum("[INFO]" in line for line in lines), 2)
+        self.assertEqual(sum("[WARNING]" in line for line in lines), 8)
+
+    def test_sampling_drops_level(self):
+        """It should drop every record of a level with a rate of 0"""
+        sampler = SamplingFilter(parse_sample_rates("debug=0, INFO=1"))
+        record = logging.LogRecord("test", logging.DEBUG, __file__, 1, "Payload", None, None)
+        self.assertFalse(sampler.filter(record))
+        record.levelno = logging.INFO
+        self.assertTrue(sampler.filter(record))
+
+    def test_parse_sample_rates(self):
+        """It should not accept unknown levels"""
+        self.assertEqual(parse_sample_rates(""), {})
+        self.assertEqual(parse_sample_rates("INFO=0.1"), {logging.INFO: 0.1})
+        self.assertRaises(ValueError, parse_sample_rates, "LOUD=0.1")
+
+    def test_json_formatter(self):
+        """It should merge the arguments into the message"""
+        record = logging.LogRecord("test", logging.INFO, __file__, 1, "Order %s", ("abc",), None)
+        entry = json.loads(JsonFormatter().format(record))
+        self.assertEqual((entry["logger"], entry["message"]), ("test", "Order abc"))
@@ -4,8 +4,13 @@ Test cases for Order Model
 import os
 import logging
 import unittest
-from service import app
-from service.models import Order, Item, DataValidationError, db, OrderStatus
+from datetime import datetime, timedelta, timezone
+from unittest.mock import patch
+from sqlalchemy.exc import OperationalError
+from service import app, models
+from service.models import Order, Item, DataValidationError, db, OrderStatus, IdAllocator
+from service.models import DatabaseUnavailableError, CustomerOrderSummary, SUMMARY_SLICES, connect_db
+from service.models import ArchivedOrder
 from tests.factories import OrderFactory, ItemFactory
 
 DATABASE_URI = os.getenv(
@@ -46,6 +51,7 @@ class TestOrder(unittest.TestCase):
     def setUp(self):
         """ This runs before each test """
         db.session.query(Order).delete()  # clean up the last tests
+        db.session.query(ArchivedOrder).delete()
         db.session.commit()
 
     def tearDown(self):
@@ -166,6 +172,191 @@ class TestOrder(unittest.TestCase):
         order_list = [order for order in orders]
         self.assertEqual(len(order_list), 1)
 
+    def test_find_by_many_items(self):
+        """It should Find a page of the Orders with any of the items, once each"""
+        Order.bulk_create([
+            Order(customer_id=customer_id, status=OrderStatus.PLACED,
+                  order_items=[_make_item(id=None, product_id=product_id) for product_id in product_ids])
+            for customer_id, product_ids in ((1, [8, 9, 9]), (2, [9]), (3, [7]), (4, [8]))
+        ])
+        orders = Order.find_by_item([8, 9]).all()
+        self.assertEqual([order.customer_id for order in orders], [1, 2, 4])
+        page = Order.find_by_item([8, 9], after=orders[0].id, limit=1).all()
+        self.assertEqual([order.id for order in page], [orders[1].id])
+        page = Order.find_by_item([9, 8, 6], limit=2).all()
+        self.assertEqual([order.customer_id for order in page], [1, 2])
+        page = Order.find_by_item([9, 8], after=orders[1].id, limit=2).all()
+        self.assertEqual([order.customer_id for order in page], [4])
+
+    def test_created_time(self):
+        """It should stamp new Orders with the time of the database"""
+        before = models.server_now()
+        order = Order(customer_id=3, status=OrderStatus.PLACED)
+        order.create()
+        self.assertGreaterEqual(Order.find(order.id).created_time, before)
+        found = Order.created_between(Order.query, before).all()
+        self.assertEqual([found_order.id for found_order in found], [order.id])
+        self.assertEqual(Order.created_between(Order.query, created_before=before).count(), 0)
+
+    def test_local_time_of_database(self):
+        """It should turn times with a time zone into the local time of the database"""
+        db.session.execute(db.text("SET LOCAL TIME ZONE 'Pacific/Kiritimati'"))
+        noon = datetime(2022, 7, 4, 12, tzinfo=timezone.utc)
+        self.assertEqual(models.local_time(noon), datetime(2022, 7, 5, 2))
+        self.assertEqual(models.local_time(datetime(2022, 7, 4, 12)), datetime(2022, 7, 4, 12))
+        db.session.rollback()
+
+    def test_upgrade_schema(self):
+        """It should add the indexes and defaults an existing table lacks"""
+        with db.engine.begin() as connection:
+            connection.execute(db.text("DROP INDEX ix_order_created_time"))
+            connection.execute(db.text('ALTER TABLE "order" ALTER COLUMN created_time DROP DEFAULT'))
+        models.upgrade_schema()
+        inspector = db.inspect(db.engine)
+        self.assertIn("ix_order_created_time", {index["name"] for index in inspector.get_indexes("order")})
+        defaults = {column["name"]: column["default"] for column in inspector.get_columns("order")}
+        self.assertEqual(defaults["created_time"], "now()")
+        models.upgrade_schema()
+
+    def test_find_many_orders(self):
+        """It should Find many Orders with their Items loaded"""
+        orders = OrderFactory.create_batch(3)
+        orders[0].order_items.append(ItemFactory())
+        for order in orders:
+            order.create()
+        db.session.expire_all()
+        found = Order.find_many([orders[0].id, orders[2].id, 0])
+        self.assertEqual(sorted(order.id for order in found), sorted([orders[0].id, orders[2].id]))
+        for order in found:
+            self.assertNotIn("order_items", db.inspect(order).unloaded)
+
+    def test_allocate_ids(self):
+        """It should allocate unused ids in blocks"""
+        allocator = IdAllocator("order", block_size=3)
+        ids = allocator.allocate(2) + allocator.allocate(5) + allocator.allocate()
+        self.assertEqual(len(set(ids)), 8)
+        self.assertEqual(ids, sorted(ids))
+        order = OrderFactory()
+        order.create()
+        self.assertNotIn(order.id, ids)
+
+    def test_bulk_create_orders(self):
+        """It should Create many Orders with their Items at once"""
+        orders = OrderFactory.create_batch(3)
+        orders[0].order_items = [_make_item(id=None), _make_item(id=None, product_id=9)]
+        orders[2].order_items = [_make_item(id=None)]
+        Order.bulk_create(orders)
+        self.assertEqual(len({order.id for order in orders}), 3)
+        found = Order.find(orders[0].id)
+        self.assertEqual(found.customer_id, orders[0].customer_id)
+        self.assertEqual(sorted(item.product_id for item in found.order_items), [TEST_PRODUCT_ID, 9])
+        self.assertEqual(len(Order.find(orders[1].id).order_items), 0)
+        self.assertEqual(Order.find(orders[2].id).order_items[0].order_id, orders[2].id)
+        self.assertEqual(len(Order.all()), 3)
+
+    def test_bulk_create_without_status(self):
+        """It should Create many Orders without a status as PLACED"""
+        order = OrderFactory(status=None)
+        Order.bulk_create([order])
+        self.assertEqual(Order.find(order.id).status, OrderStatus.PLACED)
+
+    def test_change_scopes(self):
+        """It should tell the listeners which filtered lists each change alters"""
+        published = []
+        models.change_listeners.append(published.extend)
+        self.addCleanup(models.change_listeners.remove, published.extend)
+        order = OrderFactory(customer_id=7, status=OrderStatus.PLACED)
+        order.order_items = [_make_item(id=None)]
+        Order.bulk_create([order])
+        self.assertEqual([event["scope"]["product_id"] for event in published], [[TEST_PRODUCT_ID]] * 2)
+        self.assertEqual(published[1]["scope"]["customer_id"], [7])
+
+        published.clear()
+        order = Order.find(order.id)
+        order.status = OrderStatus.PAID
+        order.customer_id = 8
+        order.update()
+        scope = published[0]["scope"]
+        self.assertEqual((scope["customer_id"], scope["status"]), ([7, 8], ["PAID", "PLACED"]))
+        self.assertEqual(scope["product_id"], [TEST_PRODUCT_ID])
+
+        published.clear()
+        order.order_items[0].product_id = 9
+        order.update()
+        self.assertEqual(published[0]["scope"],
+                         {"customer_id": [8], "status": ["PAID"], "product_id": [TEST_PRODUCT_ID, 9]})
+
+    def test_customer_summary(self):
+        """It should keep the Orders and spend of each customer up to date"""
+        db.session.query(CustomerOrderSummary).delete()
+        order = Order(customer_id=5, status=OrderStatus.PLACED, order_items=[_make_item(id=None)])
+        order.create()
+        summary = CustomerOrderSummary.find_by_customer(5)
+        self.assertEqual((summary["orders"], summary["orders_by_status"]["PLACED"], summary["spend"]), (1, 1, 42))
+
+        order.order_items.append(_make_item(id=None, quantity=1, price=8))
+        order.status = OrderStatus.PAID
+        order.update()
+        summary = CustomerOrderSummary.find_by_customer(5)
+        self.assertEqual(summary["orders_by_status"], dict.fromkeys(OrderStatus._member_names_, 0) | {"PAID": 1})
+        self.assertEqual(summary["spend"], 50)
+
+        order.order_items[0].delete()
+        order.status = OrderStatus.CANCELLED
+        order.update()
+        summary = CustomerOrderSummary.find_by_customer(5)
+        self.assertEqual((summary["orders_by_status"]["CANCELLED"], summary["spend"]), (1, 0))
+
+        Order.bulk_create([Order(customer_id=5, status=OrderStatus.PAID, order_items=[_make_item(id=None)])])
+        order.customer_id = 6
+        order.update()
+        self.assertEqual(CustomerOrderSummary.find_by_customer(6)["orders"], 1)
+        expected = CustomerOrderSummary.find_by_customer(5)
+        self.assertEqual((expected["orders"], expected["spend"]), (1, 42))
+
+        order.delete()
+        self.assertEqual(CustomerOrderSummary.find_by_customer(6)["orders"], 0)
+        for part in range(SUMMARY_SLICES):
+            CustomerOrderSummary.rebuild(part)
+        db.session.commit()
+        self.assertEqual(CustomerOrderSummary.find_by_customer(5), expected)
+
+    def test_archive_orders(self):
+        """It should move old delivered and cancelled Orders with their Items to the archive"""
+        db.session.query(CustomerOrderSummary).delete()
+        now = models.server_now()
+        old, recent, placed, cancelled = Order.bulk_create([
+            Order(customer_id=9, status=OrderStatus.DELIVERED, created_time=now - timedelta(days=days),
+                  order_items=[_make_item(id=None)])
+            for days in (40, 1, 40, 50)
+        ])
+        Order.find(placed.id).status = OrderStatus.PLACED
+        Order.find(cancelled.id).status = OrderStatus.CANCELLED
+        db.session.commit()
+        expected = CustomerOrderSummary.find_by_customer(9)
+        published = []
+        models.change_listeners.append(published.extend)
+        self.addCleanup(models.change_listeners.remove, published.extend)
+
+        cutoff = now - timedelta(days=30)
+        self.assertEqual(ArchivedOrder.archive(db.session, cutoff, batch_size=1), (1, 1))
+        self.assertEqual(ArchivedOrder.archive(db.session, cutoff, batch_size=1), (1, 1))
+        self.assertEqual(ArchivedOrder.archive(db.session, cutoff, batch_size=1), (0, 0))
+        db.session.commit()
+        self.assertEqual(sorted(order.id for order in Order.all()), sorted([recent.id, placed.id]))
+        self.assertEqual(Item.query.filter(Item.order_id.in_([old.id, cancelled.id])).count(), 0)
+        self.assertEqual([(event["action"], event["order_id"]) for event in published],
+                         [("archive", old.id), ("archive", cancelled.id)])
+        self.assertEqual(published[0]["scope"]["product_id"], [TEST_PRODUCT_ID])
+
+        archived = ArchivedOrder.find(old.id).serialize(items_limit=0)
+        self.assertEqual((archived["status"], archived["order_items"], archived["items_count"]), ("DELIVERED", [], 1))
+        self.assertEqual(ArchivedOrder.find(cancelled.id).serialize()["order_items"][0]["order_id"], cancelled.id)
+        self.assertEqual(CustomerOrderSummary.find_by_customer(9), expected)
+        CustomerOrderSummary.rebuild(9 % SUMMARY_SLICES)
+        db.session.commit()
+        self.assertEqual(CustomerOrderSummary.find_by_customer(9), expected)
+
     def test_serialize_an_order(self):
         """It should Serialize an Order"""
         order = OrderFactory()
@@ -312,3 +503,38 @@ class TestOrder(unittest.TestCase):
         # Fetch it back again
         order = Order.find(order.id)
         self.assertEqual(len(order.order_items), 0)
+
+
+######################################################################
+#  D A T A B A S E   C O N N E C T I O N   T E S T   C A S E S
+######################################################################
+
+
+class TestConnectDb(unittest.TestCase):
+    """ Test Cases for connecting to the database lazily """
+
+    def setUp(self):
+        models._database_ready.clear()
+
+    def tearDown(self):
+        models._database_ready.set()
+
+    @patch("service.models.time.sleep")
+    def test_connect_retries(self, sleep_mock):
+        """It should retry with backoff until the database answers"""
+        with patch.object(db.engine, "connect", side_effect=[
+            OperationalError("SELECT 1", {}, Exception("down")), db.engine.connect()
+        ]) as connect_mock:
+            connect_db(retries=3, backoff=0.5)
+            connect_db(retries=3, backoff=0.5)
+        self.assertEqual(connect_mock.call_count, 2)
+        sleep_mock.assert_called_once_with(0.5)
+
+    @patch("service.models.time.sleep")
+    def test_connect_gives_up(self, sleep_mock):
+        """It should give up after the given number of retries"""
+        error = OperationalError("SELECT 1", {}, Exception("down"))
+        with patch.object(db.engine, "connect", side_effect=error):
+            self.assertRaises(DatabaseUnavailableError, connect_db, 2, 0.5)
+        self.assertEqual([call.args[0] for call in sleep_mock.call_args_list], [0.5, 1.0])
+        self.assertFalse(models._database_ready.is_set())
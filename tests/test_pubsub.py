@@ -0,0 +1,50 @@
+"""
+Test cases for the Order Event Broker
+"""
+from unittest import TestCase
+from service.utils.pubsub import Broker, SUBSCRIPTION_BACKLOG
+
+
+def _make_event(order_id=1, customer_id=2, status="PAID"):
+    """Create a change event"""
+    return {"order_id": order_id, "item_id": None, "customer_id": customer_id,
+            "action": "update", "status": status, "previous_status": "PLACED"}
+
+
+class TestBroker(TestCase):
+    """Test Cases for the Broker"""
+
+    def setUp(self):
+        self.broker = Broker()
+
+    def test_publish_to_matching_subscriptions(self):
+        """It should deliver events only to matching subscriptions"""
+        by_order = self.broker.subscribe(order_id=1)
+        by_customer = self.broker.subscribe(customer_id=3)
+        self.broker.publish([_make_event(order_id=1, customer_id=2), _make_event(order_id=5, customer_id=3)])
+        self.assertEqual(by_order.get(0)["order_id"], 1)
+        self.assertIsNone(by_order.get(0))
+        self.assertEqual(by_customer.get(0)["order_id"], 5)
+        self.assertIsNone(by_customer.get(0))
+
+    def test_unsubscribe(self):
+        """It should stop delivering events once a subscription is closed"""
+        with self.broker.subscribe(order_id=1) as subscription:
+            pass
+        self.broker.publish([_make_event()])
+        self.assertIsNone(subscription.get(0))
+
+    def test_drop_events_for_slow_subscriber(self):
+        """It should drop events a subscriber has no room for"""
+        subscription = self.broker.subscribe(order_id=1)
+        self.broker.publish([_make_event()] * (SUBSCRIPTION_BACKLOG + 5))
+        self.assertEqual(subscription.events.qsize(), SUBSCRIPTION_BACKLOG)
+
+    def test_receive_notified_events(self):
+        """It should hand NOTIFYed events to the listeners and the subscriptions"""
+        received = []
+        self.broker.listeners.append(received.extend)
+        subscription = self.broker.subscribe(order_id=1)
+        self.broker.receive([_make_event()])
+        self.assertEqual(received, [_make_event()])
+        self.assertEqual(subscription.get(0), _make_event())
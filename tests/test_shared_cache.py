@@ -0,0 +1,106 @@
+"""
+Test cases for the Shared Cache
+"""
+import os
+import time
+import tempfile
+import multiprocessing
+from unittest import TestCase
+from service.utils.shared_cache import SharedCache, SLOT_SIZES, WAYS, order_dependencies
+
+
+def _store(path: str, size: int):
+    """Caches a value from another process"""
+    cache = SharedCache()
+    cache.configure(path, size, 60)
+    cache.put("order:7", {"id": 7}, ["order:7"], cache.generations(["order:7"]))
+
+
+class TestSharedCache(TestCase):
+    """Test Cases for the SharedCache"""
+
+    def setUp(self):
+        self.workdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.workdir.name, "cache")
+        self.cache = SharedCache()
+        self.cache.configure(self.path, 1024 * 1024, 60)
+
+    def tearDown(self):
+        self.cache.configure(self.path, 0, 0, enabled=False)
+        self.workdir.cleanup()
+
+    def _put(self, key, value, names=()):
+        self.cache.put(key, value, list(names), self.cache.generations(list(names)))
+
+    def test_put_and_get(self):
+        """It should return what was cached and nothing for other keys"""
+        self._put("order:1", {"id": 1, "items": []}, ["order:1"])
+        self.assertEqual(self.cache.get("order:1"), {"id": 1, "items": []})
+        self.assertIsNone(self.cache.get("order:2"))
+        self.assertEqual(self.cache.stats()["hits"], 1)
+        self.assertEqual(self.cache.stats()["misses"], 1)
+
+    def test_bump(self):
+        """It should forget entries depending on a bumped counter"""
+        self._put("order:1", {"id": 1}, ["order:1"])
+        self._put("order:2", {"id": 2}, ["order:2"])
+        self.cache.bump(["order:1"])
+        self.assertIsNone(self.cache.get("order:1"))
+        self.assertEqual(self.cache.get("order:2"), {"id": 2})
+
+    def test_notified_dependencies(self):
+        """It should invalidate every filtered list for a NOTIFYed change, which has no scope"""
+        event = {"order_id": 3, "item_id": None, "customer_id": 4, "action": "archive"}
+        self.assertEqual(order_dependencies(event), ["order:3", "orders", "lists"])
+        self.assertEqual(order_dependencies(dict(event, scope={"customer_id": [4]})),
+                         ["order:3", "orders", "customer_id:4"])
+
+    def test_write_while_fetching(self):
+        """It should not cache a value fetched before a write"""
+        generations = self.cache.generations(["order:1"])
+        self.cache.bump(["order:1"])
+        self.cache.put("order:1", {"id": 1, "status": "PLACED"}, ["order:1"], generations)
+        self.assertIsNone(self.cache.get("order:1"))
+        self.assertEqual(self.cache.stats()["skipped"], 1)
+
+    def test_expire(self):
+        """It should forget entries older than the ttl"""
+        self.cache.configure(self.path, 1024 * 1024, 0.01)
+        self._put("orders", [])
+        time.sleep(0.02)
+        self.assertIsNone(self.cache.get("orders"))
+
+    def test_least_recently_used(self):
+        """It should evict the least recently used entry of a full set"""
+        # One set in each tier
+        self.cache.configure(self.path, len(SLOT_SIZES) * SLOT_SIZES[0] * WAYS, 60)
+        for number in range(WAYS):
+            self._put(f"order:{number}", {"id": number})
+        self.cache.get("order:0")
+        self._put("order:big", {"id": "x" * SLOT_SIZES[0]})
+        self._put(f"order:{WAYS}", {"id": WAYS})
+        self.assertEqual(self.cache.get("order:0"), {"id": 0})
+        self.assertIsNone(self.cache.get("order:1"))
+        self.assertEqual(self.cache.get("order:big")["id"], "x" * SLOT_SIZES[0])
+        self.assertEqual(self.cache.stats()["evictions"], 1)
+
+    def test_too_large(self):
+        """It should not cache values larger than the largest slot"""
+        self._put("orders", ["x" * SLOT_SIZES[-1]])
+        self.assertIsNone(self.cache.get("orders"))
+        self.assertEqual(self.cache.stats()["skipped"], 1)
+
+    def test_shared_between_processes(self):
+        """It should read entries cached by another process"""
+        process = multiprocessing.get_context("fork").Process(target=_store, args=(self.path, 1024 * 1024))
+        process.start()
+        process.join(10)
+        self.assertEqual(process.exitcode, 0)
+        self.assertEqual(self.cache.get("order:7"), {"id": 7})
+
+    def test_rebuild_on_resize(self):
+        """It should start empty when the size of the cache changes"""
+        self._put("order:1", {"id": 1})
+        self.cache.configure(self.path, 2 * 1024 * 1024, 60)
+        self.assertIsNone(self.cache.get("order:1"))
+        self.cache.clear()
@@ -0,0 +1,83 @@
+"""
+Test cases for Single Flight
+"""
+import threading
+from unittest import TestCase
+from service import app
+from service.utils.singleflight import SingleFlight
+
+
+class TestSingleFlight(TestCase):
+    """Test Cases for coalescing reads"""
+
+    def setUp(self):
+        self.flights = SingleFlight()
+        self.flights.app = app
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.calls = 0
+
+    def _fetch(self, value):
+        """Stands in for a slow query"""
+        self.calls += 1
+        self.started.set()
+        self.release.wait(5)
+        if isinstance(value, Exception):
+            raise value
+        return {"value": value}
+
+    def _run(self, key, value, results):
+        """Calls the single flight in a thread, keeping what it returns or raises"""
+        def call():
+            try:
+                results.append(self.flights.do(key, self._fetch, value))
+            except ValueError as error:
+                results.append(error)
+        thread = threading.Thread(target=call)
+        thread.start()
+        return thread
+
+    def _join_waiting(self, key, count):
+        """Waits until count callers share the flight of key"""
+        while self.flights.stats().get(key[0], {}).get("coalesced", 0) < count:
+            self.release.wait(0.001)
+
+    def test_coalesce(self):
+        """It should fetch once for the callers of the same key"""
+        results = []
+        threads = [self._run(("order", 1), 1, results)]
+        self.started.wait(5)
+        threads += [self._run(("order", 1), 1, results) for _ in range(3)]
+        self._join_waiting(("order", 1), 3)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(results, [{"value": 1}] * 4)
+        self.assertEqual(self.flights.stats(), {"order": {"fetches": 1, "coalesced": 3}})
+        self.assertEqual(self.flights.do(("order", 1), self._fetch, 2), {"value": 2})
+
+    def test_share_errors(self):
+        """It should raise the error of the fetch in every caller"""
+        results = []
+        threads = [self._run(("order", 1), ValueError("bad"), results)]
+        self.started.wait(5)
+        threads.append(self._run(("order", 1), ValueError("bad"), results))
+        self._join_waiting(("order", 1), 1)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(results), 2)
+        self.assertIs(results[0], results[1])
+
+    def test_expire(self):
+        """It should not share a flight started before a commit"""
+        results = []
+        thread = self._run(("orders", None), 1, results)
+        self.started.wait(5)
+        self.flights.expire([])
+        self.release.set()
+        self.assertEqual(self.flights.do(("orders", None), self._fetch, 2), {"value": 2})
+        thread.join()
+        self.assertEqual(self.calls, 2)
+        self.assertEqual(self.flights.stats(), {"orders": {"fetches": 2, "coalesced": 0}})